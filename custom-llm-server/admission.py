@@ -0,0 +1,207 @@
+"""
+Admission control for the Custom LLM Server
+A bounded, per-client fair queue in front of completion work, with priority
+classes, queue-time deadlines and fast rejection when it is full
+"""
+
+import asyncio
+import math
+import time
+from collections import OrderedDict, deque
+from typing import Any, Deque, Dict, Optional, Sequence
+
+from metrics import ADMISSION_QUEUE_DEPTH, ADMISSION_REJECTED, ADMISSION_WAIT_SECONDS
+
+# Bounds on the Retry-After hint, in seconds
+MIN_RETRY_AFTER = 1
+MAX_RETRY_AFTER = 60
+
+class AdmissionRejected(Exception):
+    """The request was not admitted; retry_after is a hint in whole seconds"""
+
+    def __init__(self, reason: str, message: str, retry_after: int):
+        super().__init__(message)
+        self.reason = reason
+        self.retry_after = retry_after
+
+class _Waiter:
+    __slots__ = ("client", "priority", "future", "enqueued")
+
+    def __init__(self, client: str, priority: str, future: "asyncio.Future"):
+        self.client = client
+        self.priority = priority
+        self.future = future
+        self.enqueued = time.perf_counter()
+
+class Ticket:
+    """An admitted request's slot; release() is safe to call more than once"""
+    __slots__ = ("_controller", "priority", "wait_seconds", "admitted", "released")
+
+    def __init__(self, controller: "AdmissionController", priority: str, wait_seconds: float):
+        self._controller = controller
+        self.priority = priority
+        self.wait_seconds = wait_seconds
+        self.admitted = time.perf_counter()
+        self.released = False
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            self._controller._release(time.perf_counter() - self.admitted)
+
+class AdmissionController:
+    """Admits up to max_active requests at once and queues the rest fairly
+
+    Priority classes are strict: a queued request of an earlier class in
+    priorities is always admitted before one of a later class. Within a
+    class, clients take turns, so one client's burst waits behind its own
+    requests rather than everyone else's. Requests that would push the
+    queue past max_queue, or a client past max_queue_per_client, are
+    rejected at once instead of timing out later.
+    """
+
+    def __init__(self, max_active: int = 64, max_queue: int = 256, max_queue_per_client: int = 32,
+                 queue_timeouts: Optional[Dict[str, float]] = None,
+                 priorities: Sequence[str] = ("interactive", "batch"), window: int = 1000):
+        self.max_active = max_active
+        self.max_queue = max_queue
+        self.max_queue_per_client = max_queue_per_client
+        self.priorities = tuple(priorities)
+        self.queue_timeouts = {priority: 10.0 for priority in self.priorities}
+        self.queue_timeouts.update(queue_timeouts or {})
+        self.active = 0
+        self.queued = 0
+        # priority -> client -> that client's waiters, clients in turn order
+        self._queues: Dict[str, "OrderedDict[str, Deque[_Waiter]]"] = {
+            priority: OrderedDict() for priority in self.priorities
+        }
+        self._client_queued: Dict[str, int] = {}
+        self._waits: Dict[str, Deque[float]] = {priority: deque(maxlen=window) for priority in self.priorities}
+        # Moving average of how long an admitted request holds its slot, for Retry-After
+        self._hold_seconds = 1.0
+        self.admitted = 0
+        self.rejected: Dict[str, int] = {}
+
+    async def acquire(self, client: str, priority: str) -> Ticket:
+        """Wait for a slot, or raise AdmissionRejected if the queue is full or the deadline passes"""
+        if priority not in self._queues:
+            raise ValueError(f"Unknown priority: {priority}. Available: {list(self.priorities)}")
+        if self.active < self.max_active and not self.queued:
+            self._admit(priority, 0.0)
+            return Ticket(self, priority, 0.0)
+        if self.queued >= self.max_queue:
+            raise self._reject("queue_full", "Server is over capacity")
+        if self._client_queued.get(client, 0) >= self.max_queue_per_client:
+            raise self._reject("client_queue_full", "Too many queued requests for this client")
+
+        waiter = _Waiter(client, priority, asyncio.get_running_loop().create_future())
+        self._enqueue(waiter)
+        try:
+            await asyncio.wait([waiter.future], timeout=self.queue_timeouts[priority])
+        except asyncio.CancelledError:
+            if waiter.future.done():
+                # Admitted while the caller was being cancelled; hand the slot on
+                self._release(0.0)
+            else:
+                self._dequeue(waiter)
+            raise
+        if not waiter.future.done():
+            self._dequeue(waiter)
+            raise self._reject("queue_timeout", "Request waited too long in the admission queue")
+        return Ticket(self, priority, time.perf_counter() - waiter.enqueued)
+
+    def _admit(self, priority: str, wait_seconds: float) -> None:
+        self.active += 1
+        self.admitted += 1
+        self._waits[priority].append(wait_seconds)
+        ADMISSION_WAIT_SECONDS.observe(wait_seconds, priority)
+
+    def _reject(self, reason: str, message: str) -> AdmissionRejected:
+        self.rejected[reason] = self.rejected.get(reason, 0) + 1
+        ADMISSION_REJECTED.inc(1, reason)
+        return AdmissionRejected(reason, message, self.retry_after())
+
+    def retry_after(self) -> int:
+        """Seconds until the current queue should have drained, going by recent hold times"""
+        seconds = self._hold_seconds * (self.queued + 1) / max(1, self.max_active)
+        return max(MIN_RETRY_AFTER, min(MAX_RETRY_AFTER, math.ceil(seconds)))
+
+    def _enqueue(self, waiter: _Waiter) -> None:
+        clients = self._queues[waiter.priority]
+        clients.setdefault(waiter.client, deque()).append(waiter)
+        self._client_queued[waiter.client] = self._client_queued.get(waiter.client, 0) + 1
+        self.queued += 1
+        ADMISSION_QUEUE_DEPTH.inc(1, waiter.priority)
+
+    def _dequeue(self, waiter: _Waiter) -> None:
+        clients = self._queues[waiter.priority]
+        waiters = clients[waiter.client]
+        waiters.remove(waiter)
+        if not waiters:
+            del clients[waiter.client]
+        self._forget(waiter)
+
+    def _forget(self, waiter: _Waiter) -> None:
+        remaining = self._client_queued[waiter.client] - 1
+        if remaining:
+            self._client_queued[waiter.client] = remaining
+        else:
+            del self._client_queued[waiter.client]
+        self.queued -= 1
+        ADMISSION_QUEUE_DEPTH.dec(1, waiter.priority)
+
+    def _next_waiter(self) -> Optional[_Waiter]:
+        for priority in self.priorities:
+            clients = self._queues[priority]
+            if not clients:
+                continue
+            client, waiters = next(iter(clients.items()))
+            waiter = waiters.popleft()
+            if waiters:
+                # The client goes to the back of the line for its next request
+                clients.move_to_end(client)
+            else:
+                del clients[client]
+            self._forget(waiter)
+            return waiter
+        return None
+
+    def _release(self, held_seconds: float) -> None:
+        self.active -= 1
+        if held_seconds:
+            self._hold_seconds += 0.1 * (held_seconds - self._hold_seconds)
+        while self.active < self.max_active:
+            waiter = self._next_waiter()
+            if waiter is None:
+                break
+            waiter.future.set_result(None)
+            self._admit(waiter.priority, time.perf_counter() - waiter.enqueued)
+
+    def wait_percentiles(self, priority: str) -> Dict[str, Optional[float]]:
+        waits = sorted(self._waits[priority])
+        if not waits:
+            return {"p50": None, "p90": None, "p99": None, "max": None}
+
+        def at(q: float) -> float:
+            return round(waits[min(len(waits) - 1, int(q * len(waits)))] * 1000, 2)
+
+        return {"p50": at(0.5), "p90": at(0.9), "p99": at(0.99), "max": round(waits[-1] * 1000, 2)}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": self.active,
+            "max_active": self.max_active,
+            "queued": self.queued,
+            "max_queue": self.max_queue,
+            "max_queue_per_client": self.max_queue_per_client,
+            "queued_by_priority": {
+                priority: sum(len(waiters) for waiters in clients.values())
+                for priority, clients in self._queues.items()
+            },
+            "queued_clients": len(self._client_queued),
+            "wait_ms": {priority: self.wait_percentiles(priority) for priority in self.priorities},
+            "queue_timeouts_s": self.queue_timeouts,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "retry_after_s": self.retry_after(),
+        }
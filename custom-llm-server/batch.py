@@ -0,0 +1,178 @@
+"""
+Batch completion runner
+Splits a JSONL upload into records, runs them through a handler with
+bounded concurrency and yields JSONL results in completion order,
+journaling successes so an interrupted batch can be resumed
+"""
+
+import asyncio
+import json
+import os
+import time
+import uuid
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, Iterable, Iterator, Optional, Set, Tuple
+
+_encode = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+
+# Sentinel that marks the end of the input queue
+_END = object()
+
+def new_batch_id() -> str:
+    return f"batch-{uuid.uuid4().hex[:16]}"
+
+def iter_jsonl(data: bytes) -> Iterator[Tuple[int, str]]:
+    """Split an upload into (index, line) pairs, skipping blank lines"""
+    index = 0
+    for line in data.split(b"\n"):
+        if line.strip():
+            # An undecodable line fails on its own when parsed, not the whole batch
+            yield index, line.decode("utf-8", errors="replace")
+            index += 1
+
+class BatchJournal:
+    """Append-only JSONL record of a batch's successful results, keyed by input index"""
+
+    def __init__(self, directory: str, batch_id: str):
+        if not batch_id.replace("-", "").replace("_", "").isalnum():
+            raise ValueError("batch_id may only contain letters, digits, '-' and '_'")
+        os.makedirs(directory, exist_ok=True)
+        self.path = os.path.join(directory, f"{batch_id}.jsonl")
+        self._file = None
+
+    def completed(self) -> Dict[int, str]:
+        """Result lines already journaled, by index; a torn final line is ignored"""
+        results: Dict[int, str] = {}
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        results[json.loads(line)["index"]] = line.rstrip("\n")
+                    except (ValueError, KeyError):
+                        continue
+        except FileNotFoundError:
+            pass
+        return results
+
+    def append(self, line: str) -> None:
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file.write(line + "\n")
+        self._file.flush()
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+def prune_journals(directory: str, max_age_seconds: float) -> int:
+    """Delete journals of batches not touched for max_age_seconds"""
+    removed = 0
+    cutoff = time.time() - max_age_seconds
+    try:
+        names = os.listdir(directory)
+    except FileNotFoundError:
+        return 0
+    for name in names:
+        path = os.path.join(directory, name)
+        if name.endswith(".jsonl") and os.path.getmtime(path) < cutoff:
+            try:
+                os.remove(path)
+                removed += 1
+            except OSError:
+                pass
+    return removed
+
+async def run_batch(records: Iterable[Tuple[int, str]],
+                    handler: Callable[[Dict[str, Any]], Awaitable[Dict[str, Any]]],
+                    concurrency: int, batch_id: str,
+                    journal: Optional[BatchJournal] = None,
+                    on_error: Optional[Callable[[Exception], None]] = None) -> AsyncIterator[str]:
+    """Run every record through handler and yield one JSON line per record as it finishes
+
+    Successful lines are {"index", "response"}; failed ones are {"index",
+    "error"} and never affect other records. Records that succeeded in an
+    earlier run of the same journal are replayed from it with
+    "resumed": true instead of being run again. The final line is a
+    {"summary": ...} with counts and throughput.
+    """
+    started = time.perf_counter()
+    completed = journal.completed() if journal is not None else {}
+    inputs: asyncio.Queue = asyncio.Queue(maxsize=concurrency * 2)
+    results: asyncio.Queue = asyncio.Queue()
+    counts = {"succeeded": 0, "failed": 0, "resumed": 0, "prompt_tokens": 0, "completion_tokens": 0}
+    replayed: Set[int] = set()
+
+    async def produce():
+        try:
+            for index, line in records:
+                if index in completed:
+                    replayed.add(index)
+                    results.put_nowait(completed[index][:-1] + ",\"resumed\":true}")
+                    continue
+                await inputs.put((index, line))
+        finally:
+            for _ in range(concurrency):
+                await inputs.put(_END)
+
+    async def work():
+        while True:
+            item = await inputs.get()
+            if item is _END:
+                return
+            index, line = item
+            tagged: Dict[str, Any] = {"index": index}
+            try:
+                record = json.loads(line)
+                if isinstance(record, dict) and "custom_id" in record:
+                    tagged["custom_id"] = record["custom_id"]
+                response = await handler(record)
+            except Exception as e:
+                if on_error is not None:
+                    on_error(e)
+                counts["failed"] += 1
+                results.put_nowait(_encode({**tagged, "error": {"type": type(e).__name__, "message": str(e)}}))
+                continue
+            usage = response.get("usage") or {}
+            counts["prompt_tokens"] += usage.get("prompt_tokens") or 0
+            counts["completion_tokens"] += usage.get("completion_tokens") or 0
+            counts["succeeded"] += 1
+            result = _encode({**tagged, "response": response})
+            if journal is not None:
+                journal.append(result)
+            results.put_nowait(result)
+
+    producer = asyncio.create_task(produce())
+    workers = [asyncio.create_task(work()) for _ in range(concurrency)]
+    finished = asyncio.gather(producer, *workers)
+    getter: Optional[asyncio.Future] = None
+    try:
+        while True:
+            getter = asyncio.ensure_future(results.get())
+            await asyncio.wait({getter, finished}, return_when=asyncio.FIRST_COMPLETED)
+            if getter.done():
+                yield getter.result() + "\n"
+                continue
+            while not results.empty():
+                yield results.get_nowait() + "\n"
+            await finished
+            break
+    finally:
+        # Also reached when the client disconnects; journaled results survive for a resume
+        for task in [getter, producer, *workers]:
+            if task is not None:
+                task.cancel()
+        if journal is not None:
+            journal.close()
+
+    elapsed = time.perf_counter() - started
+    counts["resumed"] = len(replayed)
+    ran = counts["succeeded"] + counts["failed"]
+    summary = dict(
+        batch_id=batch_id,
+        total=ran + counts["resumed"],
+        **counts,
+        elapsed_seconds=round(elapsed, 3),
+        requests_per_second=round(ran / elapsed, 2) if elapsed else 0.0,
+        completion_tokens_per_second=round(counts["completion_tokens"] / elapsed, 2) if elapsed else 0.0,
+    )
+    yield _encode({"summary": summary}) + "\n"
@@ -0,0 +1,408 @@
+#!/usr/bin/env python3
+"""
+Load testing and latency benchmark for the Custom LLM Server
+Drives /chat/completions concurrently in streaming and non-streaming mode and
+reports time-to-first-token, inter-token latency, latency percentiles and
+throughput per concurrency level, optionally against a local mock upstream.
+A share of the requests can carry large payloads, to measure how their
+preparation disturbs the streams running alongside them.
+
+Examples:
+    python benchmark.py --spawn --concurrency 1,8,32 --requests 200 --output results.json
+    python benchmark.py --url http://localhost:8001 --mode stream --baseline results.json
+    python benchmark.py --spawn --mode stream --heavy-fraction 0.2 --offload off,thread
+    HEDGE_ENABLED=true python benchmark.py --spawn --mode stream --mock-slow-rate 0.05 --fallback-mock
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+import aiohttp
+
+SERVER_DIR = Path(__file__).resolve().parent
+
+def percentile(values: List[float], pct: float) -> Optional[float]:
+    """Linear-interpolated percentile, or None for an empty sample"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = (len(ordered) - 1) * pct / 100
+    low = int(rank)
+    high = min(low + 1, len(ordered) - 1)
+    return ordered[low] + (ordered[high] - ordered[low]) * (rank - low)
+
+def latency_summary(values: List[float]) -> Dict[str, Optional[float]]:
+    """p50/p95/p99/mean/max in milliseconds"""
+    def ms(value):
+        return round(value * 1000, 2) if value is not None else None
+    return {
+        "p50_ms": ms(percentile(values, 50)),
+        "p95_ms": ms(percentile(values, 95)),
+        "p99_ms": ms(percentile(values, 99)),
+        "mean_ms": ms(sum(values) / len(values)) if values else None,
+        "max_ms": ms(max(values)) if values else None,
+    }
+
+def heavy_messages(index: int, count: int, chars: int) -> List[Dict[str, str]]:
+    """A long conversation, distinct per request, ahead of the final question"""
+    words = [f"w{index}x{n}" for n in range(64)]
+    text = " ".join(words)
+    filler = (text + " ") * (chars // (len(text) + 1) + 1)
+    return [
+        {"role": "user" if turn % 2 == 0 else "assistant", "content": filler[:chars]}
+        for turn in range(count)
+    ]
+
+def is_heavy(index: int, heavy_fraction: float) -> bool:
+    """Spread heavy requests evenly: every (1 / heavy_fraction)th request"""
+    if heavy_fraction <= 0:
+        return False
+    return index % max(1, round(1 / heavy_fraction)) == 0
+
+def build_payload(index: int, stream: bool, model: str, prompt: str, identical: bool,
+                  heavy: Optional[Dict[str, int]] = None) -> Dict[str, Any]:
+    # Unique prompts by default so caching and coalescing do not flatter the numbers
+    content = prompt if identical else f"{prompt} (request {index})"
+    messages = heavy_messages(index, heavy["messages"], heavy["chars"]) if heavy else []
+    return {
+        "model": model,
+        "messages": messages + [{"role": "user", "content": content}],
+        "stream": stream,
+    }
+
+async def timed_request(session: aiohttp.ClientSession, url: str, payload: Dict[str, Any],
+                        headers: Optional[Dict[str, str]] = None) -> Dict[str, Any]:
+    """Send one request and record when each content token arrived"""
+    started = time.perf_counter()
+    token_times: List[float] = []
+    try:
+        async with session.post(f"{url}/chat/completions", json=payload, headers=headers) as response:
+            if response.status != 200:
+                await response.read()
+                return {"ok": False, "status": response.status, "latency": time.perf_counter() - started}
+
+            if not payload["stream"]:
+                body = await response.json()
+                finished = time.perf_counter()
+                content = body["choices"][0]["message"].get("content") or ""
+                return {"ok": True, "status": 200, "ttft": finished - started,
+                        "latency": finished - started, "token_times": [], "chars": len(content)}
+
+            chars = 0
+            errored = False
+            async for raw_line in response.content:
+                line = raw_line.decode("utf-8").strip()
+                if not line.startswith("data: ") or line == "data: [DONE]":
+                    continue
+                chunk = json.loads(line[6:])
+                if not chunk.get("choices"):
+                    continue
+                content = chunk["choices"][0].get("delta", {}).get("content")
+                if content:
+                    token_times.append(time.perf_counter())
+                    chars += len(content)
+                    errored = errored or content.startswith("Error: ")
+            finished = time.perf_counter()
+            return {
+                "ok": bool(token_times) and not errored,
+                "status": 200,
+                "ttft": token_times[0] - started if token_times else None,
+                "latency": finished - started,
+                "token_times": token_times,
+                "chars": chars,
+            }
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        return {"ok": False, "status": None, "error": str(e), "latency": time.perf_counter() - started}
+
+async def run_level(url: str, concurrency: int, total_requests: int, stream: bool,
+                    model: str, prompt: str, identical: bool, timeout: float,
+                    heavy_fraction: float = 0.0, heavy: Optional[Dict[str, int]] = None) -> Dict[str, Any]:
+    """Run total_requests with a fixed number of concurrent workers
+
+    With heavy_fraction, that share of the requests carries the heavy
+    payload; inter-token latency is measured over the light ones, which
+    are the streams a heavy request's preparation would hold up.
+    """
+    results: List[Dict[str, Any]] = []
+    next_index = 0
+
+    async def worker(session: aiohttp.ClientSession):
+        nonlocal next_index
+        while next_index < total_requests:
+            index = next_index
+            next_index += 1
+            heavy_request = is_heavy(index, heavy_fraction)
+            payload = build_payload(index, stream, model, prompt, identical, heavy if heavy_request else None)
+            result = await timed_request(session, url, payload)
+            result["heavy"] = heavy_request
+            results.append(result)
+
+    connector = aiohttp.TCPConnector(limit=concurrency)
+    client_timeout = aiohttp.ClientTimeout(total=timeout)
+    async with aiohttp.ClientSession(connector=connector, timeout=client_timeout) as session:
+        started = time.perf_counter()
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+        duration = time.perf_counter() - started
+
+    ok = [r for r in results if r["ok"]]
+    inter_token = []
+    for r in ok:
+        if r["heavy"]:
+            continue
+        times = r["token_times"]
+        inter_token.extend(later - earlier for earlier, later in zip(times, times[1:]))
+    tokens = sum(max(len(r["token_times"]), 1) for r in ok)
+
+    errors: Dict[str, int] = {}
+    for r in results:
+        if not r["ok"]:
+            key = str(r.get("status") or "connection")
+            errors[key] = errors.get(key, 0) + 1
+
+    return {
+        "mode": "stream" if stream else "non-stream",
+        "concurrency": concurrency,
+        "requests": len(results),
+        "heavy_requests": sum(1 for r in results if r["heavy"]),
+        "successes": len(ok),
+        "errors": errors,
+        "duration_s": round(duration, 3),
+        "requests_per_s": round(len(ok) / duration, 2) if duration else 0.0,
+        "chunks_per_s": round(tokens / duration, 2) if duration else 0.0,
+        "ttft": latency_summary([r["ttft"] for r in ok if r.get("ttft") is not None]),
+        "inter_token": latency_summary(inter_token),
+        "latency": latency_summary([r["latency"] for r in ok]),
+    }
+
+def wait_until_healthy(url: str, timeout: float = 30) -> bool:
+    """Poll /health until the server answers"""
+    import urllib.request
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            with urllib.request.urlopen(f"{url}/health", timeout=1) as response:
+                if response.status == 200:
+                    return True
+        except OSError:
+            time.sleep(0.2)
+    return False
+
+def spawn_mock(args, port: int, error_rate: float, slow_rate: float) -> subprocess.Popen:
+    return subprocess.Popen([
+        sys.executable, str(SERVER_DIR / "mock_upstream.py"),
+        "--port", str(port),
+        "--ttft", str(args.mock_ttft),
+        "--tps", str(args.mock_tps),
+        "--tokens", str(args.mock_tokens),
+        "--error-rate", str(error_rate),
+        "--slow-rate", str(slow_rate),
+        "--slow-ttft", str(args.mock_slow_ttft),
+    ], cwd=SERVER_DIR)
+
+def spawn_stack(args, offload: Optional[str] = None) -> List[subprocess.Popen]:
+    """Start the mock upstream and a server pointed at it, with OFFLOAD_MODE set if given
+
+    With --fallback-mock, a second mock without injected errors or slow
+    requests is started and configured as the server's fallback backend.
+    """
+    processes = [spawn_mock(args, args.mock_port, args.mock_error_rate, args.mock_slow_rate)]
+
+    env = dict(os.environ)
+    env.update({
+        "LLM_BACKEND": "openai",
+        "OPENAI_API_KEY": "mock",
+        "OPENAI_API_BASE": f"http://127.0.0.1:{args.mock_port}/v1",
+    })
+    if args.fallback_mock:
+        processes.append(spawn_mock(args, args.fallback_mock_port, 0.0, 0.0))
+        env.update({
+            "FALLBACK_LLM_BACKEND": "openai",
+            "FALLBACK_OPENAI_API_BASE": f"http://127.0.0.1:{args.fallback_mock_port}/v1",
+        })
+    if offload:
+        env["OFFLOAD_MODE"] = offload
+    port = args.url.rsplit(":", 1)[-1].split("/")[0]
+    server = subprocess.Popen([
+        sys.executable, "-m", "uvicorn", "server:app",
+        "--host", "127.0.0.1", "--port", port, "--log-level", "warning",
+    ], cwd=SERVER_DIR, env=env)
+    return processes + [server]
+
+def run_metadata(args, url: str) -> Dict[str, Any]:
+    """Describe what was measured so result files can be compared later"""
+    import urllib.request
+    server_version = None
+    try:
+        with urllib.request.urlopen(f"{url}/", timeout=2) as response:
+            server_version = json.loads(response.read()).get("version")
+    except (OSError, ValueError):
+        pass
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=SERVER_DIR,
+                                capture_output=True, text=True, timeout=5).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        commit = None
+    return {
+        "timestamp": datetime.now().isoformat(),
+        "server_version": server_version,
+        "git_commit": commit,
+        "python": platform.python_version(),
+        "url": url,
+        "spawned_mock_upstream": args.spawn,
+        "mock_upstream": {
+            "ttft_s": args.mock_ttft,
+            "tokens_per_s": args.mock_tps,
+            "tokens": args.mock_tokens,
+            "error_rate": args.mock_error_rate,
+            "slow_rate": args.mock_slow_rate,
+            "slow_ttft_s": args.mock_slow_ttft,
+            "fallback_mock": args.fallback_mock,
+        } if args.spawn else None,
+        "hedging": os.getenv("HEDGE_ENABLED", "false").lower() == "true" if args.spawn else None,
+        "requests_per_level": args.requests,
+        "identical_prompts": args.identical,
+        "heavy_requests": {
+            "fraction": args.heavy_fraction,
+            "messages": args.heavy_messages,
+            "message_chars": args.heavy_message_chars,
+        } if args.heavy_fraction > 0 else None,
+    }
+
+def result_key(result: Dict[str, Any]) -> tuple:
+    return result["mode"], result["concurrency"], result.get("offload")
+
+def print_results(results: List[Dict[str, Any]]) -> None:
+    print(f"\n{'mode':<11}{'offload':<9}{'conc':>5}{'ok':>7}{'err':>6}{'req/s':>9}"
+          f"{'ttft p50':>10}{'p95':>9}{'p99':>9}{'itl p50':>9}{'p99':>9}{'lat p99':>10}")
+    for r in results:
+        def fmt(value):
+            return f"{value:.1f}" if value is not None else "-"
+        print(f"{r['mode']:<11}{r.get('offload') or '-':<9}{r['concurrency']:>5}{r['successes']:>7}{sum(r['errors'].values()):>6}"
+              f"{r['requests_per_s']:>9.1f}{fmt(r['ttft']['p50_ms']):>10}{fmt(r['ttft']['p95_ms']):>9}"
+              f"{fmt(r['ttft']['p99_ms']):>9}{fmt(r['inter_token']['p50_ms']):>9}"
+              f"{fmt(r['inter_token']['p99_ms']):>9}{fmt(r['latency']['p99_ms']):>10}")
+
+def compare_with_baseline(results: List[Dict[str, Any]], baseline_path: str) -> None:
+    """Print relative change against a previous result file"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = {result_key(r): r for r in json.load(f)["results"]}
+    print(f"\n📈 Change vs {baseline_path} (positive = slower / more)")
+    for r in results:
+        old = baseline.get(result_key(r))
+        if not old:
+            continue
+        changes = []
+        for label, new_value, old_value in [
+            ("req/s", r["requests_per_s"], old["requests_per_s"]),
+            ("ttft p95", r["ttft"]["p95_ms"], old["ttft"]["p95_ms"]),
+            ("itl p99", r["inter_token"]["p99_ms"], old["inter_token"]["p99_ms"]),
+            ("lat p99", r["latency"]["p99_ms"], old["latency"]["p99_ms"]),
+        ]:
+            if new_value is not None and old_value:
+                changes.append(f"{label} {100 * (new_value - old_value) / old_value:+.1f}%")
+        offload = f" offload={r['offload']}" if r.get("offload") else ""
+        print(f"   {r['mode']:<11} c={r['concurrency']:<4}{offload} " + ", ".join(changes))
+
+def compare_offload_modes(results: List[Dict[str, Any]]) -> None:
+    """Print inter-token p99 with offloading off against each other mode, per level"""
+    by_key = {result_key(r): r for r in results}
+    print("\n🧵 Inter-token p99 by offload mode")
+    for r in results:
+        if r.get("offload") in (None, "off"):
+            continue
+        off = by_key.get((r["mode"], r["concurrency"], "off"))
+        if not off or off["inter_token"]["p99_ms"] is None or r["inter_token"]["p99_ms"] is None:
+            continue
+        print(f"   {r['mode']:<11} c={r['concurrency']:<4} off {off['inter_token']['p99_ms']:.1f} ms"
+              f" -> {r['offload']} {r['inter_token']['p99_ms']:.1f} ms")
+
+async def run_benchmark(args, offload: Optional[str] = None) -> Dict[str, Any]:
+    modes = {"stream": [True], "non-stream": [False], "both": [True, False]}[args.mode]
+    levels = [int(level) for level in args.concurrency.split(",")]
+    heavy = {"messages": args.heavy_messages, "chars": args.heavy_message_chars}
+    results = []
+    for stream in modes:
+        for concurrency in levels:
+            label = f" offload={offload}" if offload else ""
+            print(f"⏱️  {'stream' if stream else 'non-stream'} @ concurrency {concurrency}{label} ...")
+            result = await run_level(args.url, concurrency, args.requests, stream, args.model, args.prompt,
+                                     args.identical, args.timeout, args.heavy_fraction, heavy)
+            if offload:
+                result["offload"] = offload
+            results.append(result)
+    return {"meta": run_metadata(args, args.url), "results": results}
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the Custom LLM Server")
+    parser.add_argument("--url", default="http://127.0.0.1:8001", help="Server base URL")
+    parser.add_argument("--concurrency", default="1,8,32", help="Comma-separated concurrency levels")
+    parser.add_argument("--requests", type=int, default=100, help="Requests per concurrency level")
+    parser.add_argument("--mode", choices=["stream", "non-stream", "both"], default="both")
+    parser.add_argument("--model", default="gpt-3.5-turbo")
+    parser.add_argument("--prompt", default="What is your return policy?")
+    parser.add_argument("--identical", action="store_true", help="Send the same prompt every time")
+    parser.add_argument("--timeout", type=float, default=120, help="Per-request timeout in seconds")
+    parser.add_argument("--output", help="Write machine-readable JSON results here")
+    parser.add_argument("--baseline", help="Compare against an earlier --output file")
+    parser.add_argument("--spawn", action="store_true", help="Start the mock upstream and server automatically")
+    parser.add_argument("--mock-port", type=int, default=8002)
+    parser.add_argument("--mock-ttft", type=float, default=0.2)
+    parser.add_argument("--mock-tps", type=float, default=50)
+    parser.add_argument("--mock-tokens", type=int, default=60)
+    parser.add_argument("--mock-error-rate", type=float, default=0.0)
+    parser.add_argument("--mock-slow-rate", type=float, default=0.0, help="Share of mock requests with a slow first token")
+    parser.add_argument("--mock-slow-ttft", type=float, default=3.0, help="First-token delay of slow mock requests")
+    parser.add_argument("--fallback-mock", action="store_true",
+                        help="Also start a healthy mock and use it as the server's fallback backend")
+    parser.add_argument("--fallback-mock-port", type=int, default=8003)
+    parser.add_argument("--heavy-fraction", type=float, default=0.0,
+                        help="Share of requests that carry a large conversation, e.g. 0.2")
+    parser.add_argument("--heavy-messages", type=int, default=20, help="Messages in a heavy request")
+    parser.add_argument("--heavy-message-chars", type=int, default=20000, help="Characters per heavy message")
+    parser.add_argument("--offload", help="With --spawn, comma-separated OFFLOAD_MODE values to run in turn, e.g. off,thread")
+    args = parser.parse_args()
+    if args.offload and not args.spawn:
+        parser.error("--offload restarts the server per mode and needs --spawn")
+
+    print("📊 Custom LLM Server Benchmark")
+    print("=" * 40)
+
+    report = None
+    for offload in args.offload.split(",") if args.offload else [None]:
+        processes = spawn_stack(args, offload) if args.spawn else []
+        try:
+            if not wait_until_healthy(args.url):
+                print(f"❌ Server at {args.url} is not responding")
+                sys.exit(1)
+            run = asyncio.run(run_benchmark(args, offload))
+        finally:
+            for process in processes:
+                process.terminate()
+            for process in processes:
+                process.wait()
+        if report is None:
+            report = run
+        else:
+            report["results"].extend(run["results"])
+
+    print_results(report["results"])
+    if args.offload:
+        compare_offload_modes(report["results"])
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\n💾 Results written to {args.output}")
+    if args.baseline:
+        compare_with_baseline(report["results"], args.baseline)
+
+if __name__ == "__main__":
+    main()
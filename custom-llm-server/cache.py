@@ -0,0 +1,285 @@
+"""
+Caching for the Custom LLM Server
+In-memory LRU/TTL cache with an optional on-disk tier, and a completion
+cache keyed on the canonical form of a chat request
+"""
+
+import hashlib
+import inspect
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+WHITESPACE_PATTERN = re.compile(r"\s+")
+
+class LRUTTLCache:
+    """Bounded in-memory cache that evicts least recently used and expired entries"""
+
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 3600):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._entries: "OrderedDict[str, tuple]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def get(self, key: str) -> Optional[Any]:
+        """Return the cached value or None, refreshing its LRU position"""
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        expires_at, value = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: str, value: Any, ttl_seconds: Optional[float] = None) -> None:
+        """Store a value, evicting the oldest entries when over capacity"""
+        ttl = self.ttl_seconds if ttl_seconds is None else ttl_seconds
+        self._entries[key] = (time.monotonic() + ttl, value)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+        }
+
+class DiskCache:
+    """JSON-file cache tier; one file per key with an expiry timestamp"""
+
+    def __init__(self, directory: str, ttl_seconds: float = 86400):
+        self.directory = directory
+        self.ttl_seconds = ttl_seconds
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, f"{key}.json")
+
+    def get(self, key: str) -> Optional[Any]:
+        try:
+            with open(self._path(key), "r", encoding="utf-8") as f:
+                entry = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if entry["expires_at"] < time.time():
+            try:
+                os.remove(self._path(key))
+            except FileNotFoundError:
+                pass
+            return None
+        return entry["value"]
+
+    def set(self, key: str, value: Any) -> None:
+        # Write then rename so concurrent readers never see a partial file
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump({"expires_at": time.time() + self.ttl_seconds, "value": value}, f)
+        os.replace(tmp_path, path)
+
+def canonical_json(value: Any) -> str:
+    """Serialize with sorted keys and no insignificant whitespace"""
+    return json.dumps(value, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+
+def normalize_text(text: Optional[str]) -> Optional[str]:
+    """Collapse whitespace and lowercase, so trivially different prompts share a key"""
+    if text is None:
+        return None
+    return WHITESPACE_PATTERN.sub(" ", text).strip().lower()
+
+def request_key(model: str, messages: List[Dict[str, Any]], tools: Optional[List[Dict[str, Any]]],
+                temperature: float, max_tokens: Optional[int] = None, version: Any = None,
+                normalize: bool = False) -> str:
+    """SHA-256 of the canonical form of a chat request"""
+    if normalize:
+        messages = [dict(msg, content=normalize_text(msg.get("content"))) for msg in messages]
+    payload = {
+        "model": model,
+        "messages": messages,
+        "tools": tools,
+        "temperature": temperature,
+        "max_tokens": max_tokens,
+        "version": version,
+    }
+    return hashlib.sha256(canonical_json(payload).encode("utf-8")).hexdigest()
+
+class CompletionCache:
+    """Cache of final assistant completions keyed on the canonical request"""
+
+    def __init__(self, max_entries: int = 1024, ttl_seconds: float = 3600,
+                 normalize: bool = False, disk_dir: Optional[str] = None):
+        self.memory = LRUTTLCache(max_entries, ttl_seconds)
+        self.disk = DiskCache(disk_dir, ttl_seconds) if disk_dir else None
+        self.normalize = normalize
+        self.disk_hits = 0
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        value = self.memory.get(key)
+        if value is None and self.disk is not None:
+            value = self.disk.get(key)
+            if value is not None:
+                self.disk_hits += 1
+                self.memory.set(key, value)
+        return value
+
+    def set(self, key: str, completion: Dict[str, Any]) -> None:
+        self.memory.set(key, completion)
+        if self.disk is not None:
+            self.disk.set(key, completion)
+
+    def stats(self) -> Dict[str, Any]:
+        stats = self.memory.stats()
+        # A disk hit was first counted as a memory miss
+        stats["misses"] -= self.disk_hits
+        stats["hits"] += self.disk_hits
+        total = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / total, 4) if total else 0.0
+        stats["disk_hits"] = self.disk_hits
+        stats["disk_enabled"] = self.disk is not None
+        stats["normalize"] = self.normalize
+        return stats
+
+@dataclass(frozen=True)
+class ToolCachePolicy:
+    """How long a tool's results stay valid and which calls count as the same"""
+    ttl_seconds: float
+    # Rewrites arguments, with defaults filled in, so equivalent calls share a key
+    canonicalize: Optional[Callable[[Dict[str, Any]], Dict[str, Any]]] = None
+    # Extra key component, such as the version of the data the results come from
+    version: Optional[Callable[[], Any]] = None
+    # Rewrites a cached result for the call it answers: echoes that call's own
+    # arguments and re-stamps fields such as timestamps
+    refresh: Optional[Callable[[Any, Dict[str, Any]], Any]] = None
+
+class ToolResultCache:
+    """Serialized tool results keyed on the tool name and canonical arguments
+
+    Results are stored as the JSON sent back to the model, so a hit is not
+    serialized again. They are also stored under the raw argument string,
+    so an exact repeat is answered without parsing its arguments. Tools
+    whose policy has a refresh hook are the exception: their hits are
+    decoded, refreshed for the current arguments and encoded again. Tools
+    without a policy, or with a TTL of 0, are never cached; neither are
+    results with "success": false or larger than max_result_bytes.
+    """
+
+    def __init__(self, policies: Dict[str, ToolCachePolicy], max_entries: int = 4096,
+                 max_result_bytes: int = 65536):
+        self.policies = policies
+        self.max_result_bytes = max_result_bytes
+        self.memory = LRUTTLCache(max_entries)
+        self._signatures: Dict[str, inspect.Signature] = {}
+        self._tool_stats: Dict[str, Dict[str, int]] = {}
+
+    def _count(self, name: str, outcome: str) -> None:
+        stats = self._tool_stats.get(name)
+        if stats is None:
+            stats = self._tool_stats[name] = {"hits": 0, "misses": 0}
+        stats[outcome] += 1
+
+    def canonical_arguments(self, name: str, function: Callable, arguments: Dict[str, Any]) -> Dict[str, Any]:
+        signature = self._signatures.get(name)
+        if signature is None:
+            signature = self._signatures[name] = inspect.signature(function)
+        bound = signature.bind(**arguments)
+        bound.apply_defaults()
+        canonical = dict(bound.arguments)
+        policy = self.policies[name]
+        return policy.canonicalize(canonical) if policy.canonicalize else canonical
+
+    def _hit(self, name: str, policy: ToolCachePolicy, content: str, arguments: Any) -> str:
+        self._count(name, "hits")
+        if policy.refresh is None:
+            return content
+        if isinstance(arguments, str):
+            arguments = json.loads(arguments or "{}")
+        return json.dumps(policy.refresh(json.loads(content), arguments))
+
+    def lookup(self, name: str, function: Callable, arguments: Any) -> Tuple[Optional[str], List[str], Any]:
+        """Return (cached JSON or None, keys to store the result under, parsed arguments)
+
+        Raises the json.loads error for unparseable argument strings.
+        """
+        policy = self.policies.get(name)
+        if policy is None or policy.ttl_seconds <= 0:
+            if isinstance(arguments, str):
+                arguments = json.loads(arguments or "{}")
+            return None, [], arguments
+
+        prefix = f"{name}\0{policy.version() if policy.version else ''}\0"
+        keys = []
+        if isinstance(arguments, str):
+            raw_key = f"{prefix}raw\0{arguments}"
+            content = self.memory.get(raw_key)
+            if content is not None:
+                return self._hit(name, policy, content, arguments), [], None
+            keys.append(raw_key)
+            arguments = json.loads(arguments or "{}")
+
+        try:
+            key = prefix + canonical_json(self.canonical_arguments(name, function, arguments))
+        except (TypeError, ValueError):
+            # Arguments the tool would reject; let the call report the error
+            return None, [], arguments
+        content = self.memory.get(key)
+        if content is not None:
+            return self._hit(name, policy, content, arguments), [], arguments
+        self._count(name, "misses")
+        keys.append(key)
+        return content, keys, arguments
+
+    def store(self, name: str, keys: List[str], result: Any) -> str:
+        """Serialize a result and cache it under keys from lookup"""
+        content = json.dumps(result)
+        if keys and len(content) <= self.max_result_bytes \
+                and not (isinstance(result, dict) and result.get("success") is False):
+            ttl = self.policies[name].ttl_seconds
+            for key in keys:
+                self.memory.set(key, content, ttl)
+        return content
+
+    def stats(self) -> Dict[str, Any]:
+        memory = self.memory.stats()
+        tools = {}
+        for name, counts in sorted(self._tool_stats.items()):
+            total = counts["hits"] + counts["misses"]
+            tools[name] = {
+                **counts,
+                "hit_rate": round(counts["hits"] / total, 4) if total else 0.0,
+                "ttl_seconds": self.policies[name].ttl_seconds,
+            }
+        return {
+            "entries": memory["entries"],
+            "max_entries": memory["max_entries"],
+            "evictions": memory["evictions"],
+            "max_result_bytes": self.max_result_bytes,
+            "tools": tools,
+        }
+
+def split_for_replay(content: str) -> List[str]:
+    """Split cached content into word-sized pieces that look like streamed deltas"""
+    return re.findall(r"\s*\S+|\s+$", content) or [content]
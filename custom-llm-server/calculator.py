@@ -0,0 +1,304 @@
+"""
+Expression engine for the calculate tool
+Parses arithmetic once into a cached stack program, evaluates it under
+exponent, magnitude and step limits, runs heavy programs in a process pool
+with a hard timeout, and evaluates same-shaped batches with NumPy
+"""
+
+import ast
+import asyncio
+import math
+import operator
+import re
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Any, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from cache import LRUTTLCache
+
+# Same characters the calculator has always accepted; anything else is dropped
+ALLOWED_CHARACTERS = frozenset("0123456789+-*/.() ")
+MAX_EXPRESSION_LENGTH = 1000
+# Numbers, two-character operators, then any other single character
+EXPRESSION_TOKEN = re.compile(r"\d+\.?\d*|\.\d+|\*\*|//|\S")
+
+BINARY_OPS = {
+    ast.Add: "add",
+    ast.Sub: "sub",
+    ast.Mult: "mul",
+    ast.Div: "div",
+    ast.FloorDiv: "floordiv",
+    ast.Pow: "pow",
+}
+UNARY_OPS = {
+    ast.USub: "neg",
+    ast.UAdd: "pos",
+}
+OPERATIONS = {
+    "add": operator.add,
+    "sub": operator.sub,
+    "mul": operator.mul,
+    "div": operator.truediv,
+    "floordiv": operator.floordiv,
+}
+# Operations NumPy reproduces exactly enough to evaluate batches in one pass
+VECTORIZABLE = frozenset({"const", "add", "sub", "mul", "div", "neg", "pos"})
+
+class CalculationError(Exception):
+    """An expression that is invalid or exceeds the evaluation limits"""
+
+@dataclass(frozen=True)
+class Limits:
+    max_exponent: int = 1000
+    max_magnitude: float = 1e100
+    max_steps: int = 500
+
+@dataclass(frozen=True)
+class CompiledExpression:
+    """Postfix program: ("const", value) pushes, every other op pops its operands"""
+    program: Tuple[Tuple[Any, ...], ...]
+    # Program with constants blanked out; expressions with equal shapes batch together
+    shape: Tuple[str, ...]
+    constants: Tuple[float, ...]
+    has_pow: bool
+
+def sanitize(expression: str) -> str:
+    return "".join(c for c in expression if c in ALLOWED_CHARACTERS).strip()
+
+def canonical_expression(expression: str) -> str:
+    """Sanitized expression with one space between tokens, so "2*(3+4)" and "2 * (3 + 4)" match
+
+    Spaces that separate tokens are kept, so "1 2" stays distinct from "12".
+    """
+    return " ".join(EXPRESSION_TOKEN.findall(sanitize(expression)))
+
+@lru_cache(maxsize=4096)
+def compile_expression(expression: str, max_steps: int = Limits.max_steps) -> CompiledExpression:
+    """Sanitize, parse and validate an expression into a postfix program"""
+    sanitized = sanitize(expression)
+    if not sanitized:
+        raise CalculationError("Empty expression")
+    if len(sanitized) > MAX_EXPRESSION_LENGTH:
+        raise CalculationError(f"Expression longer than {MAX_EXPRESSION_LENGTH} characters")
+    try:
+        tree = ast.parse(sanitized, mode="eval")
+    except (SyntaxError, RecursionError, ValueError) as e:
+        raise CalculationError(f"Invalid expression: {e}") from None
+
+    program: List[Tuple[Any, ...]] = []
+
+    def emit(node: ast.AST) -> None:
+        if len(program) > max_steps:
+            raise CalculationError(f"Expression exceeds {max_steps} steps")
+        if isinstance(node, ast.Constant) and type(node.value) in (int, float):
+            program.append(("const", node.value))
+        elif isinstance(node, ast.BinOp) and type(node.op) in BINARY_OPS:
+            emit(node.left)
+            emit(node.right)
+            program.append((BINARY_OPS[type(node.op)],))
+        elif isinstance(node, ast.UnaryOp) and type(node.op) in UNARY_OPS:
+            emit(node.operand)
+            program.append((UNARY_OPS[type(node.op)],))
+        else:
+            raise CalculationError(f"Unsupported syntax: {type(node).__name__}")
+
+    emit(tree.body)
+    if len(program) > max_steps:
+        raise CalculationError(f"Expression exceeds {max_steps} steps")
+    return CompiledExpression(
+        program=tuple(program),
+        shape=tuple(instruction[0] for instruction in program),
+        constants=tuple(instruction[1] for instruction in program if instruction[0] == "const"),
+        has_pow=any(instruction[0] == "pow" for instruction in program),
+    )
+
+def _check_magnitude(value: Any, limits: Limits) -> Any:
+    if isinstance(value, complex):
+        raise CalculationError("Result is not a real number")
+    if isinstance(value, float) and not math.isfinite(value):
+        raise CalculationError("Result is not finite")
+    if abs(value) > limits.max_magnitude:
+        raise CalculationError(f"Result exceeds {limits.max_magnitude:g}")
+    return value
+
+def _power(base: Any, exponent: Any, limits: Limits) -> Any:
+    # Reject before computing: 9**9**9 would otherwise allocate gigabytes
+    if abs(exponent) > limits.max_exponent:
+        raise CalculationError(f"Exponent exceeds {limits.max_exponent}")
+    if abs(base) > 1 and exponent > 0 and exponent * math.log10(abs(base)) > math.log10(limits.max_magnitude):
+        raise CalculationError(f"Result exceeds {limits.max_magnitude:g}")
+    return base ** exponent
+
+def evaluate_program(program: Tuple[Tuple[Any, ...], ...], limits: Limits = Limits()) -> Any:
+    """Run a postfix program, checking every intermediate result against the limits"""
+    stack: List[Any] = []
+    try:
+        for instruction in program:
+            op = instruction[0]
+            if op == "const":
+                stack.append(_check_magnitude(instruction[1], limits))
+            elif op == "neg":
+                stack.append(-stack.pop())
+            elif op == "pos":
+                continue
+            else:
+                right = stack.pop()
+                left = stack.pop()
+                if op == "pow":
+                    result = _power(left, right, limits)
+                else:
+                    result = OPERATIONS[op](left, right)
+                stack.append(_check_magnitude(result, limits))
+    except ZeroDivisionError:
+        raise CalculationError("division by zero") from None
+    except OverflowError:
+        raise CalculationError("Result is too large") from None
+    return stack[0]
+
+def evaluate_shape_batch(shape: Tuple[str, ...], constants: np.ndarray, integer: np.ndarray,
+                         limits: Limits) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """Evaluate one program shape over a (batch, n_constants) matrix of constants
+
+    integer marks the constants that are Python ints. Returns the float64
+    results, a mask of rows whose result equals what evaluate_program gives,
+    and a mask of rows whose result is an int there. A row is only valid if
+    every intermediate stays within the limits and every int-typed value,
+    which Python keeps exact, stays below 2**53 where float64 is exact too.
+    """
+    stack: List[Tuple[np.ndarray, np.ndarray]] = []
+    valid = np.ones(len(constants), dtype=bool)
+    column = 0
+
+    def check(values: np.ndarray, is_int: np.ndarray) -> None:
+        nonlocal valid
+        magnitude = np.abs(values)
+        valid &= np.isfinite(values) & (magnitude <= limits.max_magnitude) & ~(is_int & (magnitude >= 2 ** 53))
+
+    with np.errstate(divide="ignore", invalid="ignore", over="ignore"):
+        for op in shape:
+            if op == "const":
+                stack.append((constants[:, column], integer[:, column]))
+                column += 1
+                check(*stack[-1])
+            elif op == "neg":
+                values, is_int = stack.pop()
+                stack.append((-values, is_int))
+            elif op == "pos":
+                continue
+            else:
+                right, right_int = stack.pop()
+                left, left_int = stack.pop()
+                # True division gives a float even for two ints
+                is_int = left_int & right_int if op != "div" else np.zeros_like(left_int)
+                stack.append((OPERATIONS[op](left, right), is_int))
+                check(*stack[-1])
+    result, is_int = stack[0]
+    return result, valid, is_int
+
+def _evaluate_in_worker(program: Tuple[Tuple[Any, ...], ...], limits: Limits) -> Any:
+    return evaluate_program(program, limits)
+
+class Calculator:
+    """Safe calculator with compiled-expression and result memoization
+
+    Short programs without exponentiation are evaluated inline since they
+    are bounded by max_steps and cost microseconds; anything else runs in a
+    process pool that is torn down if it overruns the timeout.
+    """
+
+    def __init__(self, limits: Limits = Limits(), timeout: float = 1.0, max_workers: int = 2,
+                 inline_max_steps: int = 64, cache_size: int = 4096, vectorize_min_batch: int = 8):
+        self.limits = limits
+        self.timeout = timeout
+        self.max_workers = max_workers
+        self.inline_max_steps = inline_max_steps
+        self.vectorize_min_batch = vectorize_min_batch
+        self.results = LRUTTLCache(max_entries=cache_size, ttl_seconds=float("inf"))
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.max_workers)
+        return self._executor
+
+    def _reset_executor(self) -> None:
+        """Kill a pool whose worker is stuck so later calls get fresh processes"""
+        executor, self._executor = self._executor, None
+        if executor is None:
+            return
+        # ProcessPoolExecutor cannot cancel a running task, so stop its processes directly
+        for process in list(getattr(executor, "_processes", {}).values()):
+            process.terminate()
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def compile(self, expression: str) -> CompiledExpression:
+        return compile_expression(expression, self.limits.max_steps)
+
+    async def _evaluate(self, compiled: CompiledExpression) -> Any:
+        if not compiled.has_pow and len(compiled.program) <= self.inline_max_steps:
+            return evaluate_program(compiled.program, self.limits)
+        loop = asyncio.get_running_loop()
+        future = loop.run_in_executor(self._get_executor(), _evaluate_in_worker, compiled.program, self.limits)
+        try:
+            return await asyncio.wait_for(future, self.timeout)
+        except asyncio.TimeoutError:
+            self._reset_executor()
+            raise CalculationError(f"Calculation timed out after {self.timeout}s") from None
+        except BrokenProcessPool:
+            self._reset_executor()
+            raise CalculationError("Calculation worker crashed") from None
+
+    async def calculate(self, expression: str) -> Dict[str, Any]:
+        """Evaluate one expression into the calculate tool's result shape"""
+        try:
+            compiled = self.compile(expression)
+            result = self.results.get(expression)
+            if result is None:
+                result = await self._evaluate(compiled)
+                self.results.set(expression, result)
+            return {"expression": expression, "result": result, "success": True}
+        except CalculationError as e:
+            return {"expression": expression, "error": str(e), "success": False}
+
+    async def calculate_batch(self, expressions: List[str]) -> List[Dict[str, Any]]:
+        """Evaluate many expressions, vectorizing groups that share a program shape"""
+        outcomes: List[Optional[Dict[str, Any]]] = [None] * len(expressions)
+        groups: Dict[Tuple[str, ...], List[Tuple[int, CompiledExpression]]] = {}
+
+        for i, expression in enumerate(expressions):
+            try:
+                compiled = self.compile(expression)
+            except CalculationError as e:
+                outcomes[i] = {"expression": expression, "error": str(e), "success": False}
+                continue
+            if VECTORIZABLE.issuperset(compiled.shape):
+                groups.setdefault(compiled.shape, []).append((i, compiled))
+            else:
+                groups.setdefault(("scalar", i), []).append((i, compiled))
+
+        for shape, members in groups.items():
+            if shape[0] == "scalar" or len(members) < self.vectorize_min_batch:
+                for i, _ in members:
+                    outcomes[i] = await self.calculate(expressions[i])
+                continue
+
+            constants = np.array([compiled.constants for _, compiled in members], dtype=np.float64)
+            integer = np.array([[isinstance(c, int) for c in compiled.constants] for _, compiled in members], dtype=bool)
+            values, valid, is_int = evaluate_shape_batch(shape, constants, integer, self.limits)
+            for (i, compiled), value, ok, as_int in zip(members, values, valid, is_int):
+                if not ok:
+                    # Errors, and ints float64 cannot hold exactly, go through exact evaluation
+                    outcomes[i] = await self.calculate(expressions[i])
+                    continue
+                outcomes[i] = {"expression": expressions[i], "result": int(value) if as_int else float(value), "success": True}
+
+        return outcomes
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
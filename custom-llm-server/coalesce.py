@@ -0,0 +1,174 @@
+"""
+Request coalescing for the Custom LLM Server
+Concurrent identical requests share one upstream call; shared streams fan
+out to every attached client, replaying chunks a late joiner missed
+"""
+
+import asyncio
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, Optional, Tuple
+
+class SharedCall:
+    """One in-flight non-streaming call and the clients waiting on it"""
+
+    def __init__(self, task: "asyncio.Task"):
+        self.task = task
+        self.waiters = 0
+        self.joined = 0
+
+class SharedStream:
+    """One upstream stream buffered so any number of clients can follow it
+
+    The producer runs as its own task, so a client going away never cancels
+    it; only when the last attached client leaves is the producer cancelled.
+    """
+
+    def __init__(self, source: AsyncIterator[Any], on_finish: Callable[["SharedStream"], None], context: Any = None):
+        # Whatever the creating request wants followers to see, e.g. its chunk encoder
+        self.context = context
+        self.chunks: List[Any] = []
+        self.done = False
+        self.error: Optional[BaseException] = None
+        self.subscribers = 0
+        self.joined = 0
+        self._on_finish = on_finish
+        self._changed = asyncio.Event()
+        self._task = asyncio.ensure_future(self._pump(source))
+
+    def _notify(self) -> None:
+        # Wake current followers and arm a fresh event for the next chunk
+        changed, self._changed = self._changed, asyncio.Event()
+        changed.set()
+
+    async def _pump(self, source: AsyncIterator[Any]) -> None:
+        try:
+            async for chunk in source:
+                self.chunks.append(chunk)
+                self._notify()
+        except asyncio.CancelledError:
+            self.error = asyncio.CancelledError()
+            raise
+        except Exception as e:
+            self.error = e
+        finally:
+            self.done = True
+            self._notify()
+            self._on_finish(self)
+
+    def attach(self) -> "Subscription":
+        """Register a client and return its iterator over the stream from the start"""
+        self.subscribers += 1
+        self.joined += 1
+        return Subscription(self)
+
+    def _detach(self) -> None:
+        self.subscribers -= 1
+        if self.subscribers == 0 and not self.done:
+            # Unregister first so nobody joins a stream that is being torn down
+            self._on_finish(self)
+            self._task.cancel()
+
+    async def _follow(self) -> AsyncIterator[Any]:
+        position = 0
+        while True:
+            while position < len(self.chunks):
+                yield self.chunks[position]
+                position += 1
+            if self.done:
+                if self.error is not None:
+                    raise self.error
+                return
+            await self._changed.wait()
+
+class Subscription:
+    """A client's place in a SharedStream; release() is safe to call more than once
+
+    The client counts as attached from attach() until it has read the
+    stream to the end, closed it, or called release(). A generator's
+    finally block would only run once iteration had started, so a client
+    that left before its first read would keep the producer alive.
+    """
+
+    def __init__(self, shared: SharedStream):
+        self._shared = shared
+        self._events = shared._follow()
+        self.released = False
+
+    def __aiter__(self) -> "Subscription":
+        return self
+
+    async def __anext__(self) -> Any:
+        if self.released:
+            raise StopAsyncIteration
+        try:
+            return await self._events.__anext__()
+        except BaseException:
+            self.release()
+            raise
+
+    async def aclose(self) -> None:
+        self.release()
+        await self._events.aclose()
+
+    def release(self) -> None:
+        if not self.released:
+            self.released = True
+            self._shared._detach()
+
+class Coalescer:
+    """Single-flight registry keyed on the canonical request"""
+
+    def __init__(self):
+        self._calls: Dict[str, SharedCall] = {}
+        self._streams: Dict[str, SharedStream] = {}
+        self.upstream_calls = 0
+        self.coalesced = 0
+
+    async def call(self, key: str, factory: Callable[[], Awaitable[Any]]) -> Tuple[Any, int]:
+        """Run factory() once for all concurrent callers with the same key
+
+        Returns the shared result and the number of requests that received it.
+        """
+        entry = self._calls.get(key)
+        if entry is None:
+            entry = SharedCall(asyncio.ensure_future(factory()))
+            self._calls[key] = entry
+            entry.task.add_done_callback(lambda _: self._forget(self._calls, key, entry))
+            self.upstream_calls += 1
+        else:
+            self.coalesced += 1
+
+        entry.waiters += 1
+        entry.joined += 1
+        try:
+            # shield() keeps one caller's cancellation from reaching the shared task
+            result = await asyncio.shield(entry.task)
+            return result, entry.joined
+        finally:
+            entry.waiters -= 1
+            if entry.waiters == 0 and not entry.task.done():
+                self._forget(self._calls, key, entry)
+                entry.task.cancel()
+
+    def stream(self, key: str, factory: Callable[[], AsyncIterator[Any]], context: Any = None) -> SharedStream:
+        """Return the in-flight stream for key, starting one if there is none"""
+        shared = self._streams.get(key)
+        if shared is None:
+            shared = SharedStream(factory(), lambda s: self._forget(self._streams, key, s), context)
+            self._streams[key] = shared
+            self.upstream_calls += 1
+        else:
+            self.coalesced += 1
+        return shared
+
+    @staticmethod
+    def _forget(registry: Dict[str, Any], key: str, entry: Any) -> None:
+        if registry.get(key) is entry:
+            del registry[key]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "in_flight_calls": len(self._calls),
+            "in_flight_streams": len(self._streams),
+            "upstream_calls": self.upstream_calls,
+            "coalesced_requests": self.coalesced,
+        }
@@ -0,0 +1,12 @@
+"""
+Shared pytest setup
+server.py reads its configuration once at import, so every test module that
+imports it gets the same offline setup: a fast stub upstream and the caches on
+"""
+
+import os
+
+os.environ.setdefault("LLM_BACKEND", "stub")
+os.environ.setdefault("STUB_TTFT_SECONDS", "0")
+os.environ.setdefault("STUB_TOKENS_PER_SECOND", "10000")
+os.environ.setdefault("COMPLETION_CACHE_ENABLED", "true")
@@ -0,0 +1,297 @@
+"""
+Hedged and fallback upstream requests for the Custom LLM Server
+Fires a second request when the first token is late, keeps whichever answers
+first, and routes around backends whose circuit breaker has opened
+"""
+
+import asyncio
+import time
+from collections import deque
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+from metrics import HEDGED_REQUESTS, observe_stage
+from upstream import UpstreamClient, UpstreamError
+
+class CircuitBreaker:
+    """Opens after failure_threshold consecutive failures and probes again after reset_seconds
+
+    While open, the backend is skipped. Once reset_seconds have passed, a
+    single request is let through as a probe: success closes the breaker,
+    failure opens it for another reset_seconds.
+    """
+
+    def __init__(self, failure_threshold: int = 5, reset_seconds: float = 30.0):
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.state = "closed"
+        self.consecutive_failures = 0
+        self.opened_at = 0.0
+        self.probing = False
+        self.opened = 0
+
+    def available(self) -> bool:
+        """Whether a request may be sent now, without claiming the probe"""
+        if self.failure_threshold <= 0 or self.state == "closed":
+            return True
+        if self.probing:
+            return False
+        return time.monotonic() - self.opened_at >= self.reset_seconds
+
+    def on_attempt(self) -> None:
+        if self.state != "closed" and self.available():
+            self.state = "half_open"
+            self.probing = True
+
+    def record_success(self) -> None:
+        self.consecutive_failures = 0
+        self.state = "closed"
+        self.probing = False
+
+    def record_failure(self) -> None:
+        self.consecutive_failures += 1
+        self.probing = False
+        if self.failure_threshold > 0 and (self.state == "half_open" or self.consecutive_failures >= self.failure_threshold):
+            if self.state != "open":
+                self.opened += 1
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def record_abandoned(self) -> None:
+        """An attempt was cancelled before it succeeded or failed; a pending probe may be retried"""
+        self.probing = False
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "state": self.state,
+            "consecutive_failures": self.consecutive_failures,
+            "times_opened": self.opened,
+        }
+
+class LatencyWindow:
+    """Recent latencies of one route, for percentile-based hedge delays"""
+
+    def __init__(self, size: int = 500):
+        self._values: Deque[float] = deque(maxlen=size)
+
+    def record(self, seconds: float) -> None:
+        self._values.append(seconds)
+
+    def __len__(self) -> int:
+        return len(self._values)
+
+    def percentile(self, pct: float) -> Optional[float]:
+        if not self._values:
+            return None
+        ordered = sorted(self._values)
+        return ordered[min(len(ordered) - 1, int(pct / 100 * len(ordered)))]
+
+class Route:
+    """An upstream client, optionally with its own model name, and its health"""
+
+    def __init__(self, name: str, client: UpstreamClient, model: Optional[str] = None,
+                 breaker: Optional[CircuitBreaker] = None, window: int = 500):
+        self.name = name
+        self.client = client
+        self.model = model
+        self.breaker = breaker or CircuitBreaker(failure_threshold=0)
+        # Time to first token for streams; to the whole answer for non-streaming calls
+        self.ttft = LatencyWindow(window)
+        self.latency = LatencyWindow(window)
+        self.wins = 0
+
+    def params(self, params: Dict[str, Any]) -> Dict[str, Any]:
+        return {**params, "model": self.model} if self.model else params
+
+def has_token(chunk: Dict[str, Any]) -> bool:
+    """Whether a chunk carries content or tool calls, not just the role"""
+    for choice in chunk.get("choices") or ():
+        delta = choice.get("delta") or {}
+        if delta.get("content") or delta.get("tool_calls") or choice.get("finish_reason"):
+            return True
+    return False
+
+class HedgingUpstream:
+    """Drop-in for UpstreamClient that hedges slow calls and fails over between routes
+
+    The first available route gets the request. When hedging is on and no
+    first token has arrived after the route's hedge_percentile TTFT, the
+    next route (or the same one, when there is no other) gets a duplicate;
+    the first to produce a token wins and the other is cancelled. Hedges
+    are capped at max_hedge_ratio of requests, so a slow upstream does not
+    get its load doubled. A call that fails is retried at once on the next
+    route, and routes whose breaker is open are skipped.
+    """
+
+    def __init__(self, routes: List[Route], hedging: bool = True, hedge_percentile: float = 95,
+                 min_hedge_delay: float = 0.05, default_hedge_delay: float = 1.0,
+                 min_samples: int = 20, max_hedge_ratio: float = 0.1):
+        self.routes = routes
+        self.hedging = hedging
+        self.hedge_percentile = hedge_percentile
+        self.min_hedge_delay = min_hedge_delay
+        self.default_hedge_delay = default_hedge_delay
+        self.min_samples = min_samples
+        self.max_hedge_ratio = max_hedge_ratio
+        self.requests = 0
+        self.hedges = 0
+        self.hedge_wins = 0
+        self.failovers = 0
+        self.rejected = 0
+
+    def hedge_delay(self, window: LatencyWindow) -> float:
+        """How long to wait for the first route before hedging"""
+        if len(window) < self.min_samples:
+            return self.default_hedge_delay
+        return max(self.min_hedge_delay, window.percentile(self.hedge_percentile))
+
+    def _may_hedge(self) -> bool:
+        # One hedge is always allowed so the ratio can get started
+        return self.hedging and self.hedges < self.max_hedge_ratio * self.requests + 1
+
+    async def _race(self, kind: str, attempt: Callable[[Route], Awaitable[Any]],
+                    discard: Callable[[Any], Awaitable[None]]) -> Tuple[Route, Any]:
+        """Run attempt on routes until one succeeds, hedging when the first is slow"""
+        routes = [route for route in self.routes if route.breaker.available()]
+        if not routes:
+            self.rejected += 1
+            raise UpstreamError("All upstream backends are unavailable (circuit open)", status=503)
+        self.requests += 1
+        untried = list(routes)
+        # task -> (route, when it started, whether it is a hedge or failover)
+        pending: Dict["asyncio.Task", Tuple[Route, float, bool]] = {}
+
+        def launch(route: Route, backup: bool) -> None:
+            if route in untried:
+                untried.remove(route)
+            route.breaker.on_attempt()
+            pending[asyncio.ensure_future(attempt(route))] = (route, time.perf_counter(), backup)
+
+        first = routes[0]
+        window = first.ttft if kind == "stream" else first.latency
+        hedge_at = time.perf_counter() + self.hedge_delay(window)
+        launch(first, False)
+        hedged = False
+        last_error: Optional[BaseException] = None
+        try:
+            while pending:
+                timeout = None
+                if not hedged and self._may_hedge():
+                    timeout = max(0.0, hedge_at - time.perf_counter())
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    hedged = True
+                    self.hedges += 1
+                    HEDGED_REQUESTS.inc(1, "hedge")
+                    launch(untried[0] if untried else first, True)
+                    continue
+                for task in done:
+                    route, started, backup = pending.pop(task)
+                    try:
+                        result = task.result()
+                    except Exception as e:
+                        route.breaker.record_failure()
+                        last_error = e
+                        continue
+                    route.breaker.record_success()
+                    (route.ttft if kind == "stream" else route.latency).record(time.perf_counter() - started)
+                    route.wins += 1
+                    if backup and pending:
+                        self.hedge_wins += 1
+                        HEDGED_REQUESTS.inc(1, "hedge_won")
+                    return route, result
+                if not pending and untried:
+                    # Fail over to the next route at once instead of giving up
+                    self.failovers += 1
+                    HEDGED_REQUESTS.inc(1, "failover")
+                    hedged = True
+                    launch(untried[0], True)
+            raise last_error
+        finally:
+            for task, (route, _, _) in pending.items():
+                # Not recorded in the latency window: the elapsed time understates the
+                # real latency and would pull the hedge delay down
+                task.cancel()
+                route.breaker.record_abandoned()
+            for task in pending:
+                try:
+                    result = await task
+                except BaseException:
+                    continue
+                await discard(result)
+
+    async def complete(self, **params) -> Dict[str, Any]:
+        """Non-streaming completion from whichever route answers first"""
+        async def attempt(route: Route) -> Dict[str, Any]:
+            return await route.client.complete(**route.params(params))
+
+        async def discard(result: Any) -> None:
+            pass
+
+        _, result = await self._race("complete", attempt, discard)
+        return result
+
+    async def stream(self, **params) -> AsyncIterator[Dict[str, Any]]:
+        """Streaming completion from whichever route produces a token first
+
+        Chunks read before the first token, such as the role chunk, are
+        buffered and replayed from the winning stream only.
+        """
+        async def attempt(route: Route) -> Tuple[AsyncIterator[Dict[str, Any]], List[Dict[str, Any]]]:
+            stream = route.client.stream(**route.params(params))
+            buffered = []
+            try:
+                async for chunk in stream:
+                    buffered.append(chunk)
+                    if has_token(chunk):
+                        break
+            except BaseException:
+                await stream.aclose()
+                raise
+            return stream, buffered
+
+        async def discard(result: Any) -> None:
+            await result[0].aclose()
+
+        started = time.perf_counter()
+        route, (stream, buffered) = await self._race("stream", attempt, discard)
+        observe_stage("upstream_first_token", time.perf_counter() - started)
+        try:
+            for chunk in buffered:
+                yield chunk
+            async for chunk in stream:
+                yield chunk
+        except Exception:
+            route.breaker.record_failure()
+            raise
+        finally:
+            await stream.aclose()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "hedging": self.hedging,
+            "requests": self.requests,
+            "hedges": self.hedges,
+            "hedge_wins": self.hedge_wins,
+            "failovers": self.failovers,
+            "rejected_circuit_open": self.rejected,
+            "routes": [
+                {
+                    "name": route.name,
+                    "model": route.model,
+                    "wins": route.wins,
+                    "hedge_delay_ms": round(self.hedge_delay(route.ttft) * 1000, 1),
+                    "ttft_p50_ms": _ms(route.ttft.percentile(50)),
+                    "ttft_p95_ms": _ms(route.ttft.percentile(95)),
+                    "circuit": route.breaker.stats(),
+                    **route.client.stats(),
+                }
+                for route in self.routes
+            ],
+        }
+
+    async def aclose(self) -> None:
+        for route in self.routes:
+            await route.client.aclose()
+
+def _ms(seconds: Optional[float]) -> Optional[float]:
+    return round(seconds * 1000, 1) if seconds is not None else None
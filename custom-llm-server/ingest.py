@@ -0,0 +1,485 @@
+"""
+Incremental document ingestion
+Chunks, tokenizes and embeds documents in a worker pool, then applies them
+to the live BM25 and vector indexes in small slices, so searches keep
+running against the current indexes while a job is written. Applied
+changes are journaled so rebuilt indexes can replay them
+"""
+
+import asyncio
+import json
+import os
+import time
+import uuid
+from collections import OrderedDict, deque
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from dataclasses import asdict, dataclass, field, replace
+from typing import Any, AsyncIterator, Callable, Deque, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from retrieval import BM25Index, Document, Embedder, VectorIndex, document_terms, embedding_text
+
+@dataclass
+class PreparedChunk:
+    document: Document
+    term_counts: Dict[str, int]
+    length: int
+
+@dataclass
+class PreparedDocument:
+    doc_id: str
+    chunks: List[PreparedChunk]
+    # One row per chunk, or None when there is no vector index to update
+    vectors: Optional[np.ndarray]
+
+@dataclass
+class IngestJob:
+    job_id: str
+    action: str
+    documents: List[Document] = field(default_factory=list)
+    doc_ids: List[str] = field(default_factory=list)
+    status: str = "queued"
+    submitted: float = field(default_factory=time.time)
+    started: Optional[float] = None
+    finished: Optional[float] = None
+    chunks: int = 0
+    not_found: List[str] = field(default_factory=list)
+    error: Optional[str] = None
+
+    @property
+    def size(self) -> int:
+        return len(self.documents) or len(self.doc_ids)
+
+    def stats(self) -> Dict[str, Any]:
+        stats = {
+            "job_id": self.job_id,
+            "action": self.action,
+            "status": self.status,
+            "documents": self.size,
+            "chunks": self.chunks,
+        }
+        if self.started is not None and self.finished is not None:
+            elapsed = self.finished - self.started
+            stats["elapsed_seconds"] = round(elapsed, 3)
+            stats["docs_per_second"] = round(self.size / elapsed, 2) if elapsed else None
+        if self.not_found:
+            stats["not_found"] = self.not_found
+        if self.error:
+            stats["error"] = self.error
+        return stats
+
+def chunk_text(text: str, max_chars: int, overlap: int) -> List[str]:
+    """Split text into chunks of at most max_chars, preferring to break at whitespace
+
+    Consecutive chunks share about `overlap` characters so a passage cut in
+    two is still found whole in one of them.
+    """
+    text = text.strip()
+    if len(text) <= max_chars:
+        return [text]
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + max_chars, len(text))
+        if end < len(text):
+            space = text.rfind(" ", start + max_chars // 2, end)
+            if space > start:
+                end = space
+        chunk = text[start:end].strip()
+        if chunk:
+            chunks.append(chunk)
+        if end >= len(text):
+            break
+        start = max(end - overlap, start + 1)
+        if overlap:
+            # Start the overlap on a word boundary
+            space = text.find(" ", start, end)
+            if space != -1:
+                start = space + 1
+    return chunks
+
+def prepare_documents(documents: List[Document], max_chars: int, overlap: int,
+                      embedder: Optional[Embedder] = None) -> List[PreparedDocument]:
+    """Chunk, count terms and embed documents; runs in an ingestion worker
+
+    A document that needs more than one chunk is indexed as <id>#<n> chunks.
+    """
+    prepared = []
+    for document in documents:
+        texts = chunk_text(document.text, max_chars, overlap)
+        chunks = []
+        for n, text in enumerate(texts):
+            doc_id = document.doc_id if len(texts) == 1 else f"{document.doc_id}#{n}"
+            chunk = replace(document, doc_id=doc_id, text=text)
+            term_counts, length = document_terms(chunk)
+            chunks.append(PreparedChunk(chunk, term_counts, length))
+        vectors = None
+        if embedder is not None:
+            vectors = embedder.embed([embedding_text(chunk.document) for chunk in chunks])
+        prepared.append(PreparedDocument(document.doc_id, chunks, vectors))
+    return prepared
+
+def logical_id(doc_id: str) -> str:
+    """The id a document was ingested under; its chunks are indexed as <id>#<n>"""
+    base, separator, number = doc_id.rpartition("#")
+    return base if separator and number.isdigit() else doc_id
+
+def document_positions(index: BM25Index) -> Dict[str, List[int]]:
+    """Index positions of every live document's chunks, by logical document id"""
+    positions: Dict[str, List[int]] = {}
+    for position, document in enumerate(index.documents):
+        if position not in index.removed:
+            positions.setdefault(logical_id(document.doc_id), []).append(position)
+    return positions
+
+def remove_positions(index: BM25Index, vector_index: Optional[VectorIndex], positions: List[int]) -> None:
+    for position in positions:
+        if vector_index is not None:
+            vector_index.remove(position)
+        index.remove(position)
+
+def apply_upserts(index: BM25Index, vector_index: Optional[VectorIndex], positions: Dict[str, List[int]],
+                  prepared: List[PreparedDocument]) -> int:
+    """Add prepared documents, then remove the chunks they replace; returns the chunks added"""
+    if vector_index is not None and len(vector_index) != len(index):
+        raise RuntimeError("Keyword and vector indexes are out of step")
+    chunks = [chunk for document in prepared for chunk in document.chunks]
+    if vector_index is not None:
+        # Vectors first: hybrid search sizes its scores by the vector index
+        vectors = [document.vectors for document in prepared]
+        if any(v is None for v in vectors):
+            raise RuntimeError("Vector index appeared while the job was being prepared")
+        vector_index.add_vectors([chunk.document for chunk in chunks], np.vstack(vectors))
+    added = [index.add_terms(chunk.document, chunk.term_counts, chunk.length) for chunk in chunks]
+    start = 0
+    for document in prepared:
+        new_positions = added[start:start + len(document.chunks)]
+        start += len(document.chunks)
+        remove_positions(index, vector_index, positions.get(document.doc_id, []))
+        positions[document.doc_id] = new_positions
+    return len(chunks)
+
+def apply_deletes(index: BM25Index, vector_index: Optional[VectorIndex], positions: Dict[str, List[int]],
+                  doc_ids: List[str]) -> List[str]:
+    """Remove documents by id; returns the ids that were not indexed"""
+    not_found = []
+    for doc_id in doc_ids:
+        removed = positions.pop(doc_id, None)
+        if removed is None:
+            not_found.append(doc_id)
+            continue
+        remove_positions(index, vector_index, removed)
+    return not_found
+
+class IngestJournal:
+    """Every document change applied through ingestion, so rebuilt indexes can replay them
+
+    changes maps each changed document id to its latest version, or to None
+    once deleted, in order of the last change. With a path, changes are
+    also appended to a JSONL file there and read back on startup; a torn
+    final line is ignored.
+    """
+
+    def __init__(self, path: Optional[str] = None):
+        self.path = path
+        self.changes: "OrderedDict[str, Optional[Document]]" = OrderedDict()
+        self._file = None
+        if path:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            records = self._load()
+            if records > len(self.changes):
+                self.compact()
+
+    def _load(self) -> int:
+        records = 0
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                        documents = [Document(**d) for d in record.get("upsert", [])]
+                        deleted = list(record.get("delete", []))
+                    except (ValueError, TypeError):
+                        continue
+                    self._fold(documents, deleted)
+                    records += 1
+        except FileNotFoundError:
+            pass
+        return records
+
+    def _fold(self, documents: List[Document], deleted: List[str]) -> None:
+        for document in documents:
+            self.changes.pop(document.doc_id, None)
+            self.changes[document.doc_id] = document
+        for doc_id in deleted:
+            self.changes.pop(doc_id, None)
+            self.changes[doc_id] = None
+
+    def _write(self, record: Dict[str, Any]) -> None:
+        if not self.path:
+            return
+        if self._file is None:
+            self._file = open(self.path, "a", encoding="utf-8")
+        self._file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self._file.flush()
+
+    def record_upserts(self, documents: List[Document]) -> None:
+        self._fold(documents, [])
+        self._write({"upsert": [asdict(d) for d in documents]})
+
+    def record_deletes(self, doc_ids: List[str]) -> None:
+        self._fold([], doc_ids)
+        self._write({"delete": doc_ids})
+
+    @property
+    def documents(self) -> List[Document]:
+        """Ingested documents that are still live"""
+        return [document for document in self.changes.values() if document is not None]
+
+    @property
+    def deleted(self) -> List[str]:
+        return [doc_id for doc_id, document in self.changes.items() if document is None]
+
+    def compact(self) -> None:
+        """Rewrite the file with one record per document, dropping superseded versions"""
+        if not self.path:
+            return
+        self.close()
+        tmp_path = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for doc_id, document in self.changes.items():
+                record = {"upsert": [asdict(document)]} if document is not None else {"delete": [doc_id]}
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        os.replace(tmp_path, self.path)
+
+    def replay(self, index: BM25Index, vector_index: Optional[VectorIndex],
+               chunk_chars: int, chunk_overlap: int) -> int:
+        """Apply the journaled changes to freshly built indexes, in this thread; returns the changes applied"""
+        if not self.changes:
+            return 0
+        positions = document_positions(index)
+        embedder = vector_index.embedder if vector_index is not None else None
+        apply_upserts(index, vector_index, positions,
+                      prepare_documents(self.documents, chunk_chars, chunk_overlap, embedder))
+        apply_deletes(index, vector_index, positions, self.deleted)
+        return len(self.changes)
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+class Ingestor:
+    """Single-writer queue of ingestion jobs against the live knowledge indexes
+
+    Preparation runs in a thread or process pool. Applying a job happens on
+    the event loop, apply_batch documents at a time: each slice's new chunks
+    are added before the versions they replace are removed, and removal is
+    a tombstone, so a search never sees a half-written document or waits
+    for a job to finish.
+
+    get_indexes returns the current (BM25Index, VectorIndex or None) pair;
+    on_change is called after every job that changed them. Each applied
+    slice is recorded in journal.
+    """
+
+    def __init__(self, get_indexes: Callable[[], Tuple[BM25Index, Optional[VectorIndex]]],
+                 on_change: Callable[[], None], chunk_chars: int = 1000, chunk_overlap: int = 100,
+                 executor: str = "thread", workers: int = 2, apply_batch: int = 64,
+                 rate_window_seconds: float = 60, max_jobs: int = 1000,
+                 on_error: Optional[Callable[[Exception], None]] = None,
+                 journal: Optional[IngestJournal] = None):
+        if executor not in ("thread", "process"):
+            raise ValueError(f"Unknown ingestion executor: {executor}")
+        if not 0 <= chunk_overlap < chunk_chars // 2:
+            raise ValueError("chunk_overlap must be less than half of chunk_chars")
+        self.get_indexes = get_indexes
+        self.on_change = on_change
+        self.chunk_chars = chunk_chars
+        self.chunk_overlap = chunk_overlap
+        self.executor_kind = executor
+        self.workers = workers
+        self.apply_batch = apply_batch
+        self.rate_window_seconds = rate_window_seconds
+        self.max_jobs = max_jobs
+        self.on_error = on_error
+        self.journal = journal if journal is not None else IngestJournal()
+        self.jobs: "OrderedDict[str, IngestJob]" = OrderedDict()
+        self.documents_processed = 0
+        self.chunks_indexed = 0
+        self.documents_deleted = 0
+        self.jobs_failed = 0
+        # (finish time, documents) per applied slice, for the docs/s rate
+        self._applied: Deque[Tuple[float, int]] = deque()
+        self._queue: Optional[asyncio.Queue] = None
+        self._writer: Optional[asyncio.Task] = None
+        self._executor: Optional[Executor] = None
+        self._active: Optional[IngestJob] = None
+        # Held while a job is applied, and by exclusive() while the indexes are rebuilt
+        self._lock = asyncio.Lock()
+        # Logical document id -> index positions of its live chunks
+        self._positions: Dict[str, List[int]] = {}
+        self._positions_of: Optional[BM25Index] = None
+
+    def _get_executor(self) -> Executor:
+        if self._executor is None:
+            if self.executor_kind == "process":
+                self._executor = ProcessPoolExecutor(max_workers=self.workers)
+            else:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="ingest")
+        return self._executor
+
+    def _submit(self, job: IngestJob) -> IngestJob:
+        if self._queue is None:
+            self._queue = asyncio.Queue()
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.create_task(self._run())
+        self.jobs[job.job_id] = job
+        while len(self.jobs) > self.max_jobs:
+            oldest = next(iter(self.jobs.values()))
+            if oldest.finished is None:
+                break
+            self.jobs.popitem(last=False)
+        self._queue.put_nowait(job)
+        return job
+
+    def upsert(self, documents: List[Document]) -> IngestJob:
+        """Queue documents to add, replacing any indexed under the same ids"""
+        return self._submit(IngestJob(f"ingest-{uuid.uuid4().hex[:16]}", "upsert", documents=documents))
+
+    def delete(self, doc_ids: List[str]) -> IngestJob:
+        """Queue documents to remove by id"""
+        return self._submit(IngestJob(f"ingest-{uuid.uuid4().hex[:16]}", "delete", doc_ids=doc_ids))
+
+    def _positions_for(self, index: BM25Index) -> Dict[str, List[int]]:
+        """Positions by document id, rebuilt when the indexes were swapped by a reload"""
+        if index is not self._positions_of:
+            self._positions, self._positions_of = document_positions(index), index
+        return self._positions
+
+    def _apply_upserts(self, prepared: List[PreparedDocument]) -> int:
+        index, vector_index = self.get_indexes()
+        return apply_upserts(index, vector_index, self._positions_for(index), prepared)
+
+    def _apply_deletes(self, doc_ids: List[str]) -> List[str]:
+        index, vector_index = self.get_indexes()
+        return apply_deletes(index, vector_index, self._positions_for(index), doc_ids)
+
+    @asynccontextmanager
+    async def exclusive(self) -> AsyncIterator[None]:
+        """Hold off jobs, e.g. while the indexes are rebuilt from the journal and swapped"""
+        async with self._lock:
+            yield
+
+    def _record_applied(self, documents: int) -> None:
+        now = time.monotonic()
+        self._applied.append((now, documents))
+        while self._applied and self._applied[0][0] < now - self.rate_window_seconds:
+            self._applied.popleft()
+
+    async def _run_job(self, job: IngestJob) -> None:
+        loop = asyncio.get_running_loop()
+        if job.action == "delete":
+            for start in range(0, len(job.doc_ids), self.apply_batch):
+                batch = job.doc_ids[start:start + self.apply_batch]
+                not_found = self._apply_deletes(batch)
+                self.journal.record_deletes([doc_id for doc_id in batch if doc_id not in not_found])
+                job.not_found.extend(not_found)
+                self.documents_deleted += len(batch) - len(not_found)
+                self._record_applied(len(batch))
+                await asyncio.sleep(0)
+            return
+
+        job.status = "running"
+        _, vector_index = self.get_indexes()
+        embedder = vector_index.embedder if vector_index is not None else None
+        slices = [job.documents[start:start + self.apply_batch]
+                  for start in range(0, len(job.documents), self.apply_batch)]
+        # Keep every worker busy preparing upcoming slices while earlier ones are applied in order
+        pending: Deque[Tuple[List[Document], asyncio.Future]] = deque()
+        try:
+            for documents in slices:
+                pending.append((documents, loop.run_in_executor(
+                    self._get_executor(), prepare_documents, documents, self.chunk_chars, self.chunk_overlap, embedder)))
+                if len(pending) < self.workers:
+                    continue
+                documents, future = pending.popleft()
+                self._apply_prepared(job, documents, await future)
+                # Let requests waiting on the event loop run between slices
+                await asyncio.sleep(0)
+            while pending:
+                documents, future = pending.popleft()
+                self._apply_prepared(job, documents, await future)
+                await asyncio.sleep(0)
+        finally:
+            for _, future in pending:
+                future.cancel()
+
+    def _apply_prepared(self, job: IngestJob, documents: List[Document], prepared: List[PreparedDocument]) -> None:
+        chunks = self._apply_upserts(prepared)
+        self.journal.record_upserts(documents)
+        job.chunks += chunks
+        self.chunks_indexed += chunks
+        self.documents_processed += len(prepared)
+        self._record_applied(len(prepared))
+
+    async def _run(self) -> None:
+        while True:
+            job = await self._queue.get()
+            async with self._lock:
+                self._active = job
+                job.started = time.time()
+                try:
+                    await self._run_job(job)
+                    job.status = "done"
+                except Exception as e:
+                    job.status = "failed"
+                    job.error = f"{type(e).__name__}: {e}"
+                    self.jobs_failed += 1
+                    if self.on_error is not None:
+                        self.on_error(e)
+                finally:
+                    job.finished = time.time()
+                    self._active = None
+                if job.chunks or len(job.not_found) < len(job.doc_ids):
+                    self.on_change()
+
+    @property
+    def queue_depth(self) -> int:
+        """Jobs waiting, including the one being written"""
+        queued = self._queue.qsize() if self._queue is not None else 0
+        return queued + (1 if self._active is not None else 0)
+
+    def stats(self) -> Dict[str, Any]:
+        now = time.monotonic()
+        recent = sum(documents for finished, documents in self._applied if finished >= now - self.rate_window_seconds)
+        index, _ = self.get_indexes()
+        return {
+            "queue_depth": self.queue_depth,
+            "documents_pending": sum(job.size for job in self.jobs.values() if job.finished is None),
+            "active_job": self._active.stats() if self._active is not None else None,
+            "docs_per_second": round(recent / self.rate_window_seconds, 2),
+            "rate_window_seconds": self.rate_window_seconds,
+            "documents_processed": self.documents_processed,
+            "documents_deleted": self.documents_deleted,
+            "chunks_indexed": self.chunks_indexed,
+            "jobs_failed": self.jobs_failed,
+            "index_documents": index.live_documents,
+            "index_tombstones": len(index.removed),
+            "journaled_documents": len(self.journal.changes),
+            "journal_path": self.journal.path,
+            "executor": self.executor_kind,
+            "workers": self.workers,
+        }
+
+    def shutdown(self) -> None:
+        self.journal.close()
+        if self._writer is not None:
+            self._writer.cancel()
+            self._writer = None
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,355 @@
+"""
+Location table for the get_weather tool
+Columnar city records bulk-loaded from CSV, with exact, prefix and
+trigram indexes for typo-tolerant "City" / "City, Country" lookups
+"""
+
+import bisect
+import csv
+import re
+import unicodedata
+from array import array
+from dataclasses import dataclass
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+NON_ALNUM = re.compile(r"[^a-z0-9]+")
+
+# Common spellings of country names; codes from the table itself are always accepted
+COUNTRY_ALIASES = {
+    "usa": "US", "united states": "US", "united states of america": "US", "america": "US",
+    "uk": "GB", "united kingdom": "GB", "great britain": "GB", "england": "GB", "britain": "GB",
+    "japan": "JP", "france": "FR", "germany": "DE", "spain": "ES", "italy": "IT",
+    "canada": "CA", "mexico": "MX", "brazil": "BR", "india": "IN", "china": "CN",
+    "australia": "AU", "netherlands": "NL", "south korea": "KR", "korea": "KR",
+}
+
+def normalize_name(text: str) -> str:
+    """Fold accents and case, and collapse punctuation and underscores to single spaces"""
+    if text.isascii():
+        return NON_ALNUM.sub(" ", text.lower()).strip()
+    folded = unicodedata.normalize("NFKD", text)
+    folded = "".join(c for c in folded if not unicodedata.combining(c))
+    return NON_ALNUM.sub(" ", folded.lower()).strip()
+
+def trigrams(key: str) -> List[str]:
+    padded = f"  {key} "
+    return list({padded[i:i + 3] for i in range(len(padded) - 2)})
+
+def edit_distance(a: str, b: str, limit: int) -> int:
+    """Optimal string alignment distance, giving up once it exceeds limit"""
+    if abs(len(a) - len(b)) > limit:
+        return limit + 1
+    previous2: List[int] = []
+    previous = list(range(len(b) + 1))
+    for i in range(1, len(a) + 1):
+        current = [i] + [0] * len(b)
+        for j in range(1, len(b) + 1):
+            cost = 0 if a[i - 1] == b[j - 1] else 1
+            current[j] = min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + cost)
+            if i > 1 and j > 1 and a[i - 1] == b[j - 2] and a[i - 2] == b[j - 1]:
+                current[j] = min(current[j], previous2[j - 2] + 1)
+        if min(current) > limit:
+            return limit + 1
+        previous2, previous = previous, current
+    return previous[-1]
+
+def typo_budget(key: str) -> int:
+    if len(key) < 4:
+        return 0
+    return 1 if len(key) < 8 else 2
+
+@dataclass
+class LocationMatch:
+    """Outcome of one lookup: the matched row, if any, and suggestions otherwise"""
+    query: str
+    row: Optional[int]
+    matched_by: Optional[str] = None
+    suggestions: Tuple[int, ...] = ()
+
+class LocationTableBuilder:
+    """Accumulates rows in flat arrays, then freezes them into a LocationTable"""
+
+    def __init__(self):
+        self._name_parts: List[str] = []
+        self._name_offsets = array("q", [0])
+        self._countries = array("H")
+        self._conditions = array("H")
+        self._temps = array("f")
+        self._humidity = array("B")
+        self._population = array("Q")
+        self._aliases: Dict[int, Tuple[str, ...]] = {}
+        self._country_codes: Dict[str, int] = {}
+        self._condition_names: Dict[str, int] = {}
+
+    def __len__(self) -> int:
+        return len(self._countries)
+
+    @staticmethod
+    def _category(categories: Dict[str, int], value: str) -> int:
+        if value not in categories:
+            categories[value] = len(categories)
+        return categories[value]
+
+    def add(self, name: str, country: str, temp: float, condition: str, humidity: int,
+            population: int = 0, aliases: Iterable[str] = ()) -> int:
+        row = len(self)
+        self._name_parts.append(name)
+        self._name_offsets.append(self._name_offsets[-1] + len(name))
+        self._countries.append(self._category(self._country_codes, country.upper()))
+        self._conditions.append(self._category(self._condition_names, condition))
+        self._temps.append(temp)
+        self._humidity.append(humidity)
+        self._population.append(population)
+        aliases = tuple(alias for alias in aliases if alias)
+        if aliases:
+            self._aliases[row] = aliases
+        return row
+
+    def add_csv(self, path: str) -> int:
+        """Load rows from a CSV with columns name, country, temp, condition, humidity
+        and optional population and aliases (separated by "|")"""
+        added = 0
+        with open(path, newline="", encoding="utf-8") as f:
+            reader = csv.reader(f)
+            columns = {column: i for i, column in enumerate(next(reader))}
+            name, country, temp = columns["name"], columns.get("country"), columns["temp"]
+            condition, humidity = columns["condition"], columns["humidity"]
+            population, aliases = columns.get("population"), columns.get("aliases")
+            for record in reader:
+                self.add(
+                    record[name],
+                    record[country] if country is not None else "",
+                    float(record[temp]),
+                    record[condition],
+                    int(record[humidity]),
+                    int(record[population] or 0) if population is not None else 0,
+                    record[aliases].split("|") if aliases is not None and record[aliases] else (),
+                )
+                added += 1
+        return added
+
+    def build(self) -> "LocationTable":
+        return LocationTable(
+            names="".join(self._name_parts),
+            name_offsets=np.frombuffer(self._name_offsets, dtype=np.int64).copy(),
+            countries=np.frombuffer(self._countries, dtype=np.uint16).copy(),
+            country_codes=list(self._country_codes),
+            conditions=np.frombuffer(self._conditions, dtype=np.uint16).copy(),
+            condition_names=list(self._condition_names),
+            temps=np.frombuffer(self._temps, dtype=np.float32).copy(),
+            humidity=np.frombuffer(self._humidity, dtype=np.uint8).copy(),
+            population=np.frombuffer(self._population, dtype=np.uint64).copy(),
+            aliases=self._aliases,
+        )
+
+class LocationTable:
+    """Read-only city table stored column by column
+
+    Names live in one string sliced by an offsets array, and countries and
+    conditions are small integer codes, so a row costs a few dozen bytes
+    instead of a dict per city. Names and aliases are indexed as normalized
+    keys three ways: a dict for exact hits, a sorted key list for prefixes
+    and a CSR trigram index for typos.
+    """
+
+    def __init__(self, names: str, name_offsets: np.ndarray, countries: np.ndarray,
+                 country_codes: List[str], conditions: np.ndarray, condition_names: List[str],
+                 temps: np.ndarray, humidity: np.ndarray, population: np.ndarray,
+                 aliases: Dict[int, Tuple[str, ...]]):
+        self._names = names
+        self._name_offsets = name_offsets
+        self.countries = countries
+        self.country_codes = country_codes
+        self.conditions = conditions
+        self.condition_names = condition_names
+        self.temps = temps
+        self.humidity = humidity
+        self.population = population
+        self._country_lookup = {code.lower(): i for i, code in enumerate(country_codes) if code}
+        for alias, code in COUNTRY_ALIASES.items():
+            if code in country_codes:
+                self._country_lookup.setdefault(alias, country_codes.index(code))
+        self._build_indexes(aliases)
+
+    def __len__(self) -> int:
+        return len(self.countries)
+
+    def name(self, row: int) -> str:
+        return self._names[self._name_offsets[row]:self._name_offsets[row + 1]]
+
+    def display_name(self, row: int) -> str:
+        country = self.country_codes[self.countries[row]]
+        return f"{self.name(row)}, {country}" if country else self.name(row)
+
+    def record(self, row: int) -> Dict[str, Any]:
+        return {
+            "name": self.name(row),
+            "country": self.country_codes[self.countries[row]],
+            "temp": float(self.temps[row]),
+            "condition": self.condition_names[self.conditions[row]],
+            "humidity": int(self.humidity[row]),
+        }
+
+    def _build_indexes(self, aliases: Dict[int, Tuple[str, ...]]) -> None:
+        key_rows: Dict[str, List[int]] = {}
+        offsets = self._name_offsets.tolist()
+        for row in range(len(self)):
+            labels = (self._names[offsets[row]:offsets[row + 1]],) + aliases.get(row, ())
+            for label in labels:
+                key = normalize_name(label)
+                if key:
+                    rows = key_rows.setdefault(key, [])
+                    # A name and its alias may normalize to the same key
+                    if not rows or rows[-1] != row:
+                        rows.append(row)
+
+        # Keys are stored sorted so a prefix is a contiguous slice
+        self.keys = sorted(key_rows)
+        self.key_ids = {key: i for i, key in enumerate(self.keys)}
+        counts = np.fromiter((len(key_rows[key]) for key in self.keys), dtype=np.int64, count=len(self.keys))
+        self.key_row_offsets = np.concatenate(([0], np.cumsum(counts)))
+        self.key_rows = np.fromiter((row for key in self.keys for row in key_rows[key]), dtype=np.int64,
+                                    count=int(self.key_row_offsets[-1]))
+        self.key_population = np.maximum.reduceat(self.population[self.key_rows], self.key_row_offsets[:-1]) \
+            if self.keys else np.zeros(0, dtype=np.uint64)
+
+        gram_ids: Dict[str, int] = {}
+        pair_grams = array("q")
+        pair_keys = array("q")
+        for key_id, key in enumerate(self.keys):
+            for gram in trigrams(key):
+                pair_grams.append(gram_ids.setdefault(gram, len(gram_ids)))
+                pair_keys.append(key_id)
+        grams = np.frombuffer(pair_grams, dtype=np.int64) if pair_grams else np.zeros(0, dtype=np.int64)
+        order = np.argsort(grams, kind="stable")
+        self.gram_ids = gram_ids
+        self.gram_postings = np.frombuffer(pair_keys, dtype=np.int64)[order].astype(np.int32) \
+            if pair_keys else np.zeros(0, dtype=np.int32)
+        self.gram_offsets = np.concatenate(([0], np.cumsum(np.bincount(grams, minlength=len(gram_ids)))))
+        self.key_gram_counts = np.bincount(self.gram_postings, minlength=len(self.keys))
+
+    def _rows_for_key(self, key_id: int) -> np.ndarray:
+        return self.key_rows[self.key_row_offsets[key_id]:self.key_row_offsets[key_id + 1]]
+
+    def _best_row(self, rows: np.ndarray, country: Optional[int]) -> Optional[int]:
+        if country is not None:
+            rows = rows[self.countries[rows] == country]
+        if not len(rows):
+            return None
+        return int(rows[np.argmax(self.population[rows])])
+
+    def _prefix_key_ids(self, key: str) -> range:
+        start = bisect.bisect_left(self.keys, key)
+        end = bisect.bisect_left(self.keys, key + "\uffff", lo=start)
+        return range(start, end)
+
+    def _trigram_candidates(self, key: str, limit: int) -> np.ndarray:
+        """Keys sharing the most trigrams with the query, best Dice coefficient first"""
+        query_grams = [self.gram_ids[gram] for gram in trigrams(key) if gram in self.gram_ids]
+        if not query_grams:
+            return np.zeros(0, dtype=np.int64)
+        postings = np.concatenate([
+            self.gram_postings[self.gram_offsets[gram]:self.gram_offsets[gram + 1]] for gram in query_grams
+        ])
+        key_ids, shared = np.unique(postings, return_counts=True)
+        dice = 2 * shared / (len(trigrams(key)) + self.key_gram_counts[key_ids])
+        if len(key_ids) > limit:
+            top = np.argpartition(-dice, limit)[:limit]
+            key_ids, dice = key_ids[top], dice[top]
+        return key_ids[np.argsort(-dice, kind="stable")]
+
+    def _resolve_country(self, text: str) -> Optional[int]:
+        return self._country_lookup.get(normalize_name(text))
+
+    def _match_key(self, key: str, country: Optional[int], candidates: int) -> Tuple[Optional[int], Optional[str], List[int]]:
+        """Exact, then prefix, then typo-tolerant match for one normalized key"""
+        key_id = self.key_ids.get(key)
+        if key_id is not None:
+            row = self._best_row(self._rows_for_key(key_id), country)
+            if row is not None:
+                return row, "exact", []
+
+        if len(key) >= 4:
+            prefix_ids = self._prefix_key_ids(key)
+            if len(prefix_ids):
+                ordered = prefix_ids.start + np.argsort(-self.key_population[prefix_ids.start:prefix_ids.stop], kind="stable")
+                for prefix_id in ordered[:candidates]:
+                    row = self._best_row(self._rows_for_key(int(prefix_id)), country)
+                    if row is not None:
+                        return row, "prefix", []
+
+        budget = typo_budget(key)
+        scored = []
+        for candidate in self._trigram_candidates(key, candidates):
+            distance = edit_distance(key, self.keys[candidate], max(budget, 3))
+            scored.append((distance, -int(self.key_population[candidate]), int(candidate)))
+        scored.sort()
+        for distance, _, candidate in scored:
+            if distance > budget:
+                break
+            row = self._best_row(self._rows_for_key(candidate), country)
+            if row is not None:
+                return row, "fuzzy", []
+        return None, None, [candidate for _, _, candidate in scored]
+
+    def lookup(self, query: str, suggestions: int = 5, candidates: int = 32) -> LocationMatch:
+        """Resolve a free-form location such as "tokyo", "Lodnon" or "Paris, France"
+
+        A trailing ", Country" narrows the match when it names a known country;
+        otherwise it is ignored. Misses carry up to `suggestions` close rows.
+        """
+        attempts: List[Tuple[str, Optional[int]]] = []
+        if "," in query:
+            city, _, qualifier = query.rpartition(",")
+            country = self._resolve_country(qualifier)
+            if country is not None:
+                attempts.append((normalize_name(city), country))
+            attempts.append((normalize_name(query), None))
+            attempts.append((normalize_name(city), None))
+        else:
+            attempts.append((normalize_name(query), None))
+
+        suggestion_keys: List[int] = []
+        for key, country in attempts:
+            if not key:
+                continue
+            row, matched_by, near = self._match_key(key, country, candidates)
+            if row is not None:
+                return LocationMatch(query, row, matched_by)
+            suggestion_keys.extend(k for k in near if k not in suggestion_keys)
+
+        rows: List[int] = []
+        for key_id in suggestion_keys:
+            row = self._best_row(self._rows_for_key(key_id), None)
+            if row is not None and row not in rows:
+                rows.append(row)
+            if len(rows) == suggestions:
+                break
+        return LocationMatch(query, None, suggestions=tuple(rows))
+
+    def lookup_many(self, queries: Sequence[str], suggestions: int = 5) -> List[LocationMatch]:
+        """Resolve many locations, looking each distinct query up once"""
+        resolved: Dict[str, LocationMatch] = {}
+        for query in queries:
+            if query not in resolved:
+                resolved[query] = self.lookup(query, suggestions)
+        return [resolved[query] for query in queries]
+
+def build_location_table(seed: Dict[str, Dict[str, Any]], csv_path: Optional[str] = None) -> LocationTable:
+    """Build the table from the built-in weather entries plus an optional CSV"""
+    builder = LocationTableBuilder()
+    for key, entry in seed.items():
+        builder.add(
+            entry.get("name") or key.replace("_", " ").title(),
+            entry.get("country", ""),
+            entry["temp"],
+            entry["condition"],
+            entry["humidity"],
+            entry.get("population", 0),
+            entry.get("aliases", ()),
+        )
+    if csv_path:
+        builder.add_csv(csv_path)
+    return builder.build()
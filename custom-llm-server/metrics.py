@@ -0,0 +1,173 @@
+"""
+Metrics for the Custom LLM Server
+Dependency-free counters and histograms rendered in the Prometheus text
+format, plus per-request stage timings for the Server-Timing header
+"""
+
+import bisect
+import time
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# Seconds; covers sub-millisecond RAG lookups up to long streams
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class Counter:
+    """Monotonic counter, optionally split by labels"""
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, *labelvalues: str) -> None:
+        self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def render(self) -> List[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, labels)} {_format_value(value)}"
+            for labels, value in sorted(self._values.items())
+        ]
+
+class Gauge(Counter):
+    """Value that can go up and down"""
+    kind = "gauge"
+
+    def set(self, value: float, *labelvalues: str) -> None:
+        self._values[labelvalues] = value
+
+    def dec(self, amount: float = 1, *labelvalues: str) -> None:
+        self.inc(-amount, *labelvalues)
+
+class Histogram:
+    """Cumulative-bucket histogram; observe() is a bisect and two additions"""
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [per-bucket counts (+Inf last), sum, count]
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *labelvalues: str) -> None:
+        series = self._series.get(labelvalues)
+        if series is None:
+            series = self._series[labelvalues] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self) -> List[str]:
+        lines = []
+        for labels, (counts, total, count) in sorted(self._series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = f'le="{_format_value(bound)}"'
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, labels)} {_format_value(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, labels)} {count}")
+        return lines
+
+class Registry:
+    """Holds metrics and renders them for the /metrics endpoint"""
+
+    def __init__(self):
+        self._metrics: list = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, labelnames))
+
+    def gauge(self, name: str, documentation: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, labelnames))
+
+    def histogram(self, name: str, documentation: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+REGISTRY = Registry()
+
+REQUESTS = REGISTRY.counter("llm_requests_total", "Chat completion requests", ["mode"])
+ERRORS = REGISTRY.counter("llm_errors_total", "Errors by type", ["type"])
+STAGE_SECONDS = REGISTRY.histogram("llm_stage_seconds", "Time spent in each request stage", ["stage"])
+TOOL_SECONDS = REGISTRY.histogram("llm_tool_execution_seconds", "Tool execution time", ["tool"])
+STREAM_TOKENS = REGISTRY.counter("llm_stream_tokens_total", "Content chunks streamed to clients")
+UPSTREAM_IN_FLIGHT = REGISTRY.gauge("llm_upstream_in_flight", "Upstream requests currently in flight")
+LOOP_LAG_SECONDS = REGISTRY.histogram("llm_event_loop_lag_seconds", "How late the event loop woke a sleeping coroutine")
+LOOP_STALLS = REGISTRY.counter("llm_event_loop_stalls_total", "Event loop stalls longer than the stall threshold")
+ADMISSION_QUEUE_DEPTH = REGISTRY.gauge("llm_admission_queue_depth", "Requests waiting for admission", ["priority"])
+ADMISSION_WAIT_SECONDS = REGISTRY.histogram("llm_admission_wait_seconds", "Time admitted requests spent queued", ["priority"])
+ADMISSION_REJECTED = REGISTRY.counter("llm_admission_rejected_total", "Requests turned away by admission control", ["reason"])
+HEDGED_REQUESTS = REGISTRY.counter("llm_upstream_hedges_total", "Hedged and failed-over upstream calls", ["event"])
+PREPARATION_STEPS = REGISTRY.counter("llm_preparation_steps_total", "Request preparation steps by where they ran", ["step", "executor"])
+
+# Stage timings of the request being handled, for the Server-Timing header
+_request_timings: ContextVar[Optional[Dict[str, float]]] = ContextVar("request_timings", default=None)
+
+def start_request_timings() -> Dict[str, float]:
+    """Begin collecting stage timings for the current request"""
+    timings: Dict[str, float] = {}
+    _request_timings.set(timings)
+    return timings
+
+def current_request_timings() -> Optional[Dict[str, float]]:
+    return _request_timings.get()
+
+def observe_stage(stage: str, seconds: float) -> None:
+    """Record a stage duration in the histogram and in the current request's timings"""
+    STAGE_SECONDS.observe(seconds, stage)
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[stage] = timings.get(stage, 0.0) + seconds
+
+def record_error(error_type: str) -> None:
+    ERRORS.inc(1, error_type)
+
+def server_timing_header(timings: Dict[str, float]) -> str:
+    """Render timings as a Server-Timing header value, durations in milliseconds"""
+    return ", ".join(f"{stage};dur={seconds * 1000:.2f}" for stage, seconds in timings.items())
+
+class StageTimer:
+    """Context manager that records the enclosed block as a stage"""
+    __slots__ = ("stage", "started")
+
+    def __init__(self, stage: str):
+        self.stage = stage
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        observe_stage(self.stage, time.perf_counter() - self.started)
+        return False
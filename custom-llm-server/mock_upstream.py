@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+"""
+Mock OpenAI upstream for offline load testing
+Serves /v1/chat/completions with configurable time-to-first-token,
+tokens per second and error rate, so the real network path is exercised
+without an API key. Given a recorded trace, it instead answers with the
+recorded responses at their recorded chunk timing.
+
+Point the server at it with:
+    OPENAI_API_KEY=mock OPENAI_API_BASE=http://localhost:8002/v1 python start_server.py
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+from collections import deque
+from typing import Any, Deque, Dict, List, Optional
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+MOCK_TTFT_SECONDS = float(os.getenv("MOCK_TTFT_SECONDS", "0.2"))
+MOCK_TOKENS_PER_SECOND = float(os.getenv("MOCK_TOKENS_PER_SECOND", "50"))
+MOCK_RESPONSE_TOKENS = int(os.getenv("MOCK_RESPONSE_TOKENS", "60"))
+MOCK_ERROR_RATE = float(os.getenv("MOCK_ERROR_RATE", "0"))
+# Fraction of requests whose first token takes MOCK_SLOW_TTFT_SECONDS instead, for tail-latency tests
+MOCK_SLOW_RATE = float(os.getenv("MOCK_SLOW_RATE", "0"))
+MOCK_SLOW_TTFT_SECONDS = float(os.getenv("MOCK_SLOW_TTFT_SECONDS", "3"))
+# Trace recorded with TRACE_RECORD_PATH to answer from, and how much faster than recorded to play it
+MOCK_TRACE_PATH = os.getenv("MOCK_TRACE_PATH")
+MOCK_TRACE_SPEED = float(os.getenv("MOCK_TRACE_SPEED", "1"))
+
+WORDS = (
+    "our support team is available around the clock and orders over fifty dollars ship free "
+    "within three to five business days with a thirty day money back guarantee"
+).split()
+
+app = FastAPI(title="Mock OpenAI Upstream")
+
+# Recorded upstream calls by call key; calls sharing a key are served in turn
+TRACE_CALLS: Dict[str, Deque[Dict[str, Any]]] = {}
+TRACE_STATS = {"recorded_calls": 0, "replayed": 0, "unmatched": 0}
+
+def load_trace(path: str) -> None:
+    from recording import read_trace
+    _, records = read_trace(path)
+    for record in records:
+        for call in record["calls"]:
+            TRACE_CALLS.setdefault(call["key"], deque()).append(call)
+            TRACE_STATS["recorded_calls"] += 1
+
+def next_recorded_call(messages: List[Dict[str, Any]]) -> Optional[Dict[str, Any]]:
+    from recording import call_key
+    calls = TRACE_CALLS.get(call_key(messages))
+    if not calls:
+        TRACE_STATS["unmatched"] += 1
+        return None
+    call = calls[0]
+    calls.rotate(-1)
+    TRACE_STATS["replayed"] += 1
+    return call
+
+def recorded_message(call: Dict[str, Any]) -> Dict[str, Any]:
+    """The assistant message of a recorded call, assembled from its chunks if it was streamed"""
+    if "chunks" not in call:
+        return call.get("message") or {"role": "assistant", "content": ""}
+    from streaming import ToolCallAccumulator
+    content = []
+    tool_calls = ToolCallAccumulator()
+    for _, delta, _ in call["chunks"]:
+        if delta.get("content"):
+            content.append(delta["content"])
+        if delta.get("tool_calls"):
+            tool_calls.add(delta["tool_calls"])
+    message = {"role": "assistant", "content": "".join(content) or None}
+    if tool_calls:
+        message["tool_calls"] = tool_calls.ordered()
+    return message
+
+def recorded_finish_reason(call: Dict[str, Any]) -> str:
+    for _, _, finish_reason in reversed(call.get("chunks") or []):
+        if finish_reason:
+            return finish_reason
+    return call.get("finish_reason") or "stop"
+
+async def replay_call(call: Dict[str, Any], stream: bool, model: str, completion_id: str, created: int):
+    """Answer with a recorded call, at its recorded timing divided by MOCK_TRACE_SPEED
+
+    A call recorded streaming can be replayed to a non-streaming request
+    and the other way round; the response then arrives at the time the
+    recorded one finished.
+    """
+    chunks = call.get("chunks")
+    duration = (chunks[-1][0] if chunks else call.get("latency_ms", 0)) / 1000 / MOCK_TRACE_SPEED
+    if call.get("error") and not chunks:
+        await asyncio.sleep(duration)
+        return JSONResponse(
+            status_code=call["error"],
+            content={"error": {"message": "Recorded upstream failure", "type": "server_error"}}
+        )
+
+    if not stream:
+        await asyncio.sleep(duration)
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "message": recorded_message(call), "finish_reason": recorded_finish_reason(call)}],
+            "usage": call.get("usage") or {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0}
+        }
+
+    if not chunks:
+        chunks = [[call.get("latency_ms", 0), recorded_message(call), recorded_finish_reason(call)]]
+
+    async def replay():
+        loop = asyncio.get_running_loop()
+        started = loop.time()
+        for offset_ms, delta, finish_reason in chunks:
+            delay = started + offset_ms / 1000 / MOCK_TRACE_SPEED - loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+            }
+            yield f"data: {json.dumps(chunk)}\n\n"
+        # A stream that failed when recorded ends without [DONE] here too
+        if not call.get("error"):
+            yield "data: [DONE]\n\n"
+
+    return StreamingResponse(replay(), media_type="text/event-stream")
+
+def mock_tokens(count: int):
+    """Deterministic filler text split into word tokens"""
+    words = [WORDS[i % len(WORDS)] for i in range(count)]
+    return words[:1] + [f" {word}" for word in words[1:]]
+
+def error_response() -> JSONResponse:
+    return JSONResponse(
+        status_code=503,
+        content={"error": {"message": "Mock upstream injected failure", "type": "server_error"}}
+    )
+
+@app.post("/v1/chat/completions")
+@app.post("/chat/completions")
+async def chat_completions(request: Request):
+    """OpenAI-compatible completions with synthetic latency"""
+    payload = await request.json()
+    model = payload.get("model", "mock")
+    max_tokens = payload.get("max_tokens") or MOCK_RESPONSE_TOKENS
+    tokens = mock_tokens(min(MOCK_RESPONSE_TOKENS, max_tokens))
+    completion_id = f"chatcmpl-mock-{uuid.uuid4().hex[:12]}"
+    created = int(time.time())
+
+    if TRACE_CALLS:
+        call = next_recorded_call(payload.get("messages") or [])
+        if call is not None:
+            return await replay_call(call, bool(payload.get("stream")), model, completion_id, created)
+
+    slow = MOCK_SLOW_RATE and random.random() < MOCK_SLOW_RATE
+    await asyncio.sleep(MOCK_SLOW_TTFT_SECONDS if slow else MOCK_TTFT_SECONDS)
+    if MOCK_ERROR_RATE and random.random() < MOCK_ERROR_RATE:
+        return error_response()
+
+    if not payload.get("stream"):
+        await asyncio.sleep(len(tokens) / MOCK_TOKENS_PER_SECOND)
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": model,
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "".join(tokens)},
+                "finish_reason": "stop"
+            }],
+            "usage": {"prompt_tokens": 0, "completion_tokens": len(tokens), "total_tokens": len(tokens)}
+        }
+
+    async def stream():
+        delay = 1 / MOCK_TOKENS_PER_SECOND
+        for i, token in enumerate(tokens):
+            if i:
+                await asyncio.sleep(delay)
+            chunk = {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]
+            }
+            yield f"data: {json.dumps(chunk)}\n\n"
+        chunk = {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]
+        }
+        yield f"data: {json.dumps(chunk)}\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+@app.get("/trace/stats")
+async def trace_stats():
+    """How many requests were answered from the trace and how many fell back to synthetic text"""
+    return {**TRACE_STATS, "speed": MOCK_TRACE_SPEED, "trace": MOCK_TRACE_PATH}
+
+def main():
+    global MOCK_TTFT_SECONDS, MOCK_TOKENS_PER_SECOND, MOCK_RESPONSE_TOKENS, MOCK_ERROR_RATE
+    global MOCK_SLOW_RATE, MOCK_SLOW_TTFT_SECONDS, MOCK_TRACE_PATH, MOCK_TRACE_SPEED
+    parser = argparse.ArgumentParser(description="Mock OpenAI upstream for load testing")
+    parser.add_argument("--port", type=int, default=8002)
+    parser.add_argument("--ttft", type=float, default=MOCK_TTFT_SECONDS, help="Seconds before the first token")
+    parser.add_argument("--tps", type=float, default=MOCK_TOKENS_PER_SECOND, help="Tokens per second after the first")
+    parser.add_argument("--tokens", type=int, default=MOCK_RESPONSE_TOKENS, help="Tokens per response")
+    parser.add_argument("--error-rate", type=float, default=MOCK_ERROR_RATE, help="Fraction of requests answered with 503")
+    parser.add_argument("--slow-rate", type=float, default=MOCK_SLOW_RATE, help="Fraction of requests with a slow first token")
+    parser.add_argument("--slow-ttft", type=float, default=MOCK_SLOW_TTFT_SECONDS, help="Seconds before a slow request's first token")
+    parser.add_argument("--trace", default=MOCK_TRACE_PATH, help="Answer from the responses recorded in this trace")
+    parser.add_argument("--speed", type=float, default=MOCK_TRACE_SPEED, help="Replay the trace this many times faster")
+    args = parser.parse_args()
+
+    MOCK_TTFT_SECONDS = args.ttft
+    MOCK_TOKENS_PER_SECOND = args.tps
+    MOCK_RESPONSE_TOKENS = args.tokens
+    MOCK_ERROR_RATE = args.error_rate
+    MOCK_SLOW_RATE = args.slow_rate
+    MOCK_SLOW_TTFT_SECONDS = args.slow_ttft
+    MOCK_TRACE_PATH = args.trace
+    MOCK_TRACE_SPEED = args.speed
+    if MOCK_TRACE_PATH:
+        load_trace(MOCK_TRACE_PATH)
+        print(f"🎞️  Replaying {TRACE_STATS['recorded_calls']} recorded calls from {MOCK_TRACE_PATH} at {MOCK_TRACE_SPEED}x; "
+              f"other requests get synthetic text")
+
+    print(f"🧪 Mock upstream on http://localhost:{args.port}/v1 "
+          f"(ttft={args.ttft}s, {args.tps} tok/s, {args.tokens} tokens, error rate {args.error_rate}, "
+          f"slow rate {args.slow_rate} at {args.slow_ttft}s)")
+    uvicorn.run(app, host="127.0.0.1", port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
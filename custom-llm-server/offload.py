@@ -0,0 +1,57 @@
+"""
+Offloading of CPU-bound request preparation
+Runs a preparation step inline when it is cheap, and in a thread pool when
+it is heavy enough that running it on the event loop would hold up every
+stream the loop is serving
+"""
+
+import asyncio
+import contextvars
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Optional
+
+from metrics import PREPARATION_STEPS
+
+class Offloader:
+    """Chooses per step between the event loop and a worker thread
+
+    A worker thread still shares the GIL, but the interpreter switches
+    back to the event loop every few milliseconds, so streams keep
+    flowing while a long step runs instead of waiting for all of it.
+    The thread runs in a copy of the caller's context, so stage timings
+    are still recorded against the request.
+    """
+
+    def __init__(self, mode: str = "thread", workers: int = 4):
+        if mode not in ("off", "thread"):
+            raise ValueError(f"Unknown offload mode: {mode}")
+        self.mode = mode
+        self.workers = workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self.counts: Dict[str, Dict[str, int]] = {}
+
+    def _get_executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="prepare")
+        return self._executor
+
+    async def run(self, step: str, heavy: bool, func: Callable[..., Any], *args) -> Any:
+        """Run func(*args) in the pool if heavy and offloading is on, otherwise inline"""
+        where = "thread" if heavy and self.mode == "thread" else "inline"
+        PREPARATION_STEPS.inc(1, step, where)
+        counts = self.counts.setdefault(step, {"inline": 0, "thread": 0})
+        counts[where] += 1
+        if where == "inline":
+            return func(*args)
+        context = contextvars.copy_context()
+        return await asyncio.get_running_loop().run_in_executor(
+            self._get_executor(), functools.partial(context.run, func, *args))
+
+    def stats(self) -> Dict[str, Any]:
+        return {"mode": self.mode, "workers": self.workers, "steps": self.counts}
+
+    def shutdown(self) -> None:
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
@@ -0,0 +1,366 @@
+"""
+Request profiling and event-loop monitoring
+Opt-in cProfile capture of single requests, including the tasks they
+spawn, and a lag monitor that records what the event loop was running
+whenever it stalls
+"""
+
+import asyncio
+import cProfile
+import inspect
+import io
+import marshal
+import os
+import pstats
+import sys
+import threading
+import time
+import traceback
+import uuid
+from collections import OrderedDict, deque
+from collections.abc import Coroutine
+from contextvars import ContextVar
+from dataclasses import dataclass, field
+from datetime import datetime
+from typing import Any, Deque, Dict, List, Optional
+
+from metrics import LOOP_LAG_SECONDS, LOOP_STALLS, current_request_timings
+
+# Frames kept from the event-loop thread's stack when a stall is recorded
+STALL_STACK_LIMIT = 20
+
+class ProfileSession:
+    """One profiled request: its profiler and how long its code held the event loop"""
+
+    def __init__(self):
+        self.profiler = cProfile.Profile()
+        self.busy_seconds = 0.0
+        self.steps = 0
+        self.closed = False
+
+_active_session: ContextVar[Optional[ProfileSession]] = ContextVar("profile_session", default=None)
+
+class ProfiledCoroutine(Coroutine):
+    """Runs a coroutine with the session's profiler enabled only while it is executing
+
+    Other requests' work in between its steps is not attributed to it, and
+    the time spent awaiting the upstream shows up as wall time, not CPU.
+    """
+    __slots__ = ("_coro", "_session")
+
+    def __init__(self, coro, session: ProfileSession):
+        self._coro = coro
+        self._session = session
+
+    def _step(self, method, *args):
+        session = self._session
+        if session.closed:
+            return method(*args)
+        started = time.perf_counter()
+        session.profiler.enable()
+        try:
+            return method(*args)
+        finally:
+            session.profiler.disable()
+            session.busy_seconds += time.perf_counter() - started
+            session.steps += 1
+
+    def send(self, value):
+        return self._step(self._coro.send, value)
+
+    def throw(self, *args):
+        return self._step(self._coro.throw, *args)
+
+    def close(self):
+        return self._coro.close()
+
+    def __getattr__(self, name):
+        # cr_frame, cr_running, __qualname__ and so on, which asyncio and anyio inspect
+        return getattr(self._coro, name)
+
+    def __await__(self):
+        return self
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.send(None)
+
+def install_task_factory(loop: asyncio.AbstractEventLoop) -> None:
+    """Profile tasks created by a profiled request, such as the one streaming its response"""
+    previous = loop.get_task_factory()
+
+    def factory(loop, coro, context=None):
+        session = _active_session.get() if context is None else context.get(_active_session)
+        if session is not None and not session.closed:
+            coro = ProfiledCoroutine(coro, session)
+        kwargs = {} if context is None else {"context": context}
+        if previous is not None:
+            return previous(loop, coro, **kwargs)
+        return asyncio.Task(coro, loop=loop, **kwargs)
+
+    loop.set_task_factory(factory)
+
+@dataclass
+class RequestProfile:
+    profile_id: str
+    method: str
+    path: str
+    status: Optional[int]
+    started: str
+    wall_seconds: float
+    busy_seconds: float
+    steps: int
+    stage_timings: Dict[str, float]
+    stats: pstats.Stats = field(repr=False)
+
+    def top_functions(self, limit: int = 10) -> List[Dict[str, Any]]:
+        """Functions with the most time spent in their own code"""
+        rows = sorted(self.stats.stats.items(), key=lambda item: item[1][2], reverse=True)[:limit]
+        return [
+            {
+                "function": f"{os.path.basename(filename)}:{line}({name})",
+                "calls": calls,
+                "self_ms": round(own * 1000, 3),
+                "cumulative_ms": round(cumulative * 1000, 3),
+            }
+            for (filename, line, name), (_, calls, own, cumulative, _) in rows
+        ]
+
+    def summary(self, top_functions: bool = True) -> Dict[str, Any]:
+        summary = {
+            "profile_id": self.profile_id,
+            "method": self.method,
+            "path": self.path,
+            "status": self.status,
+            "started": self.started,
+            "wall_ms": round(self.wall_seconds * 1000, 3),
+            # Time this request's code held the event loop; the rest of wall_ms was spent waiting
+            "busy_ms": round(self.busy_seconds * 1000, 3),
+            "steps": self.steps,
+            "stage_timings_ms": {stage: round(seconds * 1000, 3) for stage, seconds in self.stage_timings.items()},
+        }
+        if top_functions:
+            summary["top_functions"] = self.top_functions()
+        return summary
+
+    def report(self, limit: int = 40) -> str:
+        """pstats text report sorted by cumulative time"""
+        stream = io.StringIO()
+        self.stats.stream = stream
+        self.stats.sort_stats("cumulative").print_stats(limit)
+        return stream.getvalue()
+
+    def dump(self) -> bytes:
+        """The profile in the format cProfile writes, for pstats, snakeviz and similar tools"""
+        return marshal.dumps(self.stats.stats)
+
+class ProfileStore:
+    """The most recent request profiles, plus the admin toggle that profiles upcoming requests"""
+
+    def __init__(self, max_profiles: int = 50):
+        self.max_profiles = max_profiles
+        self._profiles: "OrderedDict[str, RequestProfile]" = OrderedDict()
+        self.armed = False
+        # Requests still to profile while armed; None profiles every request
+        self.remaining: Optional[int] = None
+
+    def arm(self, requests: Optional[int] = None) -> None:
+        self.armed = requests is None or requests > 0
+        self.remaining = requests
+
+    def disarm(self) -> None:
+        self.armed = False
+        self.remaining = None
+
+    def take(self) -> bool:
+        """Whether the admin toggle selects the next request"""
+        if not self.armed:
+            return False
+        if self.remaining is not None:
+            self.remaining -= 1
+            if self.remaining <= 0:
+                self.armed = False
+        return True
+
+    def add(self, profile: RequestProfile) -> None:
+        self._profiles[profile.profile_id] = profile
+        while len(self._profiles) > self.max_profiles:
+            self._profiles.popitem(last=False)
+
+    def get(self, profile_id: str) -> Optional[RequestProfile]:
+        return self._profiles.get(profile_id)
+
+    def list(self) -> List[Dict[str, Any]]:
+        return [profile.summary(top_functions=False) for profile in reversed(self._profiles.values())]
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "armed": self.armed,
+            "remaining": self.remaining,
+            "stored": len(self._profiles),
+            "max_profiles": self.max_profiles,
+        }
+
+class ProfilingMiddleware:
+    """ASGI middleware that profiles requests sent with `X-Profile: 1` or selected by the admin toggle
+
+    When admin_key is set the header only counts alongside a matching
+    X-Admin-Key. Profiled responses carry an X-Profile-Id header.
+    """
+
+    # Never selected by the admin toggle, so inspecting profiles does not use up the toggle
+    UNTOGGLED_PREFIXES = ("/admin", "/health", "/metrics")
+
+    def __init__(self, app, store: ProfileStore, admin_key: Optional[str] = None):
+        self.app = app
+        self.store = store
+        self.admin_key = admin_key.encode() if admin_key else None
+
+    def _selected(self, scope) -> bool:
+        headers = dict(scope["headers"])
+        if headers.get(b"x-profile", b"").lower() in (b"1", b"true"):
+            return self.admin_key is None or headers.get(b"x-admin-key") == self.admin_key
+        return not scope["path"].startswith(self.UNTOGGLED_PREFIXES) and self.store.take()
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not self._selected(scope):
+            await self.app(scope, receive, send)
+            return
+
+        profile_id = f"prof-{uuid.uuid4().hex[:16]}"
+        session = ProfileSession()
+        status = None
+
+        async def send_with_profile_id(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = list(message.get("headers", [])) + [(b"x-profile-id", profile_id.encode())]
+            await send(message)
+
+        started, wall_started = datetime.now().isoformat(), time.perf_counter()
+        token = _active_session.set(session)
+        try:
+            await ProfiledCoroutine(self.app(scope, receive, send_with_profile_id), session)
+        finally:
+            _active_session.reset(token)
+            session.closed = True
+            self.store.add(RequestProfile(
+                profile_id=profile_id,
+                method=scope["method"],
+                path=scope["path"],
+                status=status,
+                started=started,
+                wall_seconds=time.perf_counter() - wall_started,
+                busy_seconds=session.busy_seconds,
+                steps=session.steps,
+                stage_timings=dict(current_request_timings() or {}),
+                stats=pstats.Stats(session.profiler),
+            ))
+
+def _coroutine_name(coro) -> str:
+    if isinstance(coro, ProfiledCoroutine):
+        coro = coro._coro
+    return getattr(coro, "__qualname__", type(coro).__name__)
+
+class LoopMonitor:
+    """Measures how late the event loop wakes a sleeping coroutine
+
+    A watchdog thread notices when the loop has not ticked for
+    stall_threshold seconds and records the stack of the code holding
+    it. A stall inside C code that keeps the GIL is recorded once the
+    GIL is released, so its stack may show what ran right after.
+    """
+
+    def __init__(self, interval: float = 0.05, stall_threshold: float = 0.1,
+                 window: int = 1200, max_stalls: int = 50):
+        self.interval = interval
+        self.stall_threshold = stall_threshold
+        self._lags: Deque[float] = deque(maxlen=window)
+        self.stalls: Deque[Dict[str, Any]] = deque(maxlen=max_stalls)
+        self.stall_count = 0
+        self._expected: Optional[float] = None
+        self._recorded_for: Optional[float] = None
+        self._open_stall: Optional[Dict[str, Any]] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._loop_thread: Optional[int] = None
+        self._stop = threading.Event()
+
+    async def run(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._loop_thread = threading.get_ident()
+        self._stop.clear()
+        watchdog = threading.Thread(target=self._watch, name="loop-monitor", daemon=True)
+        watchdog.start()
+        try:
+            while True:
+                self._expected = time.perf_counter() + self.interval
+                await asyncio.sleep(self.interval)
+                lag = max(0.0, time.perf_counter() - self._expected)
+                self._lags.append(lag)
+                LOOP_LAG_SECONDS.observe(lag)
+                stall, self._open_stall = self._open_stall, None
+                if stall is not None:
+                    stall["duration_ms"] = round(lag * 1000, 1)
+                    stall.pop("ongoing", None)
+        finally:
+            self._stop.set()
+
+    def _watch(self) -> None:
+        while not self._stop.wait(self.stall_threshold / 2):
+            expected = self._expected
+            if expected is None or expected == self._recorded_for:
+                continue
+            if time.perf_counter() - expected >= self.stall_threshold:
+                self._recorded_for = expected
+                self._record_stall()
+
+    def _record_stall(self) -> None:
+        frame = sys._current_frames().get(self._loop_thread)
+        if frame is None:
+            return
+        stack = traceback.extract_stack(frame, limit=STALL_STACK_LIMIT)
+        # The innermost async function on the stack is the coroutine that blocked
+        coroutine = None
+        while frame is not None:
+            code = frame.f_code
+            if code.co_flags & inspect.CO_COROUTINE:
+                name = getattr(code, "co_qualname", code.co_name)
+                coroutine = f"{name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})"
+                break
+            frame = frame.f_back
+        # asyncio has no public way to read another thread's current task
+        task = getattr(asyncio.tasks, "_current_tasks", {}).get(self._loop)
+        stall = {
+            "started": datetime.now().isoformat(),
+            "ongoing": True,
+            "task": task.get_name() if task is not None else None,
+            "task_coroutine": _coroutine_name(task.get_coro()) if task is not None else None,
+            "coroutine": coroutine,
+            "stack": [f"{os.path.basename(f.filename)}:{f.lineno} {f.name}" for f in stack],
+        }
+        self.stall_count += 1
+        LOOP_STALLS.inc()
+        self.stalls.append(stall)
+        self._open_stall = stall
+
+    def percentiles(self) -> Dict[str, Optional[float]]:
+        lags = sorted(self._lags)
+        if not lags:
+            return {"p50": None, "p90": None, "p99": None, "max": None}
+
+        def at(q: float) -> float:
+            return round(lags[min(len(lags) - 1, int(q * len(lags)))] * 1000, 2)
+
+        return {"p50": at(0.5), "p90": at(0.9), "p99": at(0.99), "max": round(lags[-1] * 1000, 2)}
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "lag_ms": self.percentiles(),
+            "samples": len(self._lags),
+            "interval_ms": self.interval * 1000,
+            "stalls": self.stall_count,
+            "stall_threshold_ms": self.stall_threshold * 1000,
+        }
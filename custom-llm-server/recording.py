@@ -0,0 +1,413 @@
+"""
+Traffic recording for the Custom LLM Server
+Captures /chat/completions request payloads together with the upstream
+response chunks and their timing to a compact JSONL trace, with redaction,
+so real traffic can be replayed offline by replay.py
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import queue
+import random
+import re
+import threading
+import time
+from contextvars import ContextVar
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, Iterator, List, Optional, Tuple
+
+TRACE_FORMAT = 1
+
+# Personal data and secrets removed in "patterns" mode, with what replaces them
+REDACTION_PATTERNS = [
+    (re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+"), "[EMAIL]"),
+    (re.compile(r"\b(?:sk|pk|rk)-[A-Za-z0-9_-]{16,}\b"), "[SECRET]"),
+    (re.compile(r"\bBearer\s+[A-Za-z0-9._~+/=-]{16,}"), "Bearer [SECRET]"),
+    (re.compile(r"\b(?:\d[ -]?){13,19}\b"), "[NUMBER]"),
+    (re.compile(r"\+?\(?\d{1,3}\)?[ .-]?\d{3}[ .-]?\d{3,4}[ .-]?\d{0,4}\b"), "[PHONE]"),
+]
+
+# Request headers worth replaying; the ones naming a client or session are hashed
+RECORDED_HEADERS = ("x-session-id", "x-client-id", "x-priority")
+HASHED_HEADERS = ("x-session-id", "x-client-id")
+
+_active_entry: ContextVar[Optional["TraceEntry"]] = ContextVar("trace_entry", default=None)
+
+class Redactor:
+    """Removes sensitive text from recorded payloads and responses
+
+    "patterns" replaces emails, phone and card numbers and API keys;
+    "all" also masks every message and response text with a filler of the
+    same length, keeping prompt sizes realistic; "none" keeps everything.
+    Tool names are always kept and tool arguments only get the patterns,
+    so replayed tool calls still run. Identifiers that tie requests
+    together, such as session ids, are replaced by a stable hash.
+    Redacting already redacted text changes nothing.
+    """
+
+    MODES = ("none", "patterns", "all")
+
+    def __init__(self, mode: str = "patterns"):
+        if mode not in self.MODES:
+            raise ValueError(f"Unknown redaction mode: {mode}. Available: {list(self.MODES)}")
+        self.mode = mode
+
+    def patterns(self, text: str) -> str:
+        if self.mode == "none":
+            return text
+        for pattern, replacement in REDACTION_PATTERNS:
+            text = pattern.sub(replacement, text)
+        return text
+
+    def text(self, text: Any) -> Any:
+        if not isinstance(text, str):
+            return text
+        if self.mode == "all":
+            return re.sub(r"\S", "x", text)
+        return self.patterns(text)
+
+    def identifier(self, value: Any) -> Any:
+        if self.mode == "none" or not isinstance(value, str):
+            return value
+        return "anon-" + hashlib.sha256(value.encode("utf-8")).hexdigest()[:16]
+
+    def content(self, content: Any) -> Any:
+        if isinstance(content, list):
+            # Multi-part content: only the text parts are redacted
+            return [dict(part, text=self.text(part["text"])) if isinstance(part, dict) and "text" in part else part
+                    for part in content]
+        return self.text(content)
+
+    def tool_calls(self, tool_calls: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        redacted = []
+        for call in tool_calls:
+            function = call.get("function")
+            if function and isinstance(function.get("arguments"), str):
+                call = dict(call, function=dict(function, arguments=self.patterns(function["arguments"])))
+            redacted.append(call)
+        return redacted
+
+    def message(self, message: Dict[str, Any]) -> Dict[str, Any]:
+        message = dict(message)
+        if "content" in message:
+            message["content"] = self.content(message["content"])
+        if message.get("tool_calls"):
+            message["tool_calls"] = self.tool_calls(message["tool_calls"])
+        return message
+
+    def payload(self, payload: Dict[str, Any]) -> Dict[str, Any]:
+        payload = dict(payload)
+        if isinstance(payload.get("messages"), list):
+            payload["messages"] = [self.message(m) if isinstance(m, dict) else m for m in payload["messages"]]
+        for key in ("session_id", "user"):
+            if payload.get(key):
+                payload[key] = self.identifier(payload[key])
+        return payload
+
+    def headers(self, headers: Dict[str, str]) -> Dict[str, str]:
+        return {name: self.identifier(value) if name in HASHED_HEADERS else value for name, value in headers.items()}
+
+def call_key(messages: List[Dict[str, Any]]) -> str:
+    """Identifies an upstream call by the last user message and the tool rounds after it
+
+    The recorder computes it over redacted messages and the replay
+    upstream over what the replayed server sends, which is the same text.
+    """
+    last_user = max((i for i, m in enumerate(messages) if m.get("role") == "user"), default=-1)
+    text = messages[last_user].get("content") if last_user >= 0 else None
+    rounds = sum(1 for m in messages[last_user + 1:] if m.get("role") == "assistant")
+    return hashlib.sha256(json.dumps([text, rounds], sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+class TraceEntry:
+    """One recorded request and the upstream calls it made"""
+
+    def __init__(self, offset: float):
+        self.offset = offset
+        self.started = time.perf_counter()
+        self.calls: List[Dict[str, Any]] = []
+
+    def elapsed_ms(self, since: float) -> int:
+        return int(round((time.perf_counter() - since) * 1000))
+
+class TraceRecorder:
+    """Appends trace records to a JSONL file, gzip-compressed when the path ends in .gz
+
+    Each line is one request: its arrival time relative to the start of
+    the recording, the redacted payload and selected headers, the response
+    status and timing, and every upstream call with its chunks as
+    [milliseconds since the call started, delta, finish_reason]. A
+    "{pid}" in the path is replaced by the process id, so that worker
+    processes write separate files.
+
+    record() only queues the request; parsing, redaction, encoding,
+    compression and the write happen on a writer thread, so the event loop
+    never waits on the file. Requests arriving while max_pending are
+    already queued are dropped and counted rather than delaying the loop.
+    """
+
+    def __init__(self, path: str, redactor: Redactor, sample_rate: float = 1.0, max_pending: int = 1000):
+        self.path = path.replace("{pid}", str(os.getpid()))
+        self.redactor = redactor
+        self.sample_rate = sample_rate
+        self._file = None
+        # Offsets count from the first recorded request, not from process start
+        self._started: Optional[float] = None
+        self._queue: "queue.Queue[Optional[Dict[str, Any]]]" = queue.Queue(maxsize=max_pending)
+        self._writer: Optional[threading.Thread] = None
+        self.recorded = 0
+        self.skipped = 0
+        self.dropped = 0
+
+    def _open(self):
+        if self._file is None:
+            opener = gzip.open if self.path.endswith(".gz") else open
+            self._file = opener(self.path, "at", encoding="utf-8")
+            self._write({
+                "trace_format": TRACE_FORMAT,
+                "started": datetime.now().isoformat(),
+                "redaction": self.redactor.mode,
+            })
+        return self._file
+
+    def _write(self, record: Dict[str, Any]) -> None:
+        self._file.write(json.dumps(record, ensure_ascii=False, separators=(",", ":")) + "\n")
+
+    def sampled(self) -> bool:
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+
+    def start(self) -> TraceEntry:
+        now = time.monotonic()
+        if self._started is None:
+            self._started = now
+        return TraceEntry(round(now - self._started, 3))
+
+    def record(self, entry: TraceEntry, body: bytes, headers: Dict[str, str], status: Optional[int],
+               first_byte: Optional[float]) -> None:
+        """Queue a finished request for the writer thread"""
+        item = {
+            "t": entry.offset,
+            "body": body,
+            "headers": headers,
+            "status": status,
+            "first_byte_ms": int(round((first_byte - entry.started) * 1000)) if first_byte else None,
+            "duration_ms": entry.elapsed_ms(entry.started),
+            "calls": entry.calls,
+        }
+        if self._writer is None:
+            self._writer = threading.Thread(target=self._run, name="trace-writer", daemon=True)
+            self._writer.start()
+        try:
+            self._queue.put_nowait(item)
+        except queue.Full:
+            self.dropped += 1
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                self._record(item)
+                if self._file is not None and self._queue.empty() and not self.path.endswith(".gz"):
+                    # Once per burst rather than per record; gzip keeps its buffer for a better ratio
+                    self._file.flush()
+            except Exception:
+                self.skipped += 1
+            finally:
+                self._queue.task_done()
+
+    def _record(self, item: Dict[str, Any]) -> None:
+        try:
+            payload = json.loads(item.pop("body"))
+        except ValueError:
+            self.skipped += 1
+            return
+        if not isinstance(payload, dict):
+            self.skipped += 1
+            return
+        self._open()
+        self._write({
+            "t": item["t"],
+            "payload": self.redactor.payload(payload),
+            "headers": self.redactor.headers(item["headers"]),
+            "status": item["status"],
+            "first_byte_ms": item["first_byte_ms"],
+            "duration_ms": item["duration_ms"],
+            "calls": item["calls"],
+        })
+        self.recorded += 1
+
+    def flush(self) -> None:
+        """Block until every queued request is written; for shutdown and tests, not the event loop"""
+        self._queue.join()
+
+    def close(self) -> None:
+        if self._writer is not None:
+            self._queue.put(None)
+            self._writer.join()
+            self._writer = None
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "path": self.path,
+            "redaction": self.redactor.mode,
+            "sample_rate": self.sample_rate,
+            "recorded": self.recorded,
+            "skipped": self.skipped,
+            "dropped": self.dropped,
+            "pending": self._queue.qsize(),
+        }
+
+class RecordingUpstream:
+    """Wraps the upstream client and records calls made on behalf of a recorded request
+
+    Everything else, such as stats() and aclose(), goes to the wrapped client.
+    """
+
+    def __init__(self, upstream, redactor: Redactor):
+        self.upstream = upstream
+        self.redactor = redactor
+
+    def __getattr__(self, name: str):
+        return getattr(self.upstream, name)
+
+    def _new_call(self, entry: TraceEntry, params: Dict[str, Any], stream: bool) -> Dict[str, Any]:
+        messages = [self.redactor.message(m) for m in params.get("messages") or []]
+        call = {"key": call_key(messages), "stream": stream}
+        entry.calls.append(call)
+        return call
+
+    async def complete(self, **params) -> Dict[str, Any]:
+        entry = _active_entry.get()
+        if entry is None:
+            return await self.upstream.complete(**params)
+        call = self._new_call(entry, params, False)
+        started = time.perf_counter()
+        try:
+            result = await self.upstream.complete(**params)
+        except Exception as e:
+            call.update(latency_ms=entry.elapsed_ms(started), error=getattr(e, "status", None) or 500)
+            raise
+        choice = (result.get("choices") or [{}])[0]
+        message = dict(choice.get("message") or {})
+        call.update(
+            latency_ms=entry.elapsed_ms(started),
+            message=self.redactor.message(message),
+            finish_reason=choice.get("finish_reason"),
+            usage=result.get("usage"),
+        )
+        return result
+
+    async def stream(self, **params) -> AsyncIterator[Dict[str, Any]]:
+        entry = _active_entry.get()
+        response = self.upstream.stream(**params)
+        if entry is None:
+            try:
+                async for chunk in response:
+                    yield chunk
+            finally:
+                await response.aclose()
+            return
+        call = self._new_call(entry, params, True)
+        chunks: List[Tuple[int, Dict[str, Any], Optional[str]]] = []
+        call["chunks"] = chunks
+        started = time.perf_counter()
+        try:
+            async for chunk in response:
+                choice = (chunk.get("choices") or [{}])[0]
+                delta = dict(choice.get("delta") or {})
+                if "content" in delta:
+                    delta["content"] = self.redactor.text(delta["content"])
+                if delta.get("tool_calls"):
+                    delta["tool_calls"] = self.redactor.tool_calls(delta["tool_calls"])
+                chunks.append((entry.elapsed_ms(started), delta, choice.get("finish_reason")))
+                yield chunk
+        except Exception as e:
+            call["error"] = getattr(e, "status", None) or 500
+            raise
+        finally:
+            await response.aclose()
+
+class TraceRecordingMiddleware:
+    """ASGI middleware that records selected POST endpoints to a TraceRecorder"""
+
+    def __init__(self, app, recorder: TraceRecorder, paths: Tuple[str, ...] = ("/chat/completions",)):
+        self.app = app
+        self.recorder = recorder
+        self.paths = paths
+
+    async def __call__(self, scope, receive, send):
+        if (scope["type"] != "http" or scope["method"] != "POST" or scope["path"] not in self.paths
+                or not self.recorder.sampled()):
+            await self.app(scope, receive, send)
+            return
+
+        body = bytearray()
+        status = None
+        first_byte = None
+
+        async def receive_and_capture():
+            message = await receive()
+            if message["type"] == "http.request":
+                body.extend(message.get("body", b""))
+            return message
+
+        async def send_and_time(message):
+            nonlocal status, first_byte
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body" and first_byte is None and message.get("body"):
+                first_byte = time.perf_counter()
+            await send(message)
+
+        headers = {}
+        for name, value in scope["headers"]:
+            name = name.decode("latin-1")
+            if name in RECORDED_HEADERS:
+                headers[name] = value.decode("latin-1")
+        entry = self.recorder.start()
+        token = _active_entry.set(entry)
+        try:
+            await self.app(scope, receive_and_capture, send_and_time)
+        finally:
+            _active_entry.reset(token)
+            self.recorder.record(entry, bytes(body), headers, status, first_byte)
+
+def read_trace(path: str) -> Tuple[Dict[str, Any], Iterator[Dict[str, Any]]]:
+    """Return a trace's header and an iterator over its request records
+
+    A file appended to by several recordings has one header per
+    recording; later headers are skipped and offsets continue from the
+    last request of the previous recording.
+    """
+    opener = gzip.open if path.endswith(".gz") else open
+    f = opener(path, "rt", encoding="utf-8")
+    first = f.readline()
+    if not first:
+        f.close()
+        raise ValueError(f"Trace {path} is empty")
+    header = json.loads(first)
+    if header.get("trace_format") != TRACE_FORMAT:
+        f.close()
+        raise ValueError(f"Trace {path} has format {header.get('trace_format')}, expected {TRACE_FORMAT}")
+
+    def records() -> Iterator[Dict[str, Any]]:
+        base, last = 0.0, 0.0
+        with f:
+            for line in f:
+                if not line.strip():
+                    continue
+                record = json.loads(line)
+                if "trace_format" in record:
+                    base = last
+                    continue
+                record["t"] = base + record["t"]
+                last = record["t"]
+                yield record
+
+    return header, records()
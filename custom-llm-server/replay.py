@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+"""
+Replay of recorded traffic against the Custom LLM Server
+Sends the requests of a trace recorded with TRACE_RECORD_PATH at their
+recorded arrival times, optionally sped up, while the mock upstream answers
+with the recorded responses at the recorded chunk timing. Reports latency
+and throughput next to what was recorded, for regression testing on
+realistic traffic without an API key.
+
+Examples:
+    python replay.py traffic.jsonl.gz --spawn --output replay.json
+    python replay.py traffic.jsonl.gz --spawn --speed 4 --baseline replay.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+import urllib.request
+from datetime import datetime
+from typing import Any, Dict, List, Optional, Tuple
+
+import aiohttp
+
+from benchmark import SERVER_DIR, latency_summary, timed_request, wait_until_healthy
+from recording import read_trace
+
+def load_records(path: str, limit: Optional[int]) -> List[Dict[str, Any]]:
+    _, records = read_trace(path)
+    # Records are written as requests finish; replay them in arrival order, so
+    # the limit keeps the first N requests to arrive, not the first N to finish
+    loaded = sorted(records, key=lambda record: record["t"])
+    if limit is not None:
+        loaded = loaded[:limit]
+    if loaded:
+        first = loaded[0]["t"]
+        for record in loaded:
+            record["t"] -= first
+    return loaded
+
+def session_of(record: Dict[str, Any]) -> Optional[str]:
+    return record["payload"].get("session_id") or record.get("headers", {}).get("x-session-id")
+
+async def replay_records(url: str, records: List[Dict[str, Any]], speed: float, timeout: float) -> Dict[str, Any]:
+    """Send every record at its offset divided by speed and time the responses
+
+    A request of a session that arrived after the previous one had finished
+    waits for it here too, as the recorded client did, even when that makes
+    it late. Requests that overlapped in the recording overlap in the replay.
+    """
+    previous_in_session: Dict[str, Tuple[Dict[str, Any], asyncio.Task]] = {}
+    results: List[Dict[str, Any]] = []
+
+    async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=timeout)) as session:
+        started = time.perf_counter()
+
+        async def send(record: Dict[str, Any], after: Optional[asyncio.Task]) -> None:
+            delay = started + record["t"] / speed - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            if after is not None:
+                await asyncio.gather(after, return_exceptions=True)
+            payload = dict(record["payload"])
+            payload.setdefault("stream", False)
+            sent = time.perf_counter()
+            result = await timed_request(session, url, payload, record.get("headers") or None)
+            # A stream that only carried tool calls for the client has no content tokens
+            result["ok"] = result["ok"] or (result["status"] == 200 and payload["stream"] and not result.get("token_times"))
+            result["lateness"] = sent - (started + record["t"] / speed)
+            result["stream"] = payload["stream"]
+            results.append(result)
+
+        tasks = []
+        for record in records:
+            session_id = session_of(record)
+            after = None
+            if session_id in previous_in_session:
+                previous, previous_task = previous_in_session[session_id]
+                if previous["t"] + (previous.get("duration_ms") or 0) / 1000 <= record["t"]:
+                    after = previous_task
+            task = asyncio.create_task(send(record, after))
+            if session_id:
+                previous_in_session[session_id] = (record, task)
+            tasks.append(task)
+        await asyncio.gather(*tasks)
+        elapsed = time.perf_counter() - started
+
+    ok = [r for r in results if r["ok"]]
+    errors: Dict[str, int] = {}
+    for r in results:
+        if not r["ok"]:
+            key = str(r.get("status") or r.get("error", "error"))
+            errors[key] = errors.get(key, 0) + 1
+    inter_token = [b - a for r in ok for a, b in zip(r.get("token_times", []), r.get("token_times", [])[1:])]
+    return {
+        "requests": len(results),
+        "successes": len(ok),
+        "errors": errors,
+        "elapsed_s": round(elapsed, 3),
+        "requests_per_s": round(len(ok) / elapsed, 2) if elapsed else 0.0,
+        "ttft": latency_summary([r["ttft"] for r in ok if r["stream"] and r.get("ttft") is not None]),
+        "inter_token": latency_summary(inter_token),
+        "latency": latency_summary([r["latency"] for r in ok]),
+        "lateness": latency_summary([r["lateness"] for r in results]),
+    }
+
+def recorded_summary(records: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """The same figures as they were recorded, at 1x"""
+    ok = [r for r in records if r.get("status") == 200]
+    streams = [r for r in ok if r["payload"].get("stream")]
+    span = records[-1]["t"] if records else 0.0
+    return {
+        "requests": len(records),
+        "successes": len(ok),
+        "span_s": round(span, 3),
+        "ttft": latency_summary([r["first_byte_ms"] / 1000 for r in streams if r.get("first_byte_ms") is not None]),
+        "latency": latency_summary([r["duration_ms"] / 1000 for r in ok if r.get("duration_ms") is not None]),
+    }
+
+def spawn_stack(args) -> List[subprocess.Popen]:
+    """Start the mock upstream answering from the trace and a server pointed at it"""
+    mock = subprocess.Popen([
+        sys.executable, str(SERVER_DIR / "mock_upstream.py"),
+        "--port", str(args.mock_port), "--trace", os.path.abspath(args.trace), "--speed", str(args.speed),
+    ], cwd=SERVER_DIR)
+    env = dict(os.environ)
+    env.pop("TRACE_RECORD_PATH", None)
+    env.update({
+        "LLM_BACKEND": "openai",
+        "OPENAI_API_KEY": "mock",
+        "OPENAI_API_BASE": f"http://127.0.0.1:{args.mock_port}/v1",
+    })
+    port = args.url.rsplit(":", 1)[-1].split("/")[0]
+    server = subprocess.Popen([
+        sys.executable, "-m", "uvicorn", "server:app",
+        "--host", "127.0.0.1", "--port", port, "--log-level", "warning",
+    ], cwd=SERVER_DIR, env=env)
+    return [mock, server]
+
+def mock_trace_stats(port: int) -> Optional[Dict[str, Any]]:
+    try:
+        with urllib.request.urlopen(f"http://127.0.0.1:{port}/trace/stats", timeout=2) as response:
+            return json.loads(response.read())
+    except (OSError, ValueError):
+        return None
+
+def print_report(report: Dict[str, Any]) -> None:
+    def fmt(value):
+        return f"{value:.1f}" if value is not None else "-"
+
+    replayed, recorded = report["replayed"], report["recorded"]
+    print(f"\n   {report['meta']['speed']}x: {replayed['successes']}/{replayed['requests']} ok in {replayed['elapsed_s']:.1f}s "
+          f"({replayed['requests_per_s']:.1f} req/s), recorded span {recorded['span_s']:.1f}s")
+    if replayed["errors"]:
+        print(f"   errors: {replayed['errors']}")
+    print(f"\n   {'':<12}{'p50':>9}{'p95':>9}{'p99':>9}   (ms)")
+    for label, summary in [
+        ("ttft", replayed["ttft"]), ("  recorded", recorded["ttft"]),
+        ("latency", replayed["latency"]), ("  recorded", recorded["latency"]),
+        ("inter-token", replayed["inter_token"]),
+        ("lateness", replayed["lateness"]),
+    ]:
+        print(f"   {label:<12}{fmt(summary['p50_ms']):>9}{fmt(summary['p95_ms']):>9}{fmt(summary['p99_ms']):>9}")
+    if report["meta"]["speed"] != 1:
+        print("\n   Recorded figures are at 1x; upstream time shrinks with --speed, server time does not.")
+    upstream = report.get("mock_upstream")
+    if upstream:
+        print(f"   Upstream calls answered from the trace: {upstream['replayed']}, unmatched: {upstream['unmatched']}")
+
+def compare_with_baseline(report: Dict[str, Any], baseline_path: str) -> None:
+    """Print relative change against a previous replay of the same trace"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)["replayed"]
+    replayed = report["replayed"]
+    print(f"\n📈 Change vs {baseline_path} (positive = slower / more)")
+    for label, new_value, old_value in [
+        ("req/s", replayed["requests_per_s"], baseline["requests_per_s"]),
+        ("ttft p50", replayed["ttft"]["p50_ms"], baseline["ttft"]["p50_ms"]),
+        ("ttft p99", replayed["ttft"]["p99_ms"], baseline["ttft"]["p99_ms"]),
+        ("lat p50", replayed["latency"]["p50_ms"], baseline["latency"]["p50_ms"]),
+        ("lat p99", replayed["latency"]["p99_ms"], baseline["latency"]["p99_ms"]),
+    ]:
+        if new_value is not None and old_value:
+            print(f"   {label:<10} {old_value:.1f} -> {new_value:.1f} ({100 * (new_value - old_value) / old_value:+.1f}%)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Replay recorded traffic against the Custom LLM Server")
+    parser.add_argument("trace", help="Trace file written with TRACE_RECORD_PATH")
+    parser.add_argument("--url", default="http://127.0.0.1:8001", help="Server base URL")
+    parser.add_argument("--speed", type=float, default=1.0, help="Replay this many times faster than recorded")
+    parser.add_argument("--limit", type=int, help="Only replay the first N requests to arrive")
+    parser.add_argument("--timeout", type=float, default=120, help="Per-request timeout in seconds")
+    parser.add_argument("--spawn", action="store_true", help="Start the trace-replaying mock upstream and server automatically")
+    parser.add_argument("--mock-port", type=int, default=8002)
+    parser.add_argument("--output", help="Write machine-readable JSON results here")
+    parser.add_argument("--baseline", help="Compare against an earlier --output file")
+    args = parser.parse_args()
+    if args.speed <= 0:
+        parser.error("--speed must be positive")
+
+    records = load_records(args.trace, args.limit)
+    print("🎞️  Custom LLM Server Traffic Replay")
+    print("=" * 40)
+    print(f"{len(records)} requests from {args.trace} at {args.speed}x")
+
+    processes = spawn_stack(args) if args.spawn else []
+    try:
+        if not wait_until_healthy(args.url):
+            print(f"❌ Server at {args.url} is not responding")
+            sys.exit(1)
+        replayed = asyncio.run(replay_records(args.url, records, args.speed, args.timeout))
+        upstream = mock_trace_stats(args.mock_port) if args.spawn else None
+    finally:
+        for process in processes:
+            process.terminate()
+        for process in processes:
+            process.wait()
+
+    report = {
+        "meta": {"timestamp": datetime.now().isoformat(), "trace": args.trace, "speed": args.speed, "url": args.url},
+        "replayed": replayed,
+        "recorded": recorded_summary(records),
+        "mock_upstream": upstream,
+    }
+    print_report(report)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\n💾 Results written to {args.output}")
+    if args.baseline:
+        compare_with_baseline(report, args.baseline)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,499 @@
+"""
+Retrieval engine for the Custom LLM Server
+Inverted-index BM25 search, dense vector search and hybrid fusion
+over knowledge base documents
+"""
+
+import hashlib
+import heapq
+import json
+import math
+import re
+import zlib
+from dataclasses import asdict, dataclass
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, Optional, Sequence, Set, Tuple, Union
+
+import numpy as np
+
+TOKEN_PATTERN = re.compile(r"[a-z0-9]+")
+
+# Words too common to say anything about relevance
+STOPWORDS = frozenset("""
+a an and are as at be but by can do does for from has have how i if in is it its
+me my of on or s so that the their there this to was we what when where which
+who why will with you your
+""".split())
+
+@dataclass
+class Document:
+    """A single searchable knowledge base entry"""
+    doc_id: str
+    title: str
+    text: str
+    source: str = "knowledge_base"
+
+    def render(self) -> str:
+        """Render the document the way it is shown to the model"""
+        return f"{self.title}: {self.text}"
+
+def tokenize(text: str) -> List[str]:
+    """Lowercase, split on non-alphanumerics and drop stopwords"""
+    return [token for token in TOKEN_PATTERN.findall(text.lower()) if token not in STOPWORDS]
+
+def document_terms(document: Document) -> Tuple[Dict[str, int], int]:
+    """Term counts and token length of a document as BM25Index indexes it"""
+    # Titles such as "return_policy" are searchable as plain words
+    tokens = tokenize(f"{document.title.replace('_', ' ')} {document.text}")
+    term_counts: Dict[str, int] = {}
+    for token in tokens:
+        term_counts[token] = term_counts.get(token, 0) + 1
+    return term_counts, len(tokens)
+
+class BM25Index:
+    """Okapi BM25 over an in-memory inverted index
+
+    Postings map each term to a list of (document position, term frequency)
+    pairs, so a query only touches documents that share a term with it.
+    """
+
+    def __init__(self, k1: float = 1.5, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.documents: List[Document] = []
+        self.doc_lengths: List[int] = []
+        self.postings: Dict[str, List[Tuple[int, int]]] = {}
+        self.total_length = 0
+        # Removed positions stay in the postings and are skipped when scoring;
+        # doc_freq counts only live documents so idf stays exact
+        self.doc_freq: Dict[str, int] = {}
+        self.removed: Set[int] = set()
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    @property
+    def live_documents(self) -> int:
+        return len(self.documents) - len(self.removed)
+
+    @property
+    def avg_doc_length(self) -> float:
+        return self.total_length / self.live_documents if self.live_documents else 0.0
+
+    def add(self, document: Document) -> int:
+        """Index a document and return its position"""
+        term_counts, length = document_terms(document)
+        return self.add_terms(document, term_counts, length)
+
+    def add_terms(self, document: Document, term_counts: Dict[str, int], length: int) -> int:
+        """Index a document whose terms were already counted, e.g. by an ingestion worker"""
+        position = len(self.documents)
+        # The document goes in before its postings, so a concurrent search never
+        # finds a posting whose position has no document yet
+        self.documents.append(document)
+        self.doc_lengths.append(length)
+        self.total_length += length
+        for term, count in term_counts.items():
+            self.postings.setdefault(term, []).append((position, count))
+            self.doc_freq[term] = self.doc_freq.get(term, 0) + 1
+        return position
+
+    def remove(self, position: int) -> bool:
+        """Drop a document from results in O(its unique terms), without touching postings lists"""
+        if position in self.removed or not 0 <= position < len(self.documents):
+            return False
+        term_counts, _ = document_terms(self.documents[position])
+        for term in term_counts:
+            self.doc_freq[term] -= 1
+        self.removed.add(position)
+        self.total_length -= self.doc_lengths[position]
+        return True
+
+    def add_documents(self, documents: Iterable[Document]) -> int:
+        """Index many documents and return how many were added"""
+        count = 0
+        for document in documents:
+            self.add(document)
+            count += 1
+        return count
+
+    def idf(self, term: str) -> float:
+        """Inverse document frequency with the usual BM25 smoothing"""
+        doc_freq = self.doc_freq.get(term, 0)
+        return math.log(1 + (self.live_documents - doc_freq + 0.5) / (doc_freq + 0.5))
+
+    def score_terms(self, query_terms: Iterable[str]) -> Dict[int, float]:
+        """Accumulate BM25 scores for every document matching a query term"""
+        scores: Dict[int, float] = {}
+        avg_length = self.avg_doc_length or 1.0
+        k1, b = self.k1, self.b
+        doc_lengths = self.doc_lengths
+        removed = self.removed
+
+        for term in set(query_terms):
+            postings = self.postings.get(term)
+            if not postings:
+                continue
+            idf = self.idf(term)
+            for position, freq in postings:
+                if removed and position in removed:
+                    continue
+                norm = k1 * (1 - b + b * doc_lengths[position] / avg_length)
+                scores[position] = scores.get(position, 0.0) + idf * freq * (k1 + 1) / (freq + norm)
+
+        return scores
+
+    def search(self, query: str, top_k: int = 5) -> List[Tuple[Document, float]]:
+        """Return the top_k documents for a query with their BM25 scores"""
+        scores = self.score_terms(tokenize(query))
+        best = heapq.nlargest(top_k, scores.items(), key=lambda item: item[1])
+        return [(self.documents[position], score) for position, score in best]
+
+class FrozenBM25Index(BM25Index):
+    """Read-only BM25 index over flat postings arrays
+
+    Postings for term i are docs[offsets[i]:offsets[i + 1]] with matching
+    freqs, so the arrays can be memory-mapped from a snapshot and shared by
+    every worker process instead of rebuilt as per-process lists.
+    """
+
+    def __init__(self, documents: Sequence[Document], terms: Union[Sequence[str], Mapping[str, int]],
+                 offsets: np.ndarray, docs: np.ndarray, freqs: np.ndarray, doc_lengths: np.ndarray,
+                 k1: float = 1.5, b: float = 0.75, total_length: Optional[int] = None):
+        super().__init__(k1, b)
+        self.documents = documents
+        # A mapping is used as is, so a snapshot can look terms up in place
+        self.term_ids = terms if isinstance(terms, Mapping) else {term: i for i, term in enumerate(terms)}
+        self.offsets = offsets
+        self.docs = docs
+        self.freqs = freqs
+        self.doc_lengths = doc_lengths
+        self.total_length = int(doc_lengths.sum()) if total_length is None else total_length
+
+    @classmethod
+    def from_index(cls, index: BM25Index) -> "FrozenBM25Index":
+        # Removed documents are dropped and the rest renumbered
+        live = [position for position in range(len(index.documents)) if position not in index.removed]
+        renumber = {position: new for new, position in enumerate(live)}
+        term_postings = {
+            term: [(renumber[position], freq) for position, freq in postings if position in renumber]
+            for term, postings in index.postings.items()
+        }
+        terms = sorted(term for term, postings in term_postings.items() if postings)
+        counts = np.fromiter((len(term_postings[term]) for term in terms), dtype=np.int64, count=len(terms))
+        pairs = [pair for term in terms for pair in term_postings[term]]
+        postings = np.array(pairs, dtype=np.int32).reshape(-1, 2)
+        return cls(
+            [index.documents[position] for position in live], terms,
+            np.concatenate(([0], np.cumsum(counts))),
+            np.ascontiguousarray(postings[:, 0]),
+            np.ascontiguousarray(postings[:, 1]),
+            np.array([index.doc_lengths[position] for position in live], dtype=np.int32),
+            index.k1, index.b,
+        )
+
+    def add_terms(self, document: Document, term_counts: Dict[str, int], length: int) -> int:
+        raise TypeError("FrozenBM25Index is read-only; build a new index and freeze it")
+
+    def remove(self, position: int) -> bool:
+        raise TypeError("FrozenBM25Index is read-only; build a new index and freeze it")
+
+    def _term_range(self, term: str) -> Tuple[int, int]:
+        term_id = self.term_ids.get(term)
+        if term_id is None:
+            return 0, 0
+        return int(self.offsets[term_id]), int(self.offsets[term_id + 1])
+
+    def idf(self, term: str) -> float:
+        start, end = self._term_range(term)
+        doc_freq = end - start
+        return math.log(1 + (len(self.documents) - doc_freq + 0.5) / (doc_freq + 0.5))
+
+    def score_terms(self, query_terms: Iterable[str]) -> Dict[int, float]:
+        """Same scores as BM25Index.score_terms, computed a posting list at a time"""
+        scores: Dict[int, float] = {}
+        avg_length = self.avg_doc_length or 1.0
+        k1, b = self.k1, self.b
+
+        for term in set(query_terms):
+            start, end = self._term_range(term)
+            if start == end:
+                continue
+            docs = self.docs[start:end]
+            freqs = self.freqs[start:end].astype(np.float64)
+            norm = k1 * (1 - b + b * self.doc_lengths[docs] / avg_length)
+            contributions = self.idf(term) * freqs * (k1 + 1) / (freqs + norm)
+            for position, value in zip(docs.tolist(), contributions.tolist()):
+                scores[position] = scores.get(position, 0.0) + value
+
+        return scores
+
+def documents_from_knowledge_base(knowledge_base: Dict[str, Any]) -> List[Document]:
+    """Turn the company_info and faq sections into indexable documents"""
+    documents = []
+    for key, value in knowledge_base.get("company_info", {}).items():
+        documents.append(Document(f"company_info:{key}", key, str(value), "company_info"))
+    for topic, answer in knowledge_base.get("faq", {}).items():
+        documents.append(Document(f"faq:{topic}", topic, answer, "faq"))
+    return documents
+
+def document_from_record(record: Dict[str, Any], default_id: Optional[str] = None) -> Document:
+    """Build a document from a JSONL-style record (see load_jsonl_documents)"""
+    if not isinstance(record, dict):
+        raise ValueError("record must be a JSON object")
+    text = record.get("text", record.get("answer"))
+    if not isinstance(text, str):
+        raise ValueError("record has no 'text' field")
+    doc_id = record.get("id", default_id)
+    if doc_id is None:
+        raise ValueError("record has no 'id' field")
+    return Document(
+        doc_id=str(doc_id),
+        title=str(record.get("title", record.get("topic", ""))),
+        text=text,
+        source=str(record.get("source", "knowledge_base")),
+    )
+
+def load_jsonl_documents(path: str) -> Iterator[Document]:
+    """Stream documents from a JSONL file
+
+    Each line is an object with a "text" (or "answer") field and optional
+    "id", "title" (or "topic") and "source" fields.
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        for line_number, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield document_from_record(json.loads(line), f"{path}:{line_number}")
+            except ValueError as e:
+                raise ValueError(f"{path}:{line_number}: {e}") from None
+
+def build_index(knowledge_base: Dict[str, Any], jsonl_path: Optional[str] = None) -> BM25Index:
+    """Build a BM25 index over the knowledge base plus an optional JSONL corpus"""
+    index = BM25Index()
+    index.add_documents(documents_from_knowledge_base(knowledge_base))
+    if jsonl_path:
+        index.add_documents(load_jsonl_documents(jsonl_path))
+    return index
+
+# Dense vector retrieval
+def embedding_text(document: Document) -> str:
+    return f"{document.title.replace('_', ' ')} {document.text}"
+
+class Embedder:
+    """Base class for text embedders used by VectorIndex"""
+    name = "base"
+    dim = 0
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        """Return a (len(texts), dim) float32 matrix of L2-normalized vectors"""
+        raise NotImplementedError
+
+class HashingEmbedder(Embedder):
+    """Feature-hashing embedder that needs no model, network or GPU
+
+    Words and character trigrams are hashed into signed buckets, so related
+    word forms ("ship", "shipping") land near each other. crc32 is used
+    instead of hash() so vectors are stable across processes.
+    """
+    name = "hashing"
+
+    def __init__(self, dim: int = 512):
+        self.dim = dim
+
+    def _features(self, text: str) -> Iterator[Tuple[str, float]]:
+        for token in tokenize(text):
+            yield token, 1.0
+            padded = f"#{token}#"
+            for i in range(len(padded) - 2):
+                yield padded[i:i + 3], 0.5
+
+    def embed(self, texts: List[str]) -> np.ndarray:
+        matrix = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for row, text in enumerate(texts):
+            for feature, weight in self._features(text):
+                h = zlib.crc32(feature.encode("utf-8"))
+                sign = 1.0 if h & 0x80000000 else -1.0
+                matrix[row, h % self.dim] += sign * weight
+        norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        return matrix / norms
+
+# Embedders selectable by name; register others (e.g. a sentence-transformers wrapper) here
+EMBEDDERS = {
+    "hashing": HashingEmbedder,
+}
+
+def get_embedder(name: str = "hashing", **kwargs) -> Embedder:
+    """Instantiate a registered embedder by name"""
+    if name not in EMBEDDERS:
+        raise ValueError(f"Unknown embedder: {name}. Available: {list(EMBEDDERS)}")
+    return EMBEDDERS[name](**kwargs)
+
+def content_hash(documents: Iterable[Document], embedder: Embedder) -> str:
+    """Fingerprint of what a saved VectorIndex depends on: the embedder and every document's fields"""
+    digest = hashlib.sha256(f"{embedder.name}\0{embedder.dim}".encode("utf-8"))
+    for document in documents:
+        for value in (document.doc_id, document.title, document.text, document.source):
+            digest.update(b"\0" + value.encode("utf-8"))
+        digest.update(b"\1")
+    return digest.hexdigest()
+
+class VectorIndex:
+    """Cosine-similarity search over a contiguous float32 embedding matrix
+
+    All documents are scored with one matrix-vector product and the top k
+    are selected with argpartition, so no per-document Python loop runs.
+    """
+
+    def __init__(self, embedder: Embedder):
+        self.embedder = embedder
+        self.documents: List[Document] = []
+        self.matrix = np.zeros((0, embedder.dim), dtype=np.float32)
+        # Set by load() from the saved metadata; None for indexes saved without one
+        self.content_hash: Optional[str] = None
+
+    def __len__(self) -> int:
+        return len(self.documents)
+
+    def add_documents(self, documents: Iterable[Document]) -> int:
+        """Embed and index documents in one batch"""
+        documents = list(documents)
+        if not documents:
+            return 0
+        return self.add_vectors(documents, self.embedder.embed([embedding_text(d) for d in documents]))
+
+    def add_vectors(self, documents: List[Document], vectors: np.ndarray) -> int:
+        """Index documents whose embeddings were already computed"""
+        matrix = np.ascontiguousarray(np.vstack([self.matrix, vectors]), dtype=np.float32)
+        # Extend documents first: a search in between sees no rows without a document
+        self.documents = list(self.documents) + list(documents)
+        self.matrix = matrix
+        return len(documents)
+
+    def remove(self, position: int) -> None:
+        """Zero a document's vector so it never scores above the result cutoff"""
+        if not self.matrix.flags.writeable:
+            # A memory-mapped index is copied on first write
+            self.matrix = np.array(self.matrix)
+        self.matrix[position] = 0.0
+
+    def score_all(self, query: str) -> np.ndarray:
+        """Cosine similarity of the query against every document"""
+        query_vector = self.embedder.embed([query])[0]
+        return self.matrix @ query_vector
+
+    def search(self, query: str, top_k: int = 5) -> List[Tuple[Document, float]]:
+        """Return the top_k most similar documents with their cosine scores"""
+        if not self.documents:
+            return []
+        scores = self.score_all(query)
+        positions = top_k_positions(scores, top_k)
+        return [(self.documents[i], float(scores[i])) for i in positions if scores[i] > 0]
+
+    def save(self, path: str) -> None:
+        """Write the matrix to <path>.npy and document metadata to <path>.json"""
+        np.save(f"{path}.npy", self.matrix)
+        metadata = {
+            "embedder": self.embedder.name,
+            "dim": self.embedder.dim,
+            "content_hash": content_hash(self.documents, self.embedder),
+            "documents": [asdict(d) for d in self.documents],
+        }
+        with open(f"{path}.json", "w", encoding="utf-8") as f:
+            json.dump(metadata, f)
+
+    @classmethod
+    def load(cls, path: str, embedder: Embedder) -> "VectorIndex":
+        """Open a saved index; the matrix is memory-mapped read-only, not copied"""
+        with open(f"{path}.json", "r", encoding="utf-8") as f:
+            metadata = json.load(f)
+        if metadata["embedder"] != embedder.name or metadata["dim"] != embedder.dim:
+            raise ValueError(
+                f"Index at {path} was built with {metadata['embedder']}/{metadata['dim']}, "
+                f"not {embedder.name}/{embedder.dim}"
+            )
+        index = cls(embedder)
+        index.documents = [Document(**d) for d in metadata["documents"]]
+        index.matrix = np.load(f"{path}.npy", mmap_mode="r")
+        index.content_hash = metadata.get("content_hash")
+        return index
+
+def top_k_positions(scores: np.ndarray, top_k: int) -> np.ndarray:
+    """Positions of the top_k scores in descending order"""
+    if top_k >= len(scores):
+        return np.argsort(-scores)
+    candidates = np.argpartition(-scores, top_k)[:top_k]
+    return candidates[np.argsort(-scores[candidates])]
+
+class HybridRetriever:
+    """Fuse BM25 and dense scores with a weighted sum of max-normalized scores
+
+    Both indexes must hold the same documents in the same order.
+    """
+
+    def __init__(self, keyword_index: BM25Index, vector_index: VectorIndex, alpha: float = 0.5):
+        if len(keyword_index) != len(vector_index):
+            raise ValueError("Keyword and vector indexes must cover the same documents")
+        self.keyword_index = keyword_index
+        self.vector_index = vector_index
+        self.alpha = alpha
+
+    def search(self, query: str, top_k: int = 5) -> List[Tuple[Document, float]]:
+        """Return the top_k documents by fused score"""
+        if not len(self.vector_index):
+            return []
+        dense = np.clip(self.vector_index.score_all(query), 0.0, None)
+        if dense.max() > 0:
+            dense = dense / dense.max()
+
+        sparse = np.zeros_like(dense)
+        keyword_scores = self.keyword_index.score_terms(tokenize(query))
+        if keyword_scores:
+            positions = np.fromiter(keyword_scores.keys(), dtype=np.int64)
+            values = np.fromiter(keyword_scores.values(), dtype=np.float32)
+            # A search running off the event loop can see documents ingested
+            # after the dense scores were computed; they join the next search
+            in_range = positions < len(dense)
+            sparse[positions[in_range]] = values[in_range] / values.max()
+
+        fused = self.alpha * dense + (1 - self.alpha) * sparse
+        positions = top_k_positions(fused, top_k)
+        documents = self.vector_index.documents
+        return [(documents[i], float(fused[i])) for i in positions if fused[i] > 0]
+
+def build_retriever(mode: str, keyword_index: BM25Index, embedder: Optional[Embedder] = None,
+                    vector_index_path: Optional[str] = None, alpha: float = 0.5,
+                    vector_index: Optional[VectorIndex] = None):
+    """Create the retriever for a RAG mode: keyword, semantic or hybrid
+
+    A vector_index that is passed in (for example from a snapshot) is used
+    as is. Otherwise, when vector_index_path is given, a saved index there
+    is memory-mapped if it was built from the same documents with the same
+    embedder; otherwise the index is built and saved to it.
+    """
+    if mode == "keyword":
+        return keyword_index
+    if mode not in ("semantic", "hybrid"):
+        raise ValueError(f"Unknown retrieval mode: {mode}")
+
+    embedder = embedder or get_embedder()
+    if vector_index is None and vector_index_path:
+        try:
+            vector_index = VectorIndex.load(vector_index_path, embedder)
+        except (FileNotFoundError, ValueError):
+            pass
+        else:
+            # Edited documents keep the count but not the hash
+            if vector_index.content_hash != content_hash(keyword_index.documents, embedder):
+                vector_index = None
+    if vector_index is None:
+        vector_index = VectorIndex(embedder)
+        vector_index.add_documents(keyword_index.documents)
+        if vector_index_path:
+            vector_index.save(vector_index_path)
+
+    if mode == "semantic":
+        return vector_index
+    return HybridRetriever(keyword_index, vector_index, alpha)
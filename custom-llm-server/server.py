@@ -1,18 +1,182 @@
-from fastapi import FastAPI, HTTPException
-from fastapi.responses import StreamingResponse
+from fastapi import FastAPI, Header, HTTPException, Request, Response
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from starlette.background import BackgroundTasks
 from pydantic import BaseModel
-from typing import List, Dict, Any, Optional, AsyncGenerator
-import openai
+from typing import List, Dict, Any, Optional, AsyncGenerator, Awaitable, Tuple, Callable, Set, Union
 import json
 import asyncio
+import dataclasses
+import hashlib
+import inspect
 import os
+import signal
+import tempfile
+import time
 from datetime import datetime
-import uvicorn
 from dotenv import load_dotenv
+from retrieval import VectorIndex, build_index, build_retriever, document_from_record, get_embedder
+from snapshot import current_snapshot_version, load_snapshot, warm_snapshot, write_snapshot
+from cache import CompletionCache, ToolCachePolicy, ToolResultCache, request_key, split_for_replay
+from coalesce import Coalescer, SharedStream
+from streaming import SSE_DONE, SSE_HEADERS, ChunkEncoder, ToolCallAccumulator, coalesce_content
+from metrics import (
+    PROMETHEUS_CONTENT_TYPE, REGISTRY, REQUESTS, STREAM_TOKENS, TOOL_SECONDS, StageTimer,
+    current_request_timings, observe_stage, record_error, server_timing_header, start_request_timings
+)
+from upstream import UpstreamClient, create_backend
+from hedging import CircuitBreaker, HedgingUpstream, Route
+from calculator import Calculator, Limits, canonical_expression
+from locations import build_location_table
+from sessions import Session, SessionStore, message_tokens
+from batch import BatchJournal, iter_jsonl, new_batch_id, prune_journals, run_batch
+from ingest import IngestJournal, Ingestor
+from profiling import LoopMonitor, ProfileStore, ProfilingMiddleware, install_task_factory
+from offload import Offloader
+from admission import AdmissionController, AdmissionRejected, Ticket
+from recording import Redactor, RecordingUpstream, TraceRecorder, TraceRecordingMiddleware
 
 # Load environment variables from .env file
 load_dotenv()
 
+# Optional JSONL corpus of extra FAQ/policy entries to index at startup
+KNOWLEDGE_BASE_JSONL = os.getenv("KNOWLEDGE_BASE_JSONL")
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", "5"))
+# Retrieval backend: "keyword" (BM25), "semantic" (dense vectors) or "hybrid"
+RAG_RETRIEVAL_MODE = os.getenv("RAG_RETRIEVAL_MODE", "keyword")
+RAG_EMBEDDER = os.getenv("RAG_EMBEDDER", "hashing")
+RAG_HYBRID_ALPHA = float(os.getenv("RAG_HYBRID_ALPHA", "0.5"))
+# Where the dense index is saved and memory-mapped from on later starts
+VECTOR_INDEX_PATH = os.getenv("VECTOR_INDEX_PATH")
+# System prompt mode: "full" pastes the whole knowledge base, "retrieved" only
+# the entries relevant to the last user message, up to RAG_CONTEXT_MAX_CHARS
+RAG_PROMPT_MODE = os.getenv("RAG_PROMPT_MODE", "full")
+RAG_CONTEXT_MAX_CHARS = int(os.getenv("RAG_CONTEXT_MAX_CHARS", "2000"))
+# Run calls to tools in TOOL_FUNCTIONS on the server instead of returning them to the client
+SERVER_SIDE_TOOLS = os.getenv("SERVER_SIDE_TOOLS", "true").lower() == "true"
+TOOL_TIMEOUT_SECONDS = float(os.getenv("TOOL_TIMEOUT_SECONDS", "10"))
+MAX_TOOL_ROUNDS = int(os.getenv("MAX_TOOL_ROUNDS", "5"))
+# Start a streamed tool call as soon as its arguments are complete JSON, while the model is still streaming
+EARLY_TOOL_EXECUTION = os.getenv("EARLY_TOOL_EXECUTION", "true").lower() == "true"
+# Tool result cache; TOOL_CACHE_TTLS overrides per-tool TTLs, e.g. "get_weather=60,calculate=0" (0 disables)
+TOOL_CACHE_ENABLED = os.getenv("TOOL_CACHE_ENABLED", "true").lower() == "true"
+TOOL_CACHE_MAX_ENTRIES = int(os.getenv("TOOL_CACHE_MAX_ENTRIES", "4096"))
+TOOL_CACHE_MAX_RESULT_BYTES = int(os.getenv("TOOL_CACHE_MAX_RESULT_BYTES", "65536"))
+TOOL_CACHE_TTLS = os.getenv("TOOL_CACHE_TTLS", "")
+# Completion cache: identical requests are answered without calling OpenAI
+COMPLETION_CACHE_ENABLED = os.getenv("COMPLETION_CACHE_ENABLED", "false").lower() == "true"
+COMPLETION_CACHE_MAX_ENTRIES = int(os.getenv("COMPLETION_CACHE_MAX_ENTRIES", "1024"))
+COMPLETION_CACHE_TTL_SECONDS = float(os.getenv("COMPLETION_CACHE_TTL_SECONDS", "3600"))
+# Collapse whitespace and ignore case in message content when building cache keys
+COMPLETION_CACHE_NORMALIZE = os.getenv("COMPLETION_CACHE_NORMALIZE", "false").lower() == "true"
+COMPLETION_CACHE_DIR = os.getenv("COMPLETION_CACHE_DIR")
+# Merge tiny content deltas into chunks of up to STREAM_COALESCE_MAX_CHARS, held at most
+# STREAM_COALESCE_MS; 0 forwards every upstream delta as-is
+STREAM_COALESCE_MS = float(os.getenv("STREAM_COALESCE_MS", "0"))
+STREAM_COALESCE_MAX_CHARS = int(os.getenv("STREAM_COALESCE_MAX_CHARS", "64"))
+# Share one upstream call between concurrent identical requests
+COALESCE_REQUESTS = os.getenv("COALESCE_REQUESTS", "true").lower() == "true"
+# Upstream LLM client: "openai" or "stub" (offline canned replies for load testing)
+LLM_BACKEND = os.getenv("LLM_BACKEND", "openai")
+UPSTREAM_POOL_SIZE = int(os.getenv("UPSTREAM_POOL_SIZE", "100"))
+UPSTREAM_MAX_CONCURRENCY = int(os.getenv("UPSTREAM_MAX_CONCURRENCY", "64"))
+UPSTREAM_MAX_RETRIES = int(os.getenv("UPSTREAM_MAX_RETRIES", "3"))
+UPSTREAM_BACKOFF_BASE_SECONDS = float(os.getenv("UPSTREAM_BACKOFF_BASE_SECONDS", "0.5"))
+UPSTREAM_BACKOFF_MAX_SECONDS = float(os.getenv("UPSTREAM_BACKOFF_MAX_SECONDS", "8"))
+STUB_TTFT_SECONDS = float(os.getenv("STUB_TTFT_SECONDS", "0.05"))
+STUB_TOKENS_PER_SECOND = float(os.getenv("STUB_TOKENS_PER_SECOND", "50"))
+STUB_ERROR_RATE = float(os.getenv("STUB_ERROR_RATE", "0"))
+# Share of stub calls whose first token takes STUB_SLOW_TTFT_SECONDS, to test tail-latency handling
+STUB_SLOW_RATE = float(os.getenv("STUB_SLOW_RATE", "0"))
+STUB_SLOW_TTFT_SECONDS = float(os.getenv("STUB_SLOW_TTFT_SECONDS", "3"))
+# Optional second backend that takes over when the primary fails or is slow: "openai" or "stub"
+FALLBACK_LLM_BACKEND = os.getenv("FALLBACK_LLM_BACKEND")
+# Model sent to the fallback backend; the requested model when unset
+FALLBACK_MODEL = os.getenv("FALLBACK_MODEL")
+FALLBACK_OPENAI_API_BASE = os.getenv("FALLBACK_OPENAI_API_BASE")
+FALLBACK_OPENAI_API_KEY = os.getenv("FALLBACK_OPENAI_API_KEY")
+# Send a second upstream request when the first token is later than the HEDGE_PERCENTILE TTFT
+HEDGE_ENABLED = os.getenv("HEDGE_ENABLED", "false").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "95"))
+HEDGE_MIN_DELAY_SECONDS = float(os.getenv("HEDGE_MIN_DELAY_SECONDS", "0.05"))
+# Hedge delay until HEDGE_MIN_SAMPLES first tokens have been timed
+HEDGE_DEFAULT_DELAY_SECONDS = float(os.getenv("HEDGE_DEFAULT_DELAY_SECONDS", "1"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+# Most hedges per request, so a slow upstream does not get its load doubled
+HEDGE_MAX_RATIO = float(os.getenv("HEDGE_MAX_RATIO", "0.1"))
+# Consecutive failures that open a backend's circuit breaker (0 disables), and how long it stays open
+CIRCUIT_BREAKER_FAILURES = int(os.getenv("CIRCUIT_BREAKER_FAILURES", "5"))
+CIRCUIT_BREAKER_RESET_SECONDS = float(os.getenv("CIRCUIT_BREAKER_RESET_SECONDS", "30"))
+# Calculator limits; programs with ** or more than CALC_INLINE_MAX_STEPS steps run in a process pool
+CALC_MAX_EXPONENT = int(os.getenv("CALC_MAX_EXPONENT", "1000"))
+CALC_MAX_MAGNITUDE = float(os.getenv("CALC_MAX_MAGNITUDE", "1e100"))
+CALC_MAX_STEPS = int(os.getenv("CALC_MAX_STEPS", "500"))
+CALC_INLINE_MAX_STEPS = int(os.getenv("CALC_INLINE_MAX_STEPS", "64"))
+CALC_TIMEOUT_SECONDS = float(os.getenv("CALC_TIMEOUT_SECONDS", "1"))
+CALC_WORKERS = int(os.getenv("CALC_WORKERS", "2"))
+# Optional CSV of cities (name,country,population,temp,condition,humidity,aliases) for get_weather
+WEATHER_LOCATIONS_CSV = os.getenv("WEATHER_LOCATIONS_CSV")
+WEATHER_SUGGESTIONS = int(os.getenv("WEATHER_SUGGESTIONS", "5"))
+# Directory of memory-mapped knowledge snapshots shared by all worker processes
+KNOWLEDGE_SNAPSHOT_DIR = os.getenv("KNOWLEDGE_SNAPSHOT_DIR")
+KNOWLEDGE_SNAPSHOT_POLL_SECONDS = float(os.getenv("KNOWLEDGE_SNAPSHOT_POLL_SECONDS", "2"))
+# Read a snapshot's pages in before /ready reports ready and before a new version is swapped in
+KNOWLEDGE_WARM_ON_START = os.getenv("KNOWLEDGE_WARM_ON_START", "true").lower() == "true"
+# When set, /admin endpoints require this value in the X-Admin-Key header
+ADMIN_API_KEY = os.getenv("ADMIN_API_KEY")
+# Requests with a session_id only send new turns; the server keeps the history
+SESSION_MAX_SESSIONS = int(os.getenv("SESSION_MAX_SESSIONS", "10000"))
+SESSION_IDLE_TTL_SECONDS = float(os.getenv("SESSION_IDLE_TTL_SECONDS", "1800"))
+# Prompt token budget per request, RAG system prompt included
+SESSION_CONTEXT_TOKENS = int(os.getenv("SESSION_CONTEXT_TOKENS", "3000"))
+# "summarize" folds turns that no longer fit into a running summary, "trim" drops them
+SESSION_OVERFLOW = os.getenv("SESSION_OVERFLOW", "summarize")
+SESSION_SUMMARY_TOKENS = int(os.getenv("SESSION_SUMMARY_TOKENS", "300"))
+# Directory shared by worker processes so a session's turns may land on any of them; set by start_server.py --workers
+SESSION_DIR = os.getenv("SESSION_DIR")
+# Batch endpoint: default and maximum records in flight, and where results are journaled for resume
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+BATCH_MAX_CONCURRENCY = int(os.getenv("BATCH_MAX_CONCURRENCY", "64"))
+BATCH_JOURNAL_DIR = os.getenv("BATCH_JOURNAL_DIR", os.path.join(tempfile.gettempdir(), "custom-llm-batches"))
+BATCH_JOURNAL_TTL_SECONDS = float(os.getenv("BATCH_JOURNAL_TTL_SECONDS", "86400"))
+# Document ingestion: chunk size and overlap in characters, and the pool ("thread" or
+# "process") that chunks, tokenizes and embeds documents before they are indexed
+INGEST_CHUNK_CHARS = int(os.getenv("INGEST_CHUNK_CHARS", "1000"))
+INGEST_CHUNK_OVERLAP = int(os.getenv("INGEST_CHUNK_OVERLAP", "100"))
+INGEST_EXECUTOR = os.getenv("INGEST_EXECUTOR", "thread")
+INGEST_WORKERS = int(os.getenv("INGEST_WORKERS", "2"))
+# Ingested documents are replayed whenever the indexes are rebuilt. They are kept in
+# memory, so a reload keeps them; set a path to also journal them there and keep them across restarts
+INGEST_JOURNAL_PATH = os.getenv("INGEST_JOURNAL_PATH", "")
+# Requests sent with X-Profile: 1, or selected with POST /admin/profiling, are profiled
+# with cProfile; the newest PROFILE_MAX_STORED profiles are kept for download
+PROFILE_MAX_STORED = int(os.getenv("PROFILE_MAX_STORED", "50"))
+# Event-loop lag sampling interval (0 disables the monitor) and the lag recorded as a stall
+LOOP_MONITOR_INTERVAL_SECONDS = float(os.getenv("LOOP_MONITOR_INTERVAL_SECONDS", "0.05"))
+LOOP_STALL_THRESHOLD_SECONDS = float(os.getenv("LOOP_STALL_THRESHOLD_SECONDS", "0.1"))
+# Where heavy request preparation runs: "thread" (a worker pool) or "off" (always on the event loop)
+OFFLOAD_MODE = os.getenv("OFFLOAD_MODE", "thread")
+OFFLOAD_WORKERS = int(os.getenv("OFFLOAD_WORKERS", "4"))
+# Requests with at least this many characters of messages are converted and keyed off the event loop
+OFFLOAD_MIN_CHARS = int(os.getenv("OFFLOAD_MIN_CHARS", "16384"))
+# In retrieved prompt mode, knowledge bases with at least this many entries are searched off the event loop
+OFFLOAD_MIN_DOCUMENTS = int(os.getenv("OFFLOAD_MIN_DOCUMENTS", "5000"))
+# Completions served at once before others queue for admission; 0 disables admission control
+ADMISSION_MAX_ACTIVE = int(os.getenv("ADMISSION_MAX_ACTIVE", "64"))
+# Queued requests beyond these limits get an immediate 429
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "256"))
+ADMISSION_MAX_QUEUE_PER_CLIENT = int(os.getenv("ADMISSION_MAX_QUEUE_PER_CLIENT", "32"))
+# How long a request may wait for admission before it gets a 429, per priority class
+ADMISSION_INTERACTIVE_TIMEOUT_SECONDS = float(os.getenv("ADMISSION_INTERACTIVE_TIMEOUT_SECONDS", "10"))
+ADMISSION_BATCH_TIMEOUT_SECONDS = float(os.getenv("ADMISSION_BATCH_TIMEOUT_SECONDS", "120"))
+# Header naming the client for fair queuing; without it the API key, then the client address, is used
+ADMISSION_CLIENT_HEADER = os.getenv("ADMISSION_CLIENT_HEADER", "X-Client-Id")
+# Record /chat/completions requests and upstream chunks to this trace for replay.py; "{pid}" becomes the worker's pid
+TRACE_RECORD_PATH = os.getenv("TRACE_RECORD_PATH")
+# Share of requests recorded
+TRACE_SAMPLE_RATE = float(os.getenv("TRACE_SAMPLE_RATE", "1"))
+# "patterns" removes emails, numbers and keys, "all" also masks all message text, "none" keeps everything
+TRACE_REDACT = os.getenv("TRACE_REDACT", "patterns")
+
 # Simple in-memory RAG knowledge base
 KNOWLEDGE_BASE = {
     "company_info": {
@@ -30,15 +194,209 @@ KNOWLEDGE_BASE = {
         "warranty": "All products come with 1-year warranty and lifetime support."
     },
     "weather_locations": {
-        "new_york": {"temp": 22, "condition": "Sunny", "humidity": 60},
-        "london": {"temp": 15, "condition": "Rainy", "humidity": 85},
-        "tokyo": {"temp": 25, "condition": "Cloudy", "humidity": 70},
-        "san_francisco": {"temp": 18, "condition": "Foggy", "humidity": 90}
+        "new_york": {"temp": 22, "condition": "Sunny", "humidity": 60, "country": "US", "aliases": ["NYC", "New York City"]},
+        "london": {"temp": 15, "condition": "Rainy", "humidity": 85, "country": "GB"},
+        "tokyo": {"temp": 25, "condition": "Cloudy", "humidity": 70, "country": "JP"},
+        "san_francisco": {"temp": 18, "condition": "Foggy", "humidity": 90, "country": "US", "aliases": ["SF"]}
     }
 }
 
+# Inverted index over company_info, faq and any bulk-loaded documents
+KNOWLEDGE_INDEX = None
+KNOWLEDGE_RETRIEVER = None
+# Bumped whenever the knowledge base changes; cached prompts are keyed on it.
+# With KNOWLEDGE_SNAPSHOT_DIR it is the snapshot version, the same in every worker.
+KNOWLEDGE_BASE_VERSION = 0
+# False while a freshly mapped snapshot has not been read in yet; reported by /ready
+KNOWLEDGE_WARM = False
+# Where the knowledge indexes came from and how long loading and warming took, for /ready
+STARTUP_STATS: Dict[str, Any] = {}
+
+# Documents added, replaced or deleted through ingestion since the knowledge base was loaded
+INGEST_JOURNAL = IngestJournal(INGEST_JOURNAL_PATH or None)
+
+def knowledge_embedder():
+    return get_embedder(RAG_EMBEDDER) if RAG_RETRIEVAL_MODE != "keyword" else None
+
+def build_knowledge():
+    """Build the keyword index and retriever from KNOWLEDGE_BASE and the JSONL corpus, plus ingested documents"""
+    index = build_index(KNOWLEDGE_BASE, KNOWLEDGE_BASE_JSONL)
+    retriever = build_retriever(
+        RAG_RETRIEVAL_MODE,
+        index,
+        embedder=knowledge_embedder(),
+        vector_index_path=VECTOR_INDEX_PATH,
+        alpha=RAG_HYBRID_ALPHA,
+    )
+    INGEST_JOURNAL.replay(index, knowledge_vector_index(retriever), INGEST_CHUNK_CHARS, INGEST_CHUNK_OVERLAP)
+    return index, retriever
+
+def install_knowledge(index, retriever, version: int):
+    """Swap in new indexes; requests already past retrieval keep what they used"""
+    global KNOWLEDGE_INDEX, KNOWLEDGE_RETRIEVER, KNOWLEDGE_BASE_VERSION
+    KNOWLEDGE_INDEX, KNOWLEDGE_RETRIEVER, KNOWLEDGE_BASE_VERSION = index, retriever, version
+
+def knowledge_vector_index(retriever) -> Optional[VectorIndex]:
+    """The dense index behind a retriever, if it has one"""
+    return getattr(retriever, "vector_index", retriever if isinstance(retriever, VectorIndex) else None)
+
+def refresh_knowledge_base():
+    """Rebuild the retrieval indexes and invalidate cached RAG prompts"""
+    index, retriever = build_knowledge()
+    install_knowledge(index, retriever, KNOWLEDGE_BASE_VERSION + 1)
+
+def load_knowledge_snapshot(version: Optional[int] = None, warm: bool = False):
+    """Memory-map a published snapshot and build the retriever on top of it"""
+    snapshot = load_snapshot(KNOWLEDGE_SNAPSHOT_DIR, version, embedder=knowledge_embedder())
+    if warm:
+        warm_snapshot(snapshot)
+    retriever = build_retriever(
+        RAG_RETRIEVAL_MODE,
+        snapshot.keyword_index,
+        embedder=knowledge_embedder(),
+        alpha=RAG_HYBRID_ALPHA,
+        vector_index=snapshot.vector_index,
+    )
+    return snapshot.keyword_index, retriever, snapshot.version
+
+def publish_knowledge_snapshot() -> int:
+    """Rebuild the indexes and publish them as a new snapshot version
+
+    Workers switch to it on their next poll of the CURRENT pointer.
+    """
+    index, retriever = build_knowledge()
+    return write_snapshot(KNOWLEDGE_SNAPSHOT_DIR, index, knowledge_vector_index(retriever))
+
+def initialize_knowledge_base():
+    """Build the indexes, or map the current snapshot, which takes the same few milliseconds at any size
+
+    A mapped snapshot serves requests straight away but reads pages from
+    disk on first use until warm_knowledge_base has run.
+    """
+    global KNOWLEDGE_WARM
+    started = time.perf_counter()
+    if not KNOWLEDGE_SNAPSHOT_DIR:
+        refresh_knowledge_base()
+        STARTUP_STATS["knowledge_source"] = "built"
+        KNOWLEDGE_WARM = True
+    else:
+        version = current_snapshot_version(KNOWLEDGE_SNAPSHOT_DIR)
+        STARTUP_STATS["knowledge_source"] = "snapshot" if version is not None else "built_and_published"
+        if version is None:
+            version = publish_knowledge_snapshot()
+        install_knowledge(*load_knowledge_snapshot(version))
+        KNOWLEDGE_WARM = not KNOWLEDGE_WARM_ON_START
+    STARTUP_STATS["knowledge_load_ms"] = round((time.perf_counter() - started) * 1000, 2)
+
+initialize_knowledge_base()
+
+def bump_knowledge_version():
+    """Invalidate cached RAG prompts and completions after documents were ingested"""
+    install_knowledge(KNOWLEDGE_INDEX, KNOWLEDGE_RETRIEVER, KNOWLEDGE_BASE_VERSION + 1)
+
+# Applies document uploads and deletions to the live indexes in the background
+INGESTOR = Ingestor(
+    lambda: (KNOWLEDGE_INDEX, knowledge_vector_index(KNOWLEDGE_RETRIEVER)),
+    bump_knowledge_version,
+    chunk_chars=INGEST_CHUNK_CHARS,
+    chunk_overlap=INGEST_CHUNK_OVERLAP,
+    executor=INGEST_EXECUTOR,
+    workers=INGEST_WORKERS,
+    on_error=lambda e: record_error("ingest"),
+    journal=INGEST_JOURNAL,
+)
+
+COMPLETION_CACHE = CompletionCache(
+    max_entries=COMPLETION_CACHE_MAX_ENTRIES,
+    ttl_seconds=COMPLETION_CACHE_TTL_SECONDS,
+    normalize=COMPLETION_CACHE_NORMALIZE,
+    disk_dir=COMPLETION_CACHE_DIR,
+) if COMPLETION_CACHE_ENABLED else None
+
+def build_upstream_backend(name: str, api_key: Optional[str] = None, api_base: Optional[str] = None):
+    """Create the configured upstream backend"""
+    if name == "openai":
+        return create_backend(
+            "openai",
+            api_key=api_key or os.getenv("OPENAI_API_KEY"),
+            api_base=api_base or os.getenv("OPENAI_API_BASE"),
+            pool_size=UPSTREAM_POOL_SIZE,
+        )
+    if name == "stub":
+        return create_backend(
+            "stub",
+            time_to_first_token=STUB_TTFT_SECONDS,
+            tokens_per_second=STUB_TOKENS_PER_SECOND,
+            error_rate=STUB_ERROR_RATE,
+            slow_rate=STUB_SLOW_RATE,
+            slow_time_to_first_token=STUB_SLOW_TTFT_SECONDS,
+        )
+    return create_backend(name)
+
+def build_upstream_client(backend) -> UpstreamClient:
+    return UpstreamClient(
+        backend,
+        max_concurrency=UPSTREAM_MAX_CONCURRENCY,
+        max_retries=UPSTREAM_MAX_RETRIES,
+        backoff_base=UPSTREAM_BACKOFF_BASE_SECONDS,
+        backoff_max=UPSTREAM_BACKOFF_MAX_SECONDS,
+    )
+
+def build_upstream():
+    """The primary client, wrapped for hedging and failover when either is configured"""
+    primary = build_upstream_client(build_upstream_backend(LLM_BACKEND))
+    if not FALLBACK_LLM_BACKEND and not HEDGE_ENABLED:
+        return primary
+    routes = [Route(LLM_BACKEND, primary, breaker=CircuitBreaker(CIRCUIT_BREAKER_FAILURES, CIRCUIT_BREAKER_RESET_SECONDS))]
+    if FALLBACK_LLM_BACKEND:
+        fallback = build_upstream_client(build_upstream_backend(
+            FALLBACK_LLM_BACKEND, api_key=FALLBACK_OPENAI_API_KEY, api_base=FALLBACK_OPENAI_API_BASE
+        ))
+        routes.append(Route(
+            f"fallback:{FALLBACK_LLM_BACKEND}", fallback, model=FALLBACK_MODEL,
+            breaker=CircuitBreaker(CIRCUIT_BREAKER_FAILURES, CIRCUIT_BREAKER_RESET_SECONDS),
+        ))
+    return HedgingUpstream(
+        routes,
+        hedging=HEDGE_ENABLED,
+        hedge_percentile=HEDGE_PERCENTILE,
+        min_hedge_delay=HEDGE_MIN_DELAY_SECONDS,
+        default_hedge_delay=HEDGE_DEFAULT_DELAY_SECONDS,
+        min_samples=HEDGE_MIN_SAMPLES,
+        max_hedge_ratio=HEDGE_MAX_RATIO,
+    )
+
+TRACE_REDACTOR = Redactor(TRACE_REDACT)
+TRACE_RECORDER = TraceRecorder(TRACE_RECORD_PATH, TRACE_REDACTOR, TRACE_SAMPLE_RATE) if TRACE_RECORD_PATH else None
+UPSTREAM = RecordingUpstream(build_upstream(), TRACE_REDACTOR) if TRACE_RECORDER else build_upstream()
+
+COALESCER = Coalescer() if COALESCE_REQUESTS else None
+SESSIONS = SessionStore(
+    max_sessions=SESSION_MAX_SESSIONS,
+    idle_ttl_seconds=SESSION_IDLE_TTL_SECONDS,
+    context_tokens=SESSION_CONTEXT_TOKENS,
+    summary_tokens=SESSION_SUMMARY_TOKENS,
+    overflow=SESSION_OVERFLOW,
+    directory=SESSION_DIR,
+)
+OFFLOADER = Offloader(mode=OFFLOAD_MODE, workers=OFFLOAD_WORKERS)
+# Interactive requests are always admitted before batch ones
+ADMISSION = AdmissionController(
+    max_active=ADMISSION_MAX_ACTIVE,
+    max_queue=ADMISSION_MAX_QUEUE,
+    max_queue_per_client=ADMISSION_MAX_QUEUE_PER_CLIENT,
+    queue_timeouts={"interactive": ADMISSION_INTERACTIVE_TIMEOUT_SECONDS, "batch": ADMISSION_BATCH_TIMEOUT_SECONDS},
+    priorities=("interactive", "batch"),
+) if ADMISSION_MAX_ACTIVE > 0 else None
+
 app = FastAPI(title="Custom LLM Server with RAG", version="1.0.0")
 
+PROFILES = ProfileStore(max_profiles=PROFILE_MAX_STORED)
+app.add_middleware(ProfilingMiddleware, store=PROFILES, admin_key=ADMIN_API_KEY)
+if TRACE_RECORDER:
+    app.add_middleware(TraceRecordingMiddleware, recorder=TRACE_RECORDER)
+LOOP_MONITOR = LoopMonitor(interval=LOOP_MONITOR_INTERVAL_SECONDS, stall_threshold=LOOP_STALL_THRESHOLD_SECONDS)
+
 # Pydantic models for OpenAI compatibility
 class Message(BaseModel):
     role: str
@@ -55,6 +413,11 @@ class ChatCompletionRequest(BaseModel):
     stream: bool = False
     temperature: float = 0.7
     max_tokens: Optional[int] = None
+    session_id: Optional[str] = None
+
+class DocumentsRequest(BaseModel):
+    # JSONL-style records: "id", "text" and optional "title" and "source"
+    documents: List[Dict[str, Any]]
 
 class ToolCall(BaseModel):
     id: str
@@ -69,51 +432,54 @@ class ChatCompletionResponse(BaseModel):
     choices: List[Dict[str, Any]]
 
 # RAG Functions
-def search_knowledge_base(query: str) -> str:
+def search_knowledge_base(query: str, top_k: int = RAG_TOP_K) -> str:
     """Search the knowledge base for relevant information"""
-    query_lower = query.lower()
-    relevant_info = []
-    
-    # Search company info
-    for key, value in KNOWLEDGE_BASE["company_info"].items():
-        if any(word in query_lower for word in [key, str(value).lower()]):
-            relevant_info.append(f"{key}: {value}")
-    
-    # Search FAQ
-    for topic, answer in KNOWLEDGE_BASE["faq"].items():
-        if topic in query_lower or any(word in query_lower for word in answer.lower().split()):
-            relevant_info.append(f"{topic}: {answer}")
+    results = KNOWLEDGE_RETRIEVER.search(query, top_k=top_k)
+    relevant_info = [document.render() for document, _ in results]
     
     return "\n".join(relevant_info) if relevant_info else "No relevant information found in knowledge base."
 
-# Tool Functions
-async def get_weather(location: str, unit: str = "celsius") -> Dict[str, Any]:
-    """Get weather information for a location"""
-    location_key = location.lower().replace(" ", "_").replace(",", "")
-    
-    weather_data = KNOWLEDGE_BASE["weather_locations"].get(location_key)
-    if not weather_data:
+# Columnar city table behind get_weather: the built-in locations plus WEATHER_LOCATIONS_CSV
+WEATHER_LOCATIONS = build_location_table(KNOWLEDGE_BASE["weather_locations"], WEATHER_LOCATIONS_CSV)
+
+def weather_report(location: str, row: Optional[int], suggestions: Tuple[int, ...], unit: str) -> Dict[str, Any]:
+    """Format one location lookup as a get_weather result"""
+    if row is None:
         return {
             "location": location,
             "error": "Weather data not available for this location",
-            "available_locations": list(KNOWLEDGE_BASE["weather_locations"].keys())
+            "did_you_mean": [WEATHER_LOCATIONS.display_name(r) for r in suggestions]
         }
     
+    weather_data = WEATHER_LOCATIONS.record(row)
     temp = weather_data["temp"]
     if unit.lower() == "fahrenheit":
         temp = round((temp * 9/5) + 32)
         unit_symbol = "°F"
     else:
+        temp = int(temp) if temp.is_integer() else temp
         unit_symbol = "°C"
     
     return {
         "location": location,
+        "resolved_location": WEATHER_LOCATIONS.display_name(row),
         "temperature": f"{temp}{unit_symbol}",
         "condition": weather_data["condition"],
         "humidity": f"{weather_data['humidity']}%",
         "timestamp": datetime.now().isoformat()
     }
 
+# Tool Functions
+async def get_weather(location: str, unit: str = "celsius") -> Dict[str, Any]:
+    """Get weather information for a location"""
+    match = WEATHER_LOCATIONS.lookup(location, suggestions=WEATHER_SUGGESTIONS)
+    return weather_report(location, match.row, match.suggestions, unit)
+
+async def get_weather_batch(locations: List[str], unit: str = "celsius") -> Dict[str, Any]:
+    """Get weather information for several locations in one call"""
+    matches = WEATHER_LOCATIONS.lookup_many(locations, suggestions=WEATHER_SUGGESTIONS)
+    return {"results": [weather_report(match.query, match.row, match.suggestions, unit) for match in matches]}
+
 async def search_company_info(query: str) -> Dict[str, Any]:
     """Search company information using RAG"""
     relevant_info = search_knowledge_base(query)
@@ -123,56 +489,156 @@ async def search_company_info(query: str) -> Dict[str, Any]:
         "source": "Company Knowledge Base"
     }
 
+CALCULATOR = Calculator(
+    Limits(max_exponent=CALC_MAX_EXPONENT, max_magnitude=CALC_MAX_MAGNITUDE, max_steps=CALC_MAX_STEPS),
+    timeout=CALC_TIMEOUT_SECONDS,
+    max_workers=CALC_WORKERS,
+    inline_max_steps=CALC_INLINE_MAX_STEPS,
+)
+
 async def calculate(expression: str) -> Dict[str, Any]:
     """Perform mathematical calculations"""
-    try:
-        # Simple calculator - only allow basic operations for security
-        sanitized = ''.join(c for c in expression if c in '0123456789+-*/.() ')
-        result = eval(sanitized)
-        return {
-            "expression": expression,
-            "result": result,
-            "success": True
-        }
-    except Exception as e:
-        return {
-            "expression": expression,
-            "error": str(e),
-            "success": False
-        }
+    return await CALCULATOR.calculate(expression)
+
+async def calculate_batch(expressions: List[str]) -> Dict[str, Any]:
+    """Perform many mathematical calculations in one call"""
+    results = await CALCULATOR.calculate_batch(expressions)
+    return {
+        "results": results,
+        "success": all(result["success"] for result in results)
+    }
 
 # Tool execution mapping
 TOOL_FUNCTIONS = {
     "get_weather": get_weather,
+    "get_weather_batch": get_weather_batch,
     "search_company_info": search_company_info,
-    "calculate": calculate
+    "calculate": calculate,
+    "calculate_batch": calculate_batch
 }
 
-async def execute_tool_call(tool_call: Dict[str, Any]) -> Dict[str, Any]:
+def canonical_location(location: Any) -> Any:
+    # Lookups ignore case and spacing but not commas, which separate a country
+    return " ".join(location.split()).lower() if isinstance(location, str) else location
+
+def canonical_unit(unit: Any) -> Any:
+    return unit.lower() if isinstance(unit, str) else unit
+
+def refresh_weather_report(report: Dict[str, Any], location: Any) -> Dict[str, Any]:
+    """A cached report as this call would have produced it: its own spelling and the current time"""
+    if "timestamp" in report:
+        report = {**report, "timestamp": datetime.now().isoformat()}
+    return {**report, "location": location}
+
+def refresh_weather_batch(result: Dict[str, Any], args: Dict[str, Any]) -> Dict[str, Any]:
+    return {"results": [refresh_weather_report(report, location)
+                        for report, location in zip(result["results"], args["locations"])]}
+
+# Cache lifetime of each tool's results and how their arguments are canonicalized;
+# tools missing here are never cached. Hits are refreshed so results echo the
+# current caller's arguments, not those of the call that filled the cache
+TOOL_CACHE_POLICIES = {
+    # Weather readings change over the day
+    "get_weather": ToolCachePolicy(
+        300,
+        lambda args: {**args, "location": canonical_location(args["location"]), "unit": canonical_unit(args["unit"])},
+        refresh=lambda result, args: refresh_weather_report(result, args["location"]),
+    ),
+    "get_weather_batch": ToolCachePolicy(
+        300,
+        lambda args: {
+            **args,
+            "locations": [canonical_location(location) for location in args["locations"]]
+            if isinstance(args["locations"], list) else args["locations"],
+            "unit": canonical_unit(args["unit"]),
+        },
+        refresh=refresh_weather_batch,
+    ),
+    # Results depend on the knowledge base, so its version is part of the key
+    "search_company_info": ToolCachePolicy(
+        3600,
+        lambda args: {**args, "query": " ".join(args["query"].split()).lower()
+                      if isinstance(args["query"], str) else args["query"]},
+        version=lambda: KNOWLEDGE_BASE_VERSION,
+        refresh=lambda result, args: {**result, "query": args["query"]},
+    ),
+    "calculate": ToolCachePolicy(
+        86400,
+        lambda args: {**args, "expression": canonical_expression(args["expression"])
+                      if isinstance(args["expression"], str) else args["expression"]},
+    ),
+    "calculate_batch": ToolCachePolicy(
+        86400,
+        lambda args: {
+            **args,
+            "expressions": [canonical_expression(e) if isinstance(e, str) else e for e in args["expressions"]]
+            if isinstance(args["expressions"], list) else args["expressions"],
+        },
+    ),
+}
+
+def apply_tool_cache_ttls(policies: Dict[str, ToolCachePolicy], spec: str) -> Dict[str, ToolCachePolicy]:
+    """Override policy TTLs from a "tool=seconds,..." string"""
+    policies = dict(policies)
+    for item in spec.split(","):
+        name, _, seconds = item.partition("=")
+        if name.strip() in policies:
+            policies[name.strip()] = dataclasses.replace(policies[name.strip()], ttl_seconds=float(seconds))
+    return policies
+
+TOOL_CACHE = ToolResultCache(
+    apply_tool_cache_ttls(TOOL_CACHE_POLICIES, TOOL_CACHE_TTLS),
+    max_entries=TOOL_CACHE_MAX_ENTRIES,
+    max_result_bytes=TOOL_CACHE_MAX_RESULT_BYTES,
+) if TOOL_CACHE_ENABLED else None
+
+async def execute_tool_call(tool_call: Dict[str, Any], timeout: float = TOOL_TIMEOUT_SECONDS) -> Dict[str, Any]:
     """Execute a tool call and return the result"""
     function_name = tool_call["function"]["name"]
     function_args = tool_call["function"]["arguments"]
     
-    if isinstance(function_args, str):
-        function_args = json.loads(function_args)
-    
     if function_name in TOOL_FUNCTIONS:
+        started = time.perf_counter()
         try:
-            result = await TOOL_FUNCTIONS[function_name](**function_args)
+            function = TOOL_FUNCTIONS[function_name]
+            if TOOL_CACHE is not None:
+                content, cache_keys, function_args = TOOL_CACHE.lookup(function_name, function, function_args)
+                if content is not None:
+                    return {
+                        "tool_call_id": tool_call["id"],
+                        "role": "tool",
+                        "name": function_name,
+                        "content": content
+                    }
+            elif isinstance(function_args, str):
+                function_args = json.loads(function_args or "{}")
+            result = await asyncio.wait_for(function(**function_args), timeout)
+            return {
+                "tool_call_id": tool_call["id"],
+                "role": "tool",
+                "name": function_name,
+                "content": TOOL_CACHE.store(function_name, cache_keys, result) if TOOL_CACHE is not None else json.dumps(result)
+            }
+        except asyncio.TimeoutError:
+            record_error("tool_timeout")
             return {
                 "tool_call_id": tool_call["id"],
                 "role": "tool",
                 "name": function_name,
-                "content": json.dumps(result)
+                "content": json.dumps({"error": f"Tool timed out after {timeout}s", "success": False})
             }
         except Exception as e:
+            record_error("tool_error")
             return {
                 "tool_call_id": tool_call["id"],
                 "role": "tool", 
                 "name": function_name,
                 "content": json.dumps({"error": str(e), "success": False})
             }
+        finally:
+            TOOL_SECONDS.observe(time.perf_counter() - started, function_name)
     else:
+        record_error("unknown_tool")
         return {
             "tool_call_id": tool_call["id"],
             "role": "tool",
@@ -180,102 +646,879 @@ async def execute_tool_call(tool_call: Dict[str, Any]) -> Dict[str, Any]:
             "content": json.dumps({"error": f"Unknown function: {function_name}", "success": False})
         }
 
-def enhance_messages_with_rag(messages: List[Message]) -> List[Message]:
-    """Enhance messages with RAG context"""
-    enhanced_messages = []
-    
-    # Add system message with RAG context
-    rag_context = f"""
-You are a helpful AI assistant with access to a company knowledge base and external tools.
+async def timed_tool_call(tool_call: Dict[str, Any], round_number: int,
+                          early: bool = False) -> Tuple[Dict[str, Any], Dict[str, Any]]:
+    """Execute a tool call and return (tool message, execution report)"""
+    started = time.perf_counter()
+    result = await execute_tool_call(tool_call)
+    report = {
+        "id": tool_call["id"],
+        "name": tool_call["function"]["name"],
+        "round": round_number,
+        "duration_ms": round((time.perf_counter() - started) * 1000, 2),
+    }
+    if early:
+        report["started_early"] = True
+    return result, report
 
-Company Information:
-{json.dumps(KNOWLEDGE_BASE['company_info'], indent=2)}
+# Tool calls started while the model was still streaming: call id -> (arguments it was started with, task)
+EarlyToolCalls = Dict[str, Tuple[str, "asyncio.Task"]]
 
-FAQ Information:
-{json.dumps(KNOWLEDGE_BASE['faq'], indent=2)}
+def start_tool_call_early(early_calls: EarlyToolCalls, tool_call: Dict[str, Any], round_number: int) -> None:
+    call = {**tool_call, "function": dict(tool_call["function"])}
+    task = asyncio.ensure_future(timed_tool_call(call, round_number, early=True))
+    early_calls[call["id"]] = (call["function"]["arguments"], task)
+
+def cancel_early_tool_calls(early_calls: EarlyToolCalls) -> None:
+    for _, task in early_calls.values():
+        task.cancel()
+    early_calls.clear()
+
+async def run_tool_calls(tool_calls: List[Dict[str, Any]], round_number: int,
+                         early_calls: Optional[EarlyToolCalls] = None) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """Run independent tool calls concurrently, returning tool messages and execution reports
+
+    Calls in early_calls are already running and are awaited rather than
+    started again, unless their arguments changed after they were started.
+    """
+    early_calls = early_calls if early_calls is not None else {}
+
+    def outcome(call: Dict[str, Any]) -> Awaitable[Tuple[Dict[str, Any], Dict[str, Any]]]:
+        arguments, task = early_calls.pop(call["id"], (None, None))
+        if task is not None and arguments == call["function"]["arguments"]:
+            return task
+        if task is not None:
+            task.cancel()
+        return timed_tool_call(call, round_number)
+
+    try:
+        with StageTimer("tools"):
+            outcomes = await asyncio.gather(*(outcome(call) for call in tool_calls))
+    finally:
+        cancel_early_tool_calls(early_calls)
+    return [message for message, _ in outcomes], [report for _, report in outcomes]
+
+def can_run_tools_on_server(tool_calls: List[Dict[str, Any]]) -> bool:
+    """Only handle a round on the server when every requested tool is one of ours"""
+    return SERVER_SIDE_TOOLS and all(call["function"]["name"] in TOOL_FUNCTIONS for call in tool_calls)
 
+RAG_PROMPT_HEADER = """
+You are a helpful AI assistant with access to a company knowledge base and external tools.
+"""
+
+RAG_PROMPT_INSTRUCTIONS = """
 When users ask questions, first check if the information is available in the knowledge base.
 Use tools when you need real-time information or to perform calculations.
 Be helpful, accurate, and reference your knowledge base when appropriate.
 """
-    
-    enhanced_messages.append(Message(role="system", content=rag_context))
-    enhanced_messages.extend(messages)
-    
-    return enhanced_messages
 
-async def stream_openai_response(messages: List[Dict], tools: Optional[List[Tool]] = None, model: str = "gpt-3.5-turbo") -> AsyncGenerator[str, None]:
-    """Stream response from OpenAI with tool calling support"""
+# Full-knowledge-base system message, rebuilt only when KNOWLEDGE_BASE_VERSION changes
+_rag_prompt_cache: Dict[str, Any] = {"version": None, "message": None}
+
+def build_rag_system_prompt() -> str:
+    """Render the system prompt containing the whole knowledge base
+
+    Entries replaced or deleted through ingestion are left out of their
+    section; ingested documents follow the FAQ.
+    """
+    changed = INGEST_JOURNAL.changes
+    company_info = {key: value for key, value in KNOWLEDGE_BASE['company_info'].items() if f"company_info:{key}" not in changed}
+    faq = {topic: answer for topic, answer in KNOWLEDGE_BASE['faq'].items() if f"faq:{topic}" not in changed}
+    ingested = "\n".join(document.render() for document in INGEST_JOURNAL.documents)
+    documents = f"\nAdditional Documents:\n{ingested}\n" if ingested else ""
+    return f"""{RAG_PROMPT_HEADER}
+Company Information:
+{json.dumps(company_info, indent=2)}
+
+FAQ Information:
+{json.dumps(faq, indent=2)}
+{documents}{RAG_PROMPT_INSTRUCTIONS}"""
+
+def get_rag_system_message() -> Dict[str, str]:
+    """Return the cached full-knowledge-base system message"""
+    if _rag_prompt_cache["version"] != KNOWLEDGE_BASE_VERSION:
+        _rag_prompt_cache["message"] = {"role": "system", "content": build_rag_system_prompt()}
+        _rag_prompt_cache["version"] = KNOWLEDGE_BASE_VERSION
+    return _rag_prompt_cache["message"]
+
+def build_retrieved_context(query: str, max_chars: int = RAG_CONTEXT_MAX_CHARS) -> str:
+    """Join the entries retrieved for a query, keeping the total under max_chars"""
+    snippets = []
+    total = 0
+    for document, _ in KNOWLEDGE_RETRIEVER.search(query, top_k=RAG_TOP_K):
+        snippet = document.render()
+        if total + len(snippet) > max_chars:
+            if not snippets:
+                snippets.append(snippet[:max_chars])
+            break
+        snippets.append(snippet)
+        total += len(snippet) + 1
+    return "\n".join(snippets) if snippets else "No relevant information found in knowledge base."
+
+def get_retrieved_system_message(messages: List[Dict[str, Any]]) -> Dict[str, str]:
+    """Build a system message with only the entries relevant to the last user message"""
+    query = next((msg["content"] for msg in reversed(messages) if msg["role"] == "user"), "")
+    context = build_retrieved_context(query) if query else "No relevant information found in knowledge base."
+    return {
+        "role": "system",
+        "content": f"{RAG_PROMPT_HEADER}\nRelevant Knowledge Base Entries:\n{context}\n{RAG_PROMPT_INSTRUCTIONS}",
+    }
+
+def rag_system_message(messages: List[Dict[str, Any]]) -> Dict[str, str]:
+    with StageTimer("rag_enhance"):
+        if RAG_PROMPT_MODE == "retrieved":
+            return get_retrieved_system_message(messages)
+        return get_rag_system_message()
+
+def enhance_messages_with_rag(messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Prepend the RAG system message to messages already converted to plain dicts"""
+    return [rag_system_message(messages)] + messages
+
+def enhance_session_messages(session: Session, new_messages: List[Dict[str, Any]],
+                             system_message: Dict[str, str]) -> List[Dict[str, Any]]:
+    """Add new turns to a session and build the upstream messages from its history
+
+    The RAG system prompt's tokens are reserved first; the session's turns
+    and summary fill the rest of SESSION_CONTEXT_TOKENS.
+    """
+    with StageTimer("rag_enhance"):
+        for msg in new_messages:
+            session.append(msg["role"], msg["content"])
+        history = SESSIONS.context(session, reserved_tokens=message_tokens(system_message["content"]))
+        SESSIONS.save(session)
+    return [system_message] + history
+
+def remember_reply(session: Session, message: Dict[str, Any]) -> None:
+    """Store the assistant's answer as the session's next turn"""
+    if message.get("content") and not message.get("tool_calls"):
+        # Pick up what other workers saved while the answer was generated
+        session = SESSIONS.get_or_create(session.session_id)
+        session.append("assistant", message["content"])
+        SESSIONS.save(session)
+
+async def stream_openai_response(messages: Union[List[Dict], Awaitable[List[Dict]]],
+                                 tools: Optional[List[Dict[str, Any]]] = None, model: str = "gpt-3.5-turbo",
+                                 on_complete: Optional[Callable[[Dict[str, Any], str], None]] = None,
+                                 temperature: float = 0.7, max_tokens: Optional[int] = None,
+                                 encoder: Optional[ChunkEncoder] = None) -> AsyncGenerator[str, None]:
+    """Stream response from OpenAI with tool calling support as OpenAI-format SSE chunks
+
+    messages may be an awaitable still preparing them, so that time counts
+    towards the stream's TTFT. on_complete is called with the final
+    assistant message and its finish_reason when the model finishes with a
+    plain answer rather than tool calls for the client. If the client disconnects, the generator is cancelled and the upstream
+    stream is closed immediately instead of being read to the end.
+
+    Tool calls are reassembled as they stream. Once a call's arguments are
+    complete JSON, a server-side tool starts running while the model is
+    still generating the rest, and a call bound for the client is sent to
+    it as one fully assembled chunk.
+    """
+    encoder = encoder or ChunkEncoder(model)
+    response = None
+    early_calls: EarlyToolCalls = {}
+    started = time.perf_counter()
+    tokens_streamed = 0
     try:
-        # Convert tools to OpenAI format
-        openai_tools = None
-        if tools:
-            openai_tools = [tool.dict() for tool in tools]
+        if inspect.isawaitable(messages):
+            messages = await messages
+        messages = list(messages)
+        tool_executions = []
+        finish_reason = "stop"
+        for round_number in range(MAX_TOOL_ROUNDS + 1):
+            # Make upstream API call
+            response = UPSTREAM.stream(
+                model=model,
+                messages=messages,
+                tools=tools,
+                temperature=temperature,
+                max_tokens=max_tokens
+            )
+            if STREAM_COALESCE_MS > 0:
+                response = coalesce_content(response, STREAM_COALESCE_MS / 1000, STREAM_COALESCE_MAX_CHARS)
+            
+            content_parts = []
+            tool_call_parts = ToolCallAccumulator()
+            sent_calls: Set[int] = set()
+            # Calls in a round the server will not run go to the client as soon as they are complete
+            client_round = not SERVER_SIDE_TOOLS or round_number == MAX_TOOL_ROUNDS
+            async for chunk in response:
+                if not chunk["choices"]:
+                    continue
+                choice = chunk["choices"][0]
+                delta = choice.get("delta") or {}
+                if delta.get("content"):
+                    if not tokens_streamed:
+                        observe_stage("ttft", time.perf_counter() - started)
+                    tokens_streamed += 1
+                    content_parts.append(delta["content"])
+                    yield encoder.content(delta["content"])
+                if delta.get("tool_calls"):
+                    for index in tool_call_parts.add(delta["tool_calls"]):
+                        call = tool_call_parts.calls[index]
+                        if not client_round and call["function"]["name"] not in TOOL_FUNCTIONS:
+                            # One unknown tool hands the whole round to the client
+                            client_round = True
+                            cancel_early_tool_calls(early_calls)
+                        if not client_round:
+                            if EARLY_TOOL_EXECUTION:
+                                start_tool_call_early(early_calls, call, round_number)
+                            continue
+                        for ready in sorted(tool_call_parts.completed - sent_calls):
+                            sent_calls.add(ready)
+                            yield encoder.tool_call(ready, tool_call_parts.calls[ready])
+                if choice.get("finish_reason"):
+                    finish_reason = choice["finish_reason"]
+            response = None
+            
+            if not tool_call_parts:
+                if on_complete:
+                    on_complete({"role": "assistant", "content": "".join(content_parts)}, finish_reason)
+                break
+            
+            tool_calls = tool_call_parts.ordered()
+            if client_round or not can_run_tools_on_server(tool_calls):
+                # Hand the assembled calls the client has not had yet to it
+                cancel_early_tool_calls(early_calls)
+                for index in sorted(set(tool_call_parts.calls) - sent_calls):
+                    yield encoder.tool_call(index, tool_call_parts.calls[index])
+                finish_reason = "tool_calls"
+                break
+            
+            messages.append({"role": "assistant", "content": "".join(content_parts) or None, "tool_calls": tool_calls})
+            tool_messages, reports = await run_tool_calls(tool_calls, round_number, early_calls)
+            messages.extend(tool_messages)
+            tool_executions.extend(reports)
+            finish_reason = "stop"
         
-        # Make OpenAI API call
-        response = await openai.ChatCompletion.acreate(
-            model=model,
-            messages=[msg.dict() for msg in messages],
-            tools=openai_tools,
-            stream=True,
-            temperature=0.7
+        if tool_executions:
+            yield encoder.extra(tool_executions=tool_executions)
+        timings = current_request_timings()
+        if timings:
+            yield encoder.extra(stage_timings={stage: round(seconds * 1000, 2) for stage, seconds in timings.items()})
+        yield encoder.finish(finish_reason)
+        yield SSE_DONE
+        
+    except Exception as e:
+        record_error(type(e).__name__)
+        if response is not None:
+            # Closed here so the finally block does not count this as a disconnect
+            await response.aclose()
+            response = None
+        yield encoder.content(f"Error: {str(e)}")
+        yield encoder.finish("stop")
+        yield SSE_DONE
+    
+    finally:
+        cancel_early_tool_calls(early_calls)
+        # Only still set when we stopped mid-stream, e.g. on client disconnect
+        if response is not None:
+            record_error("client_disconnect")
+            await response.aclose()
+        observe_stage("stream_total", time.perf_counter() - started)
+        STREAM_TOKENS.inc(tokens_streamed)
+
+async def complete_with_tools(messages: List[Dict], request: ChatCompletionRequest,
+                              tools: Optional[List[Dict[str, Any]]] = None) -> Dict[str, Any]:
+    """Non-streaming completion that runs server-side tool rounds until the model answers"""
+    messages = list(messages)
+    tool_executions = []
+    for round_number in range(MAX_TOOL_ROUNDS + 1):
+        response = await UPSTREAM.complete(
+            model=request.model,
+            messages=messages,
+            tools=tools,
+            temperature=request.temperature,
+            max_tokens=request.max_tokens
         )
         
-        async for chunk in response:
-            if chunk.choices[0].delta.content:
-                yield f"data: {json.dumps({'choices': [{'delta': {'content': chunk.choices[0].delta.content}}]})}\n\n"
-            elif chunk.choices[0].delta.tool_calls:
-                yield f"data: {json.dumps({'choices': [{'delta': {'tool_calls': chunk.choices[0].delta.tool_calls}}]})}\n\n"
+        message = response["choices"][0]["message"]
+        tool_calls = message.get("tool_calls")
+        if not tool_calls or round_number == MAX_TOOL_ROUNDS:
+            break
         
-        yield "data: [DONE]\n\n"
+        tool_calls = [call.to_dict_recursive() if hasattr(call, "to_dict_recursive") else call for call in tool_calls]
+        if not can_run_tools_on_server(tool_calls):
+            break
         
-    except Exception as e:
-        error_response = {
-            "choices": [{
-                "delta": {
-                    "content": f"Error: {str(e)}"
-                }
-            }]
-        }
-        yield f"data: {json.dumps(error_response)}\n\n"
-        yield "data: [DONE]\n\n"
+        messages.append({"role": "assistant", "content": message.get("content"), "tool_calls": tool_calls})
+        tool_messages, reports = await run_tool_calls(tool_calls, round_number)
+        messages.extend(tool_messages)
+        tool_executions.extend(reports)
+    
+    if tool_executions:
+        response["tool_executions"] = tool_executions
+    return response
+
+def completion_request_key(request: ChatCompletionRequest, messages: List[Dict[str, Any]],
+                           tools: Optional[List[Dict[str, Any]]], normalize: bool = False) -> str:
+    """Canonical key for a request; includes the knowledge base version and prompt mode"""
+    return request_key(
+        request.model,
+        messages,
+        tools,
+        request.temperature,
+        request.max_tokens,
+        version=[KNOWLEDGE_BASE_VERSION, RAG_PROMPT_MODE],
+        normalize=normalize,
+    )
+
+@dataclasses.dataclass
+class PreparedRequest:
+    """A request converted once into the plain dicts its keys and upstream calls use"""
+    messages: List[Dict[str, Any]]
+    tools: Optional[List[Dict[str, Any]]]
+    heavy: bool
+    cache_key: Optional[str] = None
+    coalesce_key: Optional[str] = None
+
+# Rough character cost of a message's role and framing, or of a tool schema
+REQUEST_ITEM_CHARS = 64
+
+def request_size(request: ChatCompletionRequest) -> int:
+    """Approximate size of a request in characters, without serializing it"""
+    size = sum(len(msg.content) + REQUEST_ITEM_CHARS for msg in request.messages)
+    return size + REQUEST_ITEM_CHARS * len(request.tools or ())
+
+def build_prepared_request(request: ChatCompletionRequest, heavy: bool,
+                           cache: bool, coalesce: bool) -> PreparedRequest:
+    """Convert a request to dicts and compute the keys it needs"""
+    with StageTimer("prepare"):
+        messages = [msg.dict() for msg in request.messages]
+        tools = [tool.dict() for tool in request.tools] if request.tools else None
+        prepared = PreparedRequest(messages, tools, heavy)
+        if cache:
+            prepared.cache_key = completion_request_key(request, messages, tools, COMPLETION_CACHE.normalize)
+        if coalesce:
+            if prepared.cache_key and not COMPLETION_CACHE.normalize:
+                prepared.coalesce_key = prepared.cache_key
+            else:
+                prepared.coalesce_key = completion_request_key(request, messages, tools)
+    return prepared
+
+async def prepare_request(request: ChatCompletionRequest, cache: bool = False,
+                          coalesce: bool = False) -> PreparedRequest:
+    """build_prepared_request, off the event loop for requests of OFFLOAD_MIN_CHARS or more"""
+    heavy = request_size(request) >= OFFLOAD_MIN_CHARS
+    return await OFFLOADER.run("prepare", heavy, build_prepared_request, request, heavy, cache, coalesce)
+
+def retrieval_is_heavy(prepared: PreparedRequest) -> bool:
+    """Whether building the RAG system message is worth moving off the event loop"""
+    if RAG_PROMPT_MODE != "retrieved":
+        # The full-knowledge-base message is cached, so only the first build costs anything
+        return False
+    return prepared.heavy or len(KNOWLEDGE_INDEX) >= OFFLOAD_MIN_DOCUMENTS
+
+async def rag_messages(prepared: PreparedRequest, session: Optional[Session] = None) -> List[Dict[str, Any]]:
+    """The upstream messages for a prepared request, with retrieval offloaded when heavy
+
+    Session history is only touched on the event loop.
+    """
+    heavy = retrieval_is_heavy(prepared)
+    if session is None:
+        return await OFFLOADER.run("rag_enhance", heavy, enhance_messages_with_rag, prepared.messages)
+    system_message = await OFFLOADER.run("rag_enhance", heavy, rag_system_message, prepared.messages)
+    return enhance_session_messages(session, prepared.messages, system_message)
+
+def is_cacheable_completion(completion: Dict[str, Any]) -> bool:
+    """Only finished plain answers are cached, not tool calls or answers cut off at max_tokens"""
+    choice = completion["choices"][0]
+    return choice.get("finish_reason") == "stop" and not choice["message"].get("tool_calls")
+
+def cache_completion(cache_key: str, model: str, message: Dict[str, Any], finish_reason: str) -> None:
+    """Store a streamed answer in the same shape as a non-streaming completion"""
+    completion = {
+        "id": f"chatcmpl-{cache_key[:24]}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}]
+    }
+    if is_cacheable_completion(completion):
+        COMPLETION_CACHE.set(cache_key, completion)
+
+async def replay_cached_stream(completion: Dict[str, Any]) -> AsyncGenerator[str, None]:
+    """Replay a cached completion as a chunked stream like a live response"""
+    encoder = ChunkEncoder(completion.get("model", ""), completion.get("id"), completion.get("created"))
+    content = completion["choices"][0]["message"].get("content") or ""
+    for piece in split_for_replay(content):
+        yield encoder.content(piece)
+    if completion.get("tool_executions"):
+        yield encoder.extra(tool_executions=completion["tool_executions"])
+    yield encoder.finish(completion["choices"][0].get("finish_reason") or "stop")
+    yield SSE_DONE
+
+async def report_coalesced_stream(shared: SharedStream, events: AsyncGenerator[str, None]) -> AsyncGenerator[str, None]:
+    """Follow a shared stream, adding how many requests it served before [DONE]"""
+    async for event in events:
+        if event == SSE_DONE:
+            yield shared.context.extra(coalesced_requests=shared.joined)
+        yield event
+
+def admission_client(http_request: Request) -> str:
+    """Fair-queuing key: the client header, else a hash of the API key, else the client address"""
+    client = http_request.headers.get(ADMISSION_CLIENT_HEADER)
+    if client:
+        return f"client:{client}"
+    api_key = http_request.headers.get("authorization") or http_request.headers.get("x-api-key")
+    if api_key:
+        return "key:" + hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:16]
+    return f"addr:{http_request.client.host}" if http_request.client else "anonymous"
+
+def request_priority(x_priority: Optional[str], default: str) -> str:
+    priority = (x_priority or default).lower()
+    if ADMISSION is not None and priority not in ADMISSION.priorities:
+        raise HTTPException(status_code=400, detail=f"Unknown priority: {x_priority}. Available: {list(ADMISSION.priorities)}")
+    return priority
+
+async def admit(client: str, priority: str) -> Optional[Ticket]:
+    """Wait for an admission slot; the time spent queued is reported as the queue stage"""
+    if ADMISSION is None:
+        return None
+    try:
+        ticket = await ADMISSION.acquire(client, priority)
+    except AdmissionRejected as e:
+        record_error(f"admission_{e.reason}")
+        raise
+    observe_stage("queue", ticket.wait_seconds)
+    return ticket
+
+def rejection_response(error: AdmissionRejected) -> HTTPException:
+    return HTTPException(status_code=429, detail=str(error), headers={"Retry-After": str(error.retry_after)})
+
+async def release_after_stream(body: AsyncGenerator[str, None], ticket: Ticket) -> AsyncGenerator[str, None]:
+    """Hold an admission slot until the stream ends or the client goes away"""
+    try:
+        async for event in body:
+            yield event
+    finally:
+        ticket.release()
 
 @app.post("/chat/completions")
-async def chat_completions(request: ChatCompletionRequest):
-    """OpenAI-compatible chat completions endpoint with RAG and tool calling"""
+async def chat_completions(request: ChatCompletionRequest, response: Response, http_request: Request,
+                           x_session_id: Optional[str] = Header(None),
+                           x_priority: Optional[str] = Header(None)):
+    """OpenAI-compatible chat completions endpoint with RAG and tool calling
+
+    Cache hits are answered at once; everything else waits for admission
+    (see admission.py) and gets a 429 with Retry-After when over capacity.
+    """
+    
+    REQUESTS.inc(1, "stream" if request.stream else "non_stream")
+    timings = start_request_timings()
+    priority = request_priority(x_priority, "interactive")
+    # In session mode the request holds only new turns, so its payload says
+    # nothing about the full context and is neither cached nor coalesced
+    session_id = request.session_id or x_session_id
+    session = SESSIONS.get_or_create(session_id) if session_id else None
+    prepared = await prepare_request(
+        request,
+        cache=COMPLETION_CACHE is not None and session is None,
+        coalesce=COALESCER is not None and session is None,
+    )
+    cache_key, coalesce_key = prepared.cache_key, prepared.coalesce_key
+    if cache_key:
+        cached = COMPLETION_CACHE.get(cache_key)
+        if cached is not None:
+            if request.stream:
+                return StreamingResponse(
+                    replay_cached_stream(cached),
+                    media_type="text/event-stream",
+                    headers={**SSE_HEADERS, "X-Cache": "HIT"}
+                )
+            response.headers["X-Cache"] = "HIT"
+            return cached
     
-    # Enhance messages with RAG context
-    enhanced_messages = enhance_messages_with_rag(request.messages)
+    try:
+        ticket = await admit(admission_client(http_request), priority)
+    except AdmissionRejected as e:
+        raise rejection_response(e)
     
     if request.stream:
-        return StreamingResponse(
-            stream_openai_response(enhanced_messages, request.tools, request.model),
-            media_type="text/plain"
-        )
+        def on_complete(message: Dict[str, Any], finish_reason: str):
+            if cache_key:
+                cache_completion(cache_key, request.model, message, finish_reason)
+            if session is not None:
+                remember_reply(session, message)
+        encoder = ChunkEncoder(request.model)
+        
+        def start_stream():
+            # Enhance messages with RAG context once the stream starts
+            return stream_openai_response(
+                rag_messages(prepared, session), prepared.tools, request.model, on_complete,
+                temperature=request.temperature, max_tokens=request.max_tokens, encoder=encoder
+            )
+        
+        # Run once the response is done, also when the client left before the body started
+        cleanup = BackgroundTasks()
+        if coalesce_key:
+            shared = COALESCER.stream(coalesce_key, start_stream, context=encoder)
+            subscription = shared.attach()
+            cleanup.add_task(subscription.release)
+            body = report_coalesced_stream(shared, subscription)
+        else:
+            body = start_stream()
+        headers = dict(SSE_HEADERS)
+        if cache_key:
+            headers["X-Cache"] = "MISS"
+        if session is not None:
+            headers["X-Session-Id"] = session.session_id
+        # Later stages are reported in a stage_timings chunk at the end of the stream
+        if timings:
+            headers["Server-Timing"] = server_timing_header(timings)
+        if ticket is not None:
+            cleanup.add_task(ticket.release)
+            body = release_after_stream(body, ticket)
+        return StreamingResponse(body, media_type="text/event-stream", headers=headers, background=cleanup)
     else:
         # Non-streaming response (for testing)
+        async def run_completion():
+            return await complete_with_tools(await rag_messages(prepared, session), request, prepared.tools)
+        
         try:
-            openai_tools = None
-            if request.tools:
-                openai_tools = [tool.dict() for tool in request.tools]
-            
-            response = await openai.ChatCompletion.acreate(
-                model=request.model,
-                messages=[msg.dict() for msg in enhanced_messages],
-                tools=openai_tools,
-                temperature=request.temperature,
-                max_tokens=request.max_tokens
-            )
-            
-            return response
+            if coalesce_key:
+                completion, joined = await COALESCER.call(coalesce_key, run_completion)
+                response.headers["X-Coalesced-Requests"] = str(joined)
+            else:
+                completion = await run_completion()
             
         except Exception as e:
+            record_error(type(e).__name__)
             raise HTTPException(status_code=500, detail=str(e))
+        finally:
+            if ticket is not None:
+                ticket.release()
+        
+        response.headers["Server-Timing"] = server_timing_header(timings)
+        if session is not None:
+            response.headers["X-Session-Id"] = session.session_id
+            remember_reply(session, completion["choices"][0]["message"])
+        if cache_key:
+            response.headers["X-Cache"] = "MISS"
+            if hasattr(completion, "to_dict_recursive"):
+                completion = completion.to_dict_recursive()
+            if is_cacheable_completion(completion):
+                COMPLETION_CACHE.set(cache_key, completion)
+        return completion
+
+async def run_batch_item(record: Dict[str, Any], client: str = "anonymous") -> Dict[str, Any]:
+    """Complete one batch record like a non-streaming /chat/completions call, at batch priority"""
+    request = ChatCompletionRequest(**record)
+    REQUESTS.inc(1, "batch")
+    prepared = await prepare_request(request, cache=COMPLETION_CACHE is not None)
+    cache_key = prepared.cache_key
+    if cache_key:
+        cached = COMPLETION_CACHE.get(cache_key)
+        if cached is not None:
+            return cached
+    
+    ticket = await admit(client, "batch")
+    try:
+        completion = await complete_with_tools(await rag_messages(prepared), request, prepared.tools)
+    finally:
+        if ticket is not None:
+            ticket.release()
+    if hasattr(completion, "to_dict_recursive"):
+        completion = completion.to_dict_recursive()
+    if cache_key and is_cacheable_completion(completion):
+        COMPLETION_CACHE.set(cache_key, completion)
+    return completion
+
+@app.post("/batch/chat/completions")
+async def batch_chat_completions(request: Request, batch_id: Optional[str] = None,
+                                 concurrency: Optional[int] = None):
+    """Run a JSONL upload of chat completion requests and stream JSONL results
+
+    Results arrive in completion order tagged with their input index. To
+    resume an interrupted batch, upload the same file with the same
+    batch_id: records that already succeeded are replayed, not re-run.
+    Records are admitted at batch priority, behind interactive requests.
+    """
+    batch_id = batch_id or new_batch_id()
+    try:
+        journal = BatchJournal(BATCH_JOURNAL_DIR, batch_id)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    prune_journals(BATCH_JOURNAL_DIR, BATCH_JOURNAL_TTL_SECONDS)
+    limit = max(1, min(concurrency or BATCH_CONCURRENCY, BATCH_MAX_CONCURRENCY))
+    # The upload is read before responding: the response's disconnect listener
+    # shares the ASGI receive channel and would swallow body chunks
+    data = await request.body()
+    client = admission_client(request)
+    body = run_batch(
+        iter_jsonl(data), lambda record: run_batch_item(record, client), limit, batch_id, journal,
+        on_error=lambda e: record_error(f"batch_{type(e).__name__}")
+    )
+    return StreamingResponse(body, media_type="application/x-ndjson", headers={"X-Batch-Id": batch_id})
+
+@app.get("/cache/stats")
+async def cache_stats():
+    """Completion and tool cache hit rates and request coalescing counts"""
+    return {
+        "completion_cache": COMPLETION_CACHE.stats() if COMPLETION_CACHE is not None else {"enabled": False},
+        "coalescing": COALESCER.stats() if COALESCER is not None else {"enabled": False},
+        "tool_cache": TOOL_CACHE.stats() if TOOL_CACHE is not None else {"enabled": False}
+    }
+
+@app.get("/upstream/stats")
+async def upstream_stats():
+    """In-flight upstream calls, retries and, with a fallback or hedging, per-backend TTFT and circuit state"""
+    return UPSTREAM.stats()
+
+@app.get("/recording/stats")
+async def recording_stats():
+    """Traffic recording status"""
+    return TRACE_RECORDER.stats() if TRACE_RECORDER else {"enabled": False}
+
+@app.get("/admission/stats")
+async def admission_stats():
+    """Active and queued requests, queue wait percentiles and rejections"""
+    return ADMISSION.stats() if ADMISSION is not None else {"enabled": False}
+
+@app.get("/sessions/stats")
+async def session_stats():
+    """Session counts, evictions and token-count cache usage"""
+    return SESSIONS.stats()
+
+@app.get("/sessions/{session_id}")
+async def get_session(session_id: str):
+    """Size of one session's retained history and summary"""
+    session = SESSIONS.get(session_id)
+    if session is None:
+        raise HTTPException(status_code=404, detail="Session not found")
+    return session.stats()
+
+@app.delete("/sessions/{session_id}")
+async def delete_session(session_id: str):
+    """Forget a session's history"""
+    if not SESSIONS.delete(session_id):
+        raise HTTPException(status_code=404, detail="Session not found")
+    return {"session_id": session_id, "deleted": True}
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus metrics"""
+    return PlainTextResponse(REGISTRY.render(), media_type=PROMETHEUS_CONTENT_TYPE)
+
+# Serializes knowledge swaps; loading runs in a thread, the swap itself on the event loop
+_knowledge_reload_lock = asyncio.Lock()
+_background_tasks: set = set()
+
+def spawn_background(coroutine) -> asyncio.Task:
+    """Start a task that is kept referenced until it finishes and cancelled on shutdown"""
+    task = asyncio.create_task(coroutine)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+    return task
+
+async def switch_knowledge_snapshot(version: Optional[int] = None) -> int:
+    """Map (and warm) a published snapshot off the event loop, then swap it in"""
+    async with _knowledge_reload_lock:
+        loaded = await asyncio.get_running_loop().run_in_executor(
+            None, load_knowledge_snapshot, version, KNOWLEDGE_WARM_ON_START)
+        install_knowledge(*loaded)
+    return KNOWLEDGE_BASE_VERSION
+
+async def warm_knowledge_base():
+    """Remap the snapshot mapped at import with its pages read in, then report ready"""
+    global KNOWLEDGE_WARM
+    started = time.perf_counter()
+    try:
+        await switch_knowledge_snapshot(KNOWLEDGE_BASE_VERSION)
+    except Exception:
+        # Still served from the cold mapping; being slow at first beats never becoming ready
+        record_error("knowledge_warm")
+    STARTUP_STATS["knowledge_warm_ms"] = round((time.perf_counter() - started) * 1000, 2)
+    KNOWLEDGE_WARM = True
+
+async def reload_knowledge_on_signal():
+    try:
+        await switch_knowledge_snapshot()
+    except Exception:
+        record_error("knowledge_reload")
+
+async def watch_knowledge_snapshots():
+    """Follow the CURRENT pointer so a snapshot published by any process reaches this worker"""
+    while True:
+        await asyncio.sleep(KNOWLEDGE_SNAPSHOT_POLL_SECONDS)
+        try:
+            version = current_snapshot_version(KNOWLEDGE_SNAPSHOT_DIR)
+            if version is not None and version != KNOWLEDGE_BASE_VERSION:
+                await switch_knowledge_snapshot(version)
+        except Exception:
+            record_error("knowledge_reload")
+
+def check_admin_key(admin_key: Optional[str]):
+    if ADMIN_API_KEY and admin_key != ADMIN_API_KEY:
+        raise HTTPException(status_code=403, detail="Invalid admin key")
+
+@app.post("/admin/knowledge/reload")
+async def reload_knowledge(x_admin_key: Optional[str] = Header(None)):
+    """Rebuild the knowledge indexes and swap them in without interrupting open streams"""
+    check_admin_key(x_admin_key)
+    loop = asyncio.get_running_loop()
+    if KNOWLEDGE_SNAPSHOT_DIR:
+        version = await loop.run_in_executor(None, publish_knowledge_snapshot)
+        await switch_knowledge_snapshot(version)
+    else:
+        # No ingestion job may change the old indexes once the journal is being replayed into new ones
+        async with _knowledge_reload_lock, INGESTOR.exclusive():
+            index, retriever = await loop.run_in_executor(None, build_knowledge)
+            install_knowledge(index, retriever, KNOWLEDGE_BASE_VERSION + 1)
+    return {"version": KNOWLEDGE_BASE_VERSION, "documents": len(KNOWLEDGE_INDEX)}
+
+def check_ingestion_allowed():
+    if KNOWLEDGE_SNAPSHOT_DIR:
+        # Each worker maps the same read-only snapshot; an upload would reach only one of them
+        raise HTTPException(
+            status_code=409,
+            detail="Knowledge snapshots are read-only; update KNOWLEDGE_BASE_JSONL and reload instead",
+        )
+
+def documents_from_records(records: List[Dict[str, Any]]):
+    try:
+        return [document_from_record(record) for record in records]
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=f"Invalid document: {e}")
+
+@app.post("/documents", status_code=202)
+async def upsert_documents(request: DocumentsRequest, x_admin_key: Optional[str] = Header(None)):
+    """Queue documents to be indexed, replacing any with the same ids"""
+    check_admin_key(x_admin_key)
+    check_ingestion_allowed()
+    return INGESTOR.upsert(documents_from_records(request.documents)).stats()
+
+@app.put("/documents/{doc_id}", status_code=202)
+async def put_document(doc_id: str, record: Dict[str, Any], x_admin_key: Optional[str] = Header(None)):
+    """Queue one document to be indexed under doc_id"""
+    check_admin_key(x_admin_key)
+    check_ingestion_allowed()
+    return INGESTOR.upsert(documents_from_records([{**record, "id": doc_id}])).stats()
+
+@app.delete("/documents/{doc_id}", status_code=202)
+async def delete_document(doc_id: str, x_admin_key: Optional[str] = Header(None)):
+    """Queue a document, and all of its chunks, to be removed from the index"""
+    check_admin_key(x_admin_key)
+    check_ingestion_allowed()
+    return INGESTOR.delete([doc_id]).stats()
+
+@app.get("/ingest/status")
+async def ingest_status():
+    """Ingestion queue depth, throughput and index size"""
+    return INGESTOR.stats()
+
+@app.get("/ingest/jobs/{job_id}")
+async def ingest_job(job_id: str):
+    """Progress or outcome of one ingestion job"""
+    job = INGESTOR.jobs.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Ingestion job not found")
+    return job.stats()
+
+class ProfilingToggle(BaseModel):
+    enabled: bool
+    # Profile only this many more requests; all of them while enabled if omitted
+    requests: Optional[int] = None
+
+@app.post("/admin/profiling")
+async def set_profiling(toggle: ProfilingToggle, x_admin_key: Optional[str] = Header(None)):
+    """Profile upcoming requests without the X-Profile header"""
+    check_admin_key(x_admin_key)
+    if toggle.enabled:
+        PROFILES.arm(toggle.requests)
+    else:
+        PROFILES.disarm()
+    return PROFILES.stats()
+
+@app.get("/admin/profiles")
+async def list_profiles(x_admin_key: Optional[str] = Header(None)):
+    """Stored request profiles, newest first"""
+    check_admin_key(x_admin_key)
+    return {**PROFILES.stats(), "profiles": PROFILES.list()}
+
+@app.get("/admin/profiles/{profile_id}")
+async def get_profile(profile_id: str, format: str = "summary", x_admin_key: Optional[str] = Header(None)):
+    """One profile as a JSON summary, a pstats text report, or a .prof file for pstats or snakeviz"""
+    check_admin_key(x_admin_key)
+    profile = PROFILES.get(profile_id)
+    if profile is None:
+        raise HTTPException(status_code=404, detail="Profile not found")
+    if format == "summary":
+        return profile.summary()
+    if format == "text":
+        return PlainTextResponse(profile.report())
+    if format == "pstats":
+        return Response(
+            profile.dump(),
+            media_type="application/octet-stream",
+            headers={"Content-Disposition": f'attachment; filename="{profile_id}.prof"'},
+        )
+    raise HTTPException(status_code=400, detail="format must be summary, text or pstats")
+
+@app.get("/admin/event-loop")
+async def event_loop_stalls(x_admin_key: Optional[str] = Header(None)):
+    """Event-loop lag and the stacks of recent stalls"""
+    check_admin_key(x_admin_key)
+    return {**LOOP_MONITOR.stats(), "recent_stalls": list(reversed(LOOP_MONITOR.stalls))}
+
+@app.on_event("startup")
+async def start_loop_monitor():
+    """Let profiled requests follow their tasks, and start sampling event-loop lag"""
+    install_task_factory(asyncio.get_running_loop())
+    if LOOP_MONITOR_INTERVAL_SECONDS > 0:
+        spawn_background(LOOP_MONITOR.run())
+
+@app.on_event("startup")
+async def start_knowledge_watcher():
+    """Warm the mapped snapshot, poll for new ones and reload on SIGHUP when snapshots are shared"""
+    if not KNOWLEDGE_SNAPSHOT_DIR:
+        return
+    if not KNOWLEDGE_WARM:
+        spawn_background(warm_knowledge_base())
+    spawn_background(watch_knowledge_snapshots())
+    try:
+        asyncio.get_running_loop().add_signal_handler(signal.SIGHUP, lambda: spawn_background(reload_knowledge_on_signal()))
+    except (AttributeError, NotImplementedError, RuntimeError):
+        # No SIGHUP on Windows, and no signal handlers outside the main thread
+        pass
+
+@app.on_event("shutdown")
+async def close_upstream():
+    """Close pooled upstream connections, the trace file and the calculator's, ingestor's and offloader's workers"""
+    for task in list(_background_tasks):
+        task.cancel()
+    await UPSTREAM.aclose()
+    if TRACE_RECORDER:
+        TRACE_RECORDER.close()
+    CALCULATOR.shutdown()
+    INGESTOR.shutdown()
+    OFFLOADER.shutdown()
 
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    return {"status": "healthy", "timestamp": datetime.now().isoformat()}
+    return {
+        "status": "healthy",
+        "timestamp": datetime.now().isoformat(),
+        "event_loop": LOOP_MONITOR.stats(),
+        "offload": OFFLOADER.stats(),
+    }
+
+@app.get("/ready")
+async def readiness_check(response: Response):
+    """Readiness probe: 503 until the knowledge indexes are loaded and warm
+
+    Unlike /health, which only says the process is up, this tells a load
+    balancer or orchestrator when to start sending traffic.
+    """
+    if not KNOWLEDGE_WARM:
+        response.status_code = 503
+    return {
+        "ready": KNOWLEDGE_WARM,
+        "knowledge_version": KNOWLEDGE_BASE_VERSION,
+        "documents": len(KNOWLEDGE_INDEX),
+        "startup": STARTUP_STATS,
+    }
 
 @app.get("/")
 async def root():
@@ -286,11 +1529,25 @@ async def root():
         "features": ["RAG", "Tool Calling", "OpenAI Compatible"],
         "endpoints": {
             "chat": "/chat/completions",
-            "health": "/health"
+            "health": "/health",
+            "ready": "/ready",
+            "cache_stats": "/cache/stats",
+            "metrics": "/metrics",
+            "sessions": "/sessions/stats",
+            "admission": "/admission/stats",
+            "upstream": "/upstream/stats",
+            "recording": "/recording/stats",
+            "batch": "/batch/chat/completions",
+            "documents": "/documents",
+            "ingest_status": "/ingest/status",
+            "knowledge_reload": "/admin/knowledge/reload"
         }
     }
 
 if __name__ == "__main__":
+    import openai
+    import uvicorn
+
     # Set your OpenAI API key
     openai.api_key = os.getenv("OPENAI_API_KEY")
     
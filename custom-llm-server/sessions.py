@@ -0,0 +1,284 @@
+"""
+Server-side conversation sessions
+Keeps each session's turns with their token counts, compacts the oldest
+turns into a running summary (or drops them) to stay within a context
+budget, and bounds memory with LRU and idle eviction. With a shared
+directory, sessions are saved there so every worker process sees them
+"""
+
+import hashlib
+import json
+import os
+import re
+import time
+from collections import OrderedDict, deque
+from dataclasses import dataclass, field
+from functools import lru_cache
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+# Every chat message costs a few tokens of framing on top of its content
+MESSAGE_OVERHEAD_TOKENS = 4
+TOKEN_PATTERN = re.compile(r"\w+|[^\w\s]")
+SUMMARY_HEADER = "Summary of the earlier conversation:\n"
+
+@lru_cache(maxsize=4096)
+def count_tokens(text: str) -> int:
+    """Approximate BPE token count: words split into ~4-character pieces, plus punctuation
+
+    Within a few percent of OpenAI tokenizers on English text, which is
+    enough to budget context without a tokenizer dependency.
+    """
+    return sum(1 if len(piece) <= 4 else (len(piece) + 3) // 4 for piece in TOKEN_PATTERN.findall(text))
+
+def message_tokens(content: str) -> int:
+    return count_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+
+def file_version(stat: os.stat_result) -> Tuple[int, int, int]:
+    # Every save replaces the file, so the inode changes even within one mtime tick
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+@dataclass
+class Turn:
+    role: str
+    content: str
+    tokens: int
+
+@dataclass
+class Session:
+    session_id: str
+    turns: Deque[Turn] = field(default_factory=deque)
+    # Token total of turns, maintained incrementally
+    tokens: int = 0
+    summary: str = ""
+    summary_tokens: int = 0
+    compacted_turns: int = 0
+    last_used: float = field(default_factory=time.monotonic)
+    # file_version() of the shared file when this copy was loaded or saved
+    file_version: Optional[Tuple[int, int, int]] = None
+
+    def append(self, role: str, content: str) -> Turn:
+        turn = Turn(role, content, message_tokens(content))
+        self.turns.append(turn)
+        self.tokens += turn.tokens
+        return turn
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "session_id": self.session_id,
+            "turns": len(self.turns),
+            "tokens": self.tokens,
+            "summary_tokens": self.summary_tokens,
+            "compacted_turns": self.compacted_turns,
+            "idle_seconds": round(time.monotonic() - self.last_used, 1),
+        }
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            "session_id": self.session_id,
+            "turns": [[turn.role, turn.content, turn.tokens] for turn in self.turns],
+            "summary": self.summary,
+            "summary_tokens": self.summary_tokens,
+            "compacted_turns": self.compacted_turns,
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Session":
+        turns = deque(Turn(role, content, tokens) for role, content, tokens in data["turns"])
+        return cls(
+            session_id=data["session_id"],
+            turns=turns,
+            tokens=sum(turn.tokens for turn in turns),
+            summary=data["summary"],
+            summary_tokens=data["summary_tokens"],
+            compacted_turns=data["compacted_turns"],
+        )
+
+class SessionStore:
+    """Bounded map of session id to Session
+
+    Sessions are kept in least-recently-used order, so idle ones are found
+    at the front and expiry stops at the first session still in use.
+
+    With a directory, which worker processes share, every change is saved
+    there with save(), and a session is reloaded whenever its file changed
+    since this process last saw it. The turns of one session are expected
+    to arrive one at a time, as a client waits for each reply.
+    """
+
+    def __init__(self, max_sessions: int = 10000, idle_ttl_seconds: float = 1800,
+                 context_tokens: int = 3000, summary_tokens: int = 300, overflow: str = "summarize",
+                 directory: Optional[str] = None):
+        if overflow not in ("summarize", "trim"):
+            raise ValueError(f"Unknown session overflow mode: {overflow}")
+        self.max_sessions = max_sessions
+        self.idle_ttl_seconds = idle_ttl_seconds
+        self.context_tokens = context_tokens
+        self.summary_tokens = summary_tokens
+        self.overflow = overflow
+        self.directory = directory
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        self._last_sweep = time.monotonic()
+        self.created = 0
+        self.evicted = 0
+        self.expired = 0
+        self.loaded = 0
+
+    def __len__(self) -> int:
+        return len(self._sessions)
+
+    def expire_idle(self) -> int:
+        """Drop sessions idle for longer than idle_ttl_seconds"""
+        cutoff = time.monotonic() - self.idle_ttl_seconds
+        removed = 0
+        while self._sessions:
+            session = next(iter(self._sessions.values()))
+            if session.last_used >= cutoff:
+                break
+            self._sessions.popitem(last=False)
+            removed += 1
+        self.expired += removed
+        if self.directory and time.monotonic() - self._last_sweep > min(60.0, self.idle_ttl_seconds):
+            self._sweep_files()
+        return removed
+
+    def _path(self, session_id: str) -> str:
+        # Hashed so any session id is a safe file name
+        return os.path.join(self.directory, hashlib.sha256(session_id.encode("utf-8")).hexdigest()[:32] + ".json")
+
+    def _sweep_files(self) -> None:
+        """Remove shared files of sessions no worker has used for idle_ttl_seconds"""
+        self._last_sweep = time.monotonic()
+        cutoff = time.time() - self.idle_ttl_seconds
+        with os.scandir(self.directory) as entries:
+            for entry in entries:
+                try:
+                    if entry.name.endswith(".json") and entry.stat().st_mtime < cutoff:
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+    def _refresh(self, session_id: str) -> Optional[Session]:
+        """The in-memory session, replaced by the shared file's copy when another worker changed it"""
+        session = self._sessions.get(session_id)
+        if not self.directory:
+            return session
+        path = self._path(session_id)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            # Deleted elsewhere, or expired; a session never saved yet is kept
+            if session is not None and session.file_version is not None:
+                del self._sessions[session_id]
+                return None
+            return session
+        if session is not None and session.file_version == file_version(stat):
+            return session
+        if stat.st_mtime < time.time() - self.idle_ttl_seconds:
+            return session
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                loaded = Session.from_dict(json.load(f))
+        except (FileNotFoundError, ValueError, KeyError):
+            return session
+        loaded.file_version = file_version(stat)
+        self._sessions[session_id] = loaded
+        self.loaded += 1
+        return loaded
+
+    def save(self, session: Session) -> None:
+        """Write a changed session to the shared directory, if there is one"""
+        if not self.directory:
+            return
+        path = self._path(session.session_id)
+        # Write then rename so other workers never read a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(session.to_dict(), f)
+        os.replace(tmp_path, path)
+        session.file_version = file_version(os.stat(path))
+
+    def get(self, session_id: str) -> Optional[Session]:
+        self.expire_idle()
+        return self._refresh(session_id)
+
+    def get_or_create(self, session_id: str) -> Session:
+        self.expire_idle()
+        session = self._refresh(session_id)
+        if session is None:
+            session = self._sessions[session_id] = Session(session_id)
+            self.created += 1
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
+            self.evicted += 1
+        session.last_used = time.monotonic()
+        self._sessions.move_to_end(session_id)
+        return session
+
+    def delete(self, session_id: str) -> bool:
+        deleted = self._refresh(session_id) is not None
+        self._sessions.pop(session_id, None)
+        if self.directory:
+            try:
+                os.remove(self._path(session_id))
+                deleted = True
+            except FileNotFoundError:
+                pass
+        return deleted
+
+    def _fold_into_summary(self, session: Session, turn: Turn) -> None:
+        """Add a one-line digest of a turn, keeping only the most recent summary_tokens"""
+        digest = " ".join(turn.content.split())
+        if len(digest) > 200:
+            digest = digest[:197] + "..."
+        lines = session.summary.splitlines() + [f"{turn.role}: {digest}"]
+        tokens = [count_tokens(line) + 1 for line in lines]
+        total = sum(tokens)
+        limit = self.summary_tokens - message_tokens(SUMMARY_HEADER)
+        while lines and total > limit:
+            total -= tokens.pop(0)
+            lines.pop(0)
+        session.summary = "\n".join(lines)
+        session.summary_tokens = total + message_tokens(SUMMARY_HEADER) if lines else 0
+
+    def compact(self, session: Session, budget: int) -> None:
+        """Move the oldest turns out of the session until it fits the budget
+
+        The newest turn is always kept, even if it alone is over budget.
+        """
+        while len(session.turns) > 1 and session.tokens + session.summary_tokens > budget:
+            turn = session.turns.popleft()
+            session.tokens -= turn.tokens
+            session.compacted_turns += 1
+            if self.overflow == "summarize":
+                self._fold_into_summary(session, turn)
+
+    def context(self, session: Session, reserved_tokens: int = 0) -> List[Dict[str, str]]:
+        """Messages to send upstream: the summary, if any, then the retained turns
+
+        reserved_tokens is taken off the budget for whatever is sent
+        alongside, such as the RAG system prompt.
+        """
+        self.compact(session, max(0, self.context_tokens - reserved_tokens))
+        messages = []
+        if session.summary:
+            messages.append({"role": "system", "content": SUMMARY_HEADER + session.summary})
+        messages.extend({"role": turn.role, "content": turn.content} for turn in session.turns)
+        return messages
+
+    def stats(self) -> Dict[str, Any]:
+        self.expire_idle()
+        return {
+            "sessions": len(self._sessions),
+            "max_sessions": self.max_sessions,
+            "idle_ttl_seconds": self.idle_ttl_seconds,
+            "context_tokens": self.context_tokens,
+            "shared_directory": self.directory,
+            "loaded_from_directory": self.loaded,
+            "turns": sum(len(s.turns) for s in self._sessions.values()),
+            "created": self.created,
+            "evicted": self.evicted,
+            "expired": self.expired,
+            "token_cache": count_tokens.cache_info()._asdict(),
+        }
@@ -0,0 +1,260 @@
+"""
+Knowledge snapshots for multi-worker deployments
+Writes the retrieval indexes to a versioned directory of flat arrays that
+every worker memory-maps, and publishes new versions atomically through a
+CURRENT pointer file
+"""
+
+import json
+import mmap
+import os
+import shutil
+import tempfile
+from collections.abc import Mapping
+from dataclasses import asdict, dataclass, field
+from datetime import datetime
+from typing import Iterator, List, Optional, Sequence
+
+import numpy as np
+
+from retrieval import BM25Index, Document, Embedder, FrozenBM25Index, VectorIndex
+
+# Format 2 moved the vocabulary out of the manifest into mapped files, so
+# opening a snapshot no longer decodes every term; format 1 is still read
+SNAPSHOT_FORMAT = 2
+READABLE_FORMATS = (1, 2)
+POINTER_FILE = "CURRENT"
+MANIFEST_FILE = "manifest.json"
+
+class MappedDocuments(Sequence):
+    """Documents decoded on access from a memory-mapped JSONL blob
+
+    Every worker shares the blob's pages instead of holding its own copy of
+    every document's text.
+    """
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray):
+        self._blob = blob
+        self._offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, position):
+        if isinstance(position, slice):
+            return [self[i] for i in range(*position.indices(len(self)))]
+        if position < 0:
+            position += len(self)
+        start, end = int(self._offsets[position]), int(self._offsets[position + 1])
+        return Document(**json.loads(self._blob[start:end].tobytes()))
+
+    def __iter__(self) -> Iterator[Document]:
+        for position in range(len(self)):
+            yield self[position]
+
+class MappedTerms(Mapping):
+    """Term -> term id over a memory-mapped vocabulary blob in sorted order
+
+    A term's id is its position in the sorted vocabulary, so lookups are a
+    binary search of the blob rather than a dict that would have to be
+    built from every term when the snapshot is opened.
+    """
+
+    def __init__(self, blob: np.ndarray, offsets: np.ndarray):
+        self._blob = memoryview(blob) if blob.size else memoryview(b"")
+        self._offsets = offsets
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def _term(self, term_id: int) -> bytes:
+        return bytes(self._blob[int(self._offsets[term_id]):int(self._offsets[term_id + 1])])
+
+    def __getitem__(self, term: str) -> int:
+        # UTF-8 byte order matches code point order, which is how the terms were sorted
+        key = term.encode("utf-8")
+        low, high = 0, len(self)
+        while low < high:
+            middle = (low + high) // 2
+            if self._term(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self) and self._term(low) == key:
+            return low
+        raise KeyError(term)
+
+    def __iter__(self) -> Iterator[str]:
+        for term_id in range(len(self)):
+            yield self._term(term_id).decode("utf-8")
+
+@dataclass
+class KnowledgeSnapshot:
+    version: int
+    path: str
+    keyword_index: FrozenBM25Index
+    vector_index: Optional[VectorIndex]
+    # Every memory-mapped array, for warm_snapshot
+    mapped: List[np.ndarray] = field(default_factory=list)
+
+def snapshot_path(root: str, version: int) -> str:
+    return os.path.join(root, f"v{version:06d}")
+
+def current_snapshot_version(root: str) -> Optional[int]:
+    """Version named by the CURRENT pointer, or None if nothing is published"""
+    try:
+        with open(os.path.join(root, POINTER_FILE), "r", encoding="utf-8") as f:
+            return int(f.read().strip())
+    except FileNotFoundError:
+        return None
+
+def _published_versions(root: str) -> List[int]:
+    versions = []
+    for name in os.listdir(root):
+        if name.startswith("v") and name[1:].isdigit():
+            versions.append(int(name[1:]))
+    return sorted(versions)
+
+def write_snapshot(root: str, keyword_index: BM25Index, vector_index: Optional[VectorIndex] = None,
+                   keep: int = 3) -> int:
+    """Write the indexes as the next snapshot version and point CURRENT at it
+
+    The snapshot is written to a temporary directory and renamed into place
+    before the pointer is replaced, so readers only ever see complete
+    snapshots. Workers that still map an older version keep working; all
+    but the newest `keep` versions are removed.
+    """
+    os.makedirs(root, exist_ok=True)
+    frozen = keyword_index if isinstance(keyword_index, FrozenBM25Index) else FrozenBM25Index.from_index(keyword_index)
+    versions = _published_versions(root)
+    version = max(versions + [current_snapshot_version(root) or 0]) + 1
+
+    staging = tempfile.mkdtemp(prefix=".staging-", dir=root)
+    try:
+        blobs = [json.dumps(asdict(document), ensure_ascii=False).encode("utf-8") for document in frozen.documents]
+        lengths = np.fromiter((len(blob) for blob in blobs), dtype=np.int64, count=len(blobs))
+        with open(os.path.join(staging, "documents.bin"), "wb") as f:
+            f.write(b"".join(blobs))
+        np.save(os.path.join(staging, "document_offsets.npy"), np.concatenate(([0], np.cumsum(lengths))))
+        np.save(os.path.join(staging, "postings_offsets.npy"), np.asarray(frozen.offsets, dtype=np.int64))
+        np.save(os.path.join(staging, "postings_docs.npy"), np.asarray(frozen.docs, dtype=np.int32))
+        np.save(os.path.join(staging, "postings_freqs.npy"), np.asarray(frozen.freqs, dtype=np.int32))
+        np.save(os.path.join(staging, "doc_lengths.npy"), np.asarray(frozen.doc_lengths, dtype=np.int32))
+        # Both kinds of term_ids iterate in id order
+        terms = [term.encode("utf-8") for term in frozen.term_ids]
+        if any(earlier >= later for earlier, later in zip(terms, terms[1:])):
+            raise ValueError("Snapshot vocabulary must be sorted with term ids in sorted order")
+        term_lengths = np.fromiter((len(term) for term in terms), dtype=np.int64, count=len(terms))
+        with open(os.path.join(staging, "terms.bin"), "wb") as f:
+            f.write(b"".join(terms))
+        np.save(os.path.join(staging, "term_offsets.npy"), np.concatenate(([0], np.cumsum(term_lengths))))
+
+        manifest = {
+            "format": SNAPSHOT_FORMAT,
+            "version": version,
+            "created": datetime.now().isoformat(),
+            "documents": len(frozen.documents),
+            "terms": len(terms),
+            "total_length": int(frozen.total_length),
+            "bm25": {"k1": frozen.k1, "b": frozen.b},
+            "vectors": None,
+        }
+        if vector_index is not None:
+            matrix = vector_index.matrix
+            removed = getattr(keyword_index, "removed", None)
+            if removed:
+                # Rows line up with keyword index positions; keep the ones from_index kept, in its order
+                matrix = matrix[[position for position in range(len(matrix)) if position not in removed]]
+            if len(matrix) != len(frozen.documents):
+                raise ValueError(f"Vector index has {len(matrix)} rows for {len(frozen.documents)} documents")
+            np.save(os.path.join(staging, "vectors.npy"), np.ascontiguousarray(matrix, dtype=np.float32))
+            manifest["vectors"] = {"embedder": vector_index.embedder.name, "dim": vector_index.embedder.dim}
+        with open(os.path.join(staging, MANIFEST_FILE), "w", encoding="utf-8") as f:
+            json.dump(manifest, f)
+
+        os.rename(staging, snapshot_path(root, version))
+    except BaseException:
+        shutil.rmtree(staging, ignore_errors=True)
+        raise
+
+    pointer_tmp = os.path.join(root, f".{POINTER_FILE}.{os.getpid()}")
+    with open(pointer_tmp, "w", encoding="utf-8") as f:
+        f.write(str(version))
+    os.replace(pointer_tmp, os.path.join(root, POINTER_FILE))
+
+    for old in _published_versions(root)[:-keep]:
+        # Mapped files stay readable after unlinking on POSIX; elsewhere, retry next publish
+        shutil.rmtree(snapshot_path(root, old), ignore_errors=True)
+    return version
+
+def load_snapshot(root: str, version: Optional[int] = None,
+                  embedder: Optional[Embedder] = None) -> KnowledgeSnapshot:
+    """Memory-map a published snapshot (CURRENT by default)
+
+    Only the manifest is parsed, so this takes about the same time for any
+    corpus size; pages are read on first use, or up front by
+    warm_snapshot. Vectors are only opened when an embedder matching the
+    one they were built with is given.
+    """
+    if version is None:
+        version = current_snapshot_version(root)
+        if version is None:
+            raise FileNotFoundError(f"No knowledge snapshot published in {root}")
+    path = snapshot_path(root, version)
+    with open(os.path.join(path, MANIFEST_FILE), "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest["format"] not in READABLE_FORMATS:
+        raise ValueError(f"Snapshot {path} has format {manifest['format']}, expected one of {READABLE_FORMATS}")
+    arrays: List[np.ndarray] = []
+
+    def mapped(name: str) -> np.ndarray:
+        array = np.load(os.path.join(path, name), mmap_mode="r")
+        arrays.append(array)
+        return array
+
+    def mapped_blob(name: str) -> np.ndarray:
+        blob_path = os.path.join(path, name)
+        if not os.path.getsize(blob_path):
+            return np.zeros(0, dtype=np.uint8)
+        blob = np.memmap(blob_path, dtype=np.uint8, mode="r")
+        arrays.append(blob)
+        return blob
+
+    documents = MappedDocuments(mapped_blob("documents.bin"), mapped("document_offsets.npy"))
+    if manifest["format"] == 1:
+        terms = manifest["terms"]
+    else:
+        terms = MappedTerms(mapped_blob("terms.bin"), mapped("term_offsets.npy"))
+    keyword_index = FrozenBM25Index(
+        documents,
+        terms,
+        mapped("postings_offsets.npy"),
+        mapped("postings_docs.npy"),
+        mapped("postings_freqs.npy"),
+        mapped("doc_lengths.npy"),
+        manifest["bm25"]["k1"],
+        manifest["bm25"]["b"],
+        total_length=manifest.get("total_length"),
+    )
+
+    vector_index = None
+    vectors = manifest.get("vectors")
+    if embedder is not None and vectors and vectors["embedder"] == embedder.name and vectors["dim"] == embedder.dim:
+        vector_index = VectorIndex(embedder)
+        vector_index.documents = documents
+        vector_index.matrix = mapped("vectors.npy")
+    return KnowledgeSnapshot(version, path, keyword_index, vector_index, arrays)
+
+def warm_snapshot(snapshot: KnowledgeSnapshot) -> int:
+    """Fault every page of a snapshot's mapped files in, returning the bytes covered
+
+    Without this, the first queries after a cold start read postings and
+    vectors from disk a page at a time.
+    """
+    covered = 0
+    for array in snapshot.mapped:
+        raw = array.reshape(-1).view(np.uint8)
+        # One byte per page is enough to fault the page in
+        int(raw[::mmap.PAGESIZE].sum())
+        covered += raw.nbytes
+    return covered
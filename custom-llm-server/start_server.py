@@ -4,9 +4,12 @@ Custom LLM Server Startup Script
 Starts the OpenAI-compatible server with RAG and tool calling capabilities
 """
 
+import argparse
 import os
+import signal
 import sys
 import subprocess
+import threading
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -61,7 +64,56 @@ def start_server():
     except subprocess.CalledProcessError as e:
         print(f"❌ Error starting server: {e}")
 
+def start_production_server(workers: int, host: str, port: int, reuse_snapshot: bool = False):
+    """Run N worker processes that share one memory-mapped knowledge snapshot and the sessions
+
+    Sessions are saved to SESSION_DIR, so a follow-up turn may be served by
+    any worker. The snapshot is built once here before the workers start. Sending SIGHUP
+    to this process rebuilds it (re-reading KNOWLEDGE_BASE_JSONL) and
+    publishes a new version, which every worker swaps in on its next poll
+    without dropping streams that are in progress.
+    """
+    snapshot_dir = os.environ.setdefault(
+        "KNOWLEDGE_SNAPSHOT_DIR", str(Path(__file__).resolve().parent / "knowledge_snapshots")
+    )
+    os.environ.setdefault("SESSION_DIR", str(Path(__file__).resolve().parent / "sessions"))
+    from snapshot import current_snapshot_version
+    existing = current_snapshot_version(snapshot_dir)
+
+    # Importing the app publishes a first snapshot if the directory is empty
+    import server
+    if existing is not None and not reuse_snapshot:
+        server.publish_knowledge_snapshot()
+    print(f"📦 Knowledge snapshot v{current_snapshot_version(snapshot_dir)} in {snapshot_dir}")
+
+    if hasattr(signal, "SIGHUP"):
+        def republish():
+            try:
+                version = server.publish_knowledge_snapshot()
+                print(f"📦 Published knowledge snapshot v{version}")
+            except Exception as e:
+                print(f"❌ Error publishing knowledge snapshot: {e}")
+
+        signal.signal(signal.SIGHUP, lambda signum, frame: threading.Thread(target=republish, daemon=True).start())
+        print(f"🔄 Reload knowledge: kill -HUP {os.getpid()} or POST /admin/knowledge/reload")
+
+    print(f"💬 Sessions shared in {os.environ['SESSION_DIR']}")
+    print(f"🚀 Starting {workers} workers on http://{host}:{port}")
+    print("\n" + "="*50)
+
+    import uvicorn
+    uvicorn.run("server:app", host=host, port=port, workers=workers)
+
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Start the Custom LLM Server")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("SERVER_WORKERS", "0")),
+                        help="Run in production mode with this many worker processes (default: development mode)")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--reuse-snapshot", action="store_true",
+                        help="Serve the existing knowledge snapshot instead of rebuilding it at startup")
+    args = parser.parse_args()
+
     print("🤖 Custom LLM Server with RAG & Tool Calling")
     print("=" * 50)
     
@@ -73,4 +125,7 @@ if __name__ == "__main__":
     check_openai_key()
     
     # Start server
-    start_server() 
\ No newline at end of file
+    if args.workers > 0:
+        start_production_server(args.workers, args.host, args.port, args.reuse_snapshot)
+    else:
+        start_server() 
\ No newline at end of file
@@ -0,0 +1,186 @@
+#!/usr/bin/env python3
+"""
+Cold-start benchmark for the Custom LLM Server
+Measures how long `import server` takes and which modules it spends that time
+on, then how long a fresh server process takes to answer /health and to
+report ready on /ready, over several runs.
+
+Examples:
+    python startup_benchmark.py --runs 5 --output startup.json
+    KNOWLEDGE_SNAPSHOT_DIR=/var/lib/llm/snapshots python startup_benchmark.py --baseline startup.json
+"""
+
+import argparse
+import json
+import os
+import platform
+import re
+import statistics
+import subprocess
+import sys
+import time
+import urllib.request
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+SERVER_DIR = Path(__file__).resolve().parent
+
+# "import time:       self |  cumulative | <indent>module", times in microseconds
+IMPORT_TIME_LINE = re.compile(r"^import time:\s+(\d+) \|\s+(\d+) \|( +)(\S+)$")
+
+def median(values: List[float]) -> Optional[float]:
+    return round(statistics.median(values), 1) if values else None
+
+def measure_import(env: Dict[str, str]) -> Dict[str, Any]:
+    """Import the server once in a fresh interpreter, with -X importtime"""
+    started = time.perf_counter()
+    completed = subprocess.run([sys.executable, "-X", "importtime", "-c", "import server"],
+                               cwd=SERVER_DIR, env=env, capture_output=True, text=True)
+    wall_ms = (time.perf_counter() - started) * 1000
+    if completed.returncode != 0:
+        raise RuntimeError(f"import server failed:\n{completed.stderr[-2000:]}")
+
+    total_ms = None
+    modules: Dict[str, float] = {}
+    for line in completed.stderr.splitlines():
+        match = IMPORT_TIME_LINE.match(line)
+        if not match:
+            continue
+        cumulative_ms = int(match.group(2)) / 1000
+        depth = len(match.group(3))
+        name = match.group(4)
+        if name == "server" and depth == 1:
+            total_ms = cumulative_ms
+        elif depth == 3:
+            # Imported directly by server.py
+            modules[name] = cumulative_ms
+    return {"wall_ms": wall_ms, "import_ms": total_ms, "modules": modules}
+
+def wait_for(url: str, deadline: float) -> Optional[float]:
+    """Poll url until it answers 200, returning when it did"""
+    while time.perf_counter() < deadline:
+        try:
+            with urllib.request.urlopen(url, timeout=1) as response:
+                if response.status == 200:
+                    return time.perf_counter()
+        except OSError:
+            time.sleep(0.01)
+    return None
+
+def measure_start(env: Dict[str, str], port: int, timeout: float) -> Dict[str, Any]:
+    """Start a server process and time /health and /ready"""
+    started = time.perf_counter()
+    server = subprocess.Popen([
+        sys.executable, "-m", "uvicorn", "server:app",
+        "--host", "127.0.0.1", "--port", str(port), "--log-level", "warning",
+    ], cwd=SERVER_DIR, env=env)
+    url = f"http://127.0.0.1:{port}"
+    try:
+        deadline = started + timeout
+        healthy = wait_for(f"{url}/health", deadline)
+        ready = wait_for(f"{url}/ready", deadline)
+        startup = None
+        if ready is not None:
+            with urllib.request.urlopen(f"{url}/ready", timeout=2) as response:
+                startup = json.loads(response.read()).get("startup")
+    finally:
+        server.terminate()
+        server.wait()
+    return {
+        "health_ms": (healthy - started) * 1000 if healthy else None,
+        "ready_ms": (ready - started) * 1000 if ready else None,
+        "startup": startup,
+    }
+
+def summarize(imports: List[Dict[str, Any]], starts: List[Dict[str, Any]], top: int) -> Dict[str, Any]:
+    module_names = {name for run in imports for name in run["modules"]}
+    modules = {
+        name: median([run["modules"][name] for run in imports if name in run["modules"]])
+        for name in module_names
+    }
+    slowest = dict(sorted(modules.items(), key=lambda item: item[1], reverse=True)[:top])
+    server_stats = [run["startup"] for run in starts if run["startup"]]
+    return {
+        "import_ms": median([run["import_ms"] for run in imports if run["import_ms"] is not None]),
+        "import_wall_ms": median([run["wall_ms"] for run in imports]),
+        "slowest_imports_ms": slowest,
+        "health_ms": median([run["health_ms"] for run in starts if run["health_ms"] is not None]),
+        "ready_ms": median([run["ready_ms"] for run in starts if run["ready_ms"] is not None]),
+        "knowledge_load_ms": median([s["knowledge_load_ms"] for s in server_stats if "knowledge_load_ms" in s]),
+        "knowledge_warm_ms": median([s["knowledge_warm_ms"] for s in server_stats if "knowledge_warm_ms" in s]),
+        "knowledge_source": server_stats[0].get("knowledge_source") if server_stats else None,
+        "failed_starts": sum(1 for run in starts if run["ready_ms"] is None),
+    }
+
+def print_summary(summary: Dict[str, Any]) -> None:
+    def fmt(value):
+        return f"{value:.1f} ms" if value is not None else "-"
+
+    print(f"\n   import server          {fmt(summary['import_ms'])}")
+    print(f"   interpreter + import   {fmt(summary['import_wall_ms'])}")
+    print(f"   /health answering      {fmt(summary['health_ms'])}")
+    print(f"   /ready reporting ready {fmt(summary['ready_ms'])}")
+    print(f"   knowledge load         {fmt(summary['knowledge_load_ms'])} ({summary['knowledge_source'] or '-'})")
+    print(f"   knowledge warm         {fmt(summary['knowledge_warm_ms'])}")
+    if summary["failed_starts"]:
+        print(f"   ❌ {summary['failed_starts']} start(s) never became ready")
+    print("\n   Slowest imports:")
+    for name, ms in summary["slowest_imports_ms"].items():
+        print(f"      {name:<28}{fmt(ms)}")
+
+def compare_with_baseline(summary: Dict[str, Any], baseline_path: str) -> None:
+    """Print relative change against a previous result file"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)["summary"]
+    print(f"\n📈 Change vs {baseline_path} (positive = slower)")
+    for key in ("import_ms", "import_wall_ms", "health_ms", "ready_ms", "knowledge_load_ms"):
+        new_value, old_value = summary.get(key), baseline.get(key)
+        if new_value is not None and old_value:
+            print(f"   {key:<20} {old_value:.1f} -> {new_value:.1f} ms ({100 * (new_value - old_value) / old_value:+.1f}%)")
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure Custom LLM Server cold-start time")
+    parser.add_argument("--runs", type=int, default=5, help="Imports and server starts to measure")
+    parser.add_argument("--port", type=int, default=8011, help="Port for the started servers")
+    parser.add_argument("--timeout", type=float, default=60, help="Seconds to wait for a server to become ready")
+    parser.add_argument("--top", type=int, default=10, help="How many of the slowest imports to list")
+    parser.add_argument("--skip-server", action="store_true", help="Only measure the import")
+    parser.add_argument("--output", help="Write machine-readable JSON results here")
+    parser.add_argument("--baseline", help="Compare against an earlier --output file")
+    args = parser.parse_args()
+
+    print("🚀 Custom LLM Server Startup Benchmark")
+    print("=" * 40)
+    env = dict(os.environ)
+    env.setdefault("LLM_BACKEND", "stub")
+
+    imports, starts = [], []
+    for run in range(args.runs):
+        print(f"⏱️  run {run + 1}/{args.runs} ...")
+        imports.append(measure_import(env))
+        if not args.skip_server:
+            starts.append(measure_start(env, args.port, args.timeout))
+
+    summary = summarize(imports, starts, args.top)
+    print_summary(summary)
+    if args.output:
+        report = {
+            "meta": {
+                "timestamp": datetime.now().isoformat(),
+                "python": platform.python_version(),
+                "runs": args.runs,
+                "llm_backend": env["LLM_BACKEND"],
+                "knowledge_snapshot_dir": env.get("KNOWLEDGE_SNAPSHOT_DIR"),
+            },
+            "summary": summary,
+            "runs": {"imports": imports, "starts": starts},
+        }
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+        print(f"\n💾 Results written to {args.output}")
+    if args.baseline:
+        compare_with_baseline(summary, args.baseline)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,189 @@
+"""
+Server-sent event helpers for the Custom LLM Server
+OpenAI-format chunk encoding with precomputed framing, coalescing of small
+content deltas into time- or size-bounded chunks, and reassembly of
+streamed tool calls
+"""
+
+import asyncio
+import json
+import time
+import uuid
+from typing import Any, AsyncIterator, Dict, List, Optional, Set
+
+SSE_DONE = "data: [DONE]\n\n"
+
+# Headers that keep proxies from buffering the event stream
+SSE_HEADERS = {
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",
+}
+
+_encode = json.JSONEncoder(ensure_ascii=False, separators=(",", ":")).encode
+
+def new_completion_id() -> str:
+    return f"chatcmpl-{uuid.uuid4().hex[:24]}"
+
+class ChunkEncoder:
+    """Encodes one response's chunks as `data: ...` SSE events
+
+    Everything except the delta is fixed for a response, so the JSON around
+    it is rendered once and content deltas only cost one string encode.
+    """
+
+    def __init__(self, model: str, completion_id: Optional[str] = None, created: Optional[int] = None):
+        self.completion_id = completion_id or new_completion_id()
+        self.model = model
+        self.created = created or int(time.time())
+        header = _encode({
+            "id": self.completion_id,
+            "object": "chat.completion.chunk",
+            "created": self.created,
+            "model": self.model,
+        })
+        # '{"id":...,"model":"..."' without the closing brace
+        self._head = f"data: {header[:-1]},\"choices\":"
+        self._content_prefix = f"{self._head}[{{\"index\":0,\"delta\":{{\"content\":"
+        self._content_suffix = "},\"finish_reason\":null}]}\n\n"
+
+    def content(self, text: str) -> str:
+        """A content delta chunk"""
+        return f"{self._content_prefix}{_encode(text)}{self._content_suffix}"
+
+    def delta(self, delta: Dict[str, Any], finish_reason: Optional[str] = None) -> str:
+        """A chunk with an arbitrary delta"""
+        choice = {"index": 0, "delta": delta, "finish_reason": finish_reason}
+        return f"{self._head}[{_encode(choice)}]}}\n\n"
+
+    def tool_call(self, index: int, tool_call: Dict[str, Any]) -> str:
+        """A delta carrying one fully assembled tool call"""
+        return self.delta({"tool_calls": [dict(tool_call, index=index)]})
+
+    def finish(self, reason: str = "stop") -> str:
+        """The closing chunk with an empty delta and the finish reason"""
+        return self.delta({}, reason)
+
+    def extra(self, **fields) -> str:
+        """A chunk with no choices carrying server metadata fields"""
+        fields_json = _encode(fields)[1:-1]
+        return f"{self._head}[],{fields_json}}}\n\n"
+
+class ToolCallAccumulator:
+    """Rebuilds streamed tool calls from their fragments, keyed by index
+
+    A call counts as complete once it has an id and a name and its
+    arguments parse as a JSON object, which is usually well before the
+    stream ends when the model asks for several tools.
+    """
+
+    def __init__(self):
+        self.calls: Dict[int, Dict[str, Any]] = {}
+        self.completed: Set[int] = set()
+
+    def __bool__(self) -> bool:
+        return bool(self.calls)
+
+    def add(self, deltas: List[Dict[str, Any]]) -> List[int]:
+        """Merge fragments and return the indexes of calls that just became complete"""
+        touched: List[int] = []
+        for delta in deltas:
+            index = delta.get("index", 0)
+            entry = self.calls.setdefault(index, {
+                "id": "",
+                "type": "function",
+                "function": {"name": "", "arguments": ""}
+            })
+            if delta.get("id"):
+                entry["id"] = delta["id"]
+            function = delta.get("function") or {}
+            if function.get("name"):
+                entry["function"]["name"] += function["name"]
+            if function.get("arguments"):
+                entry["function"]["arguments"] += function["arguments"]
+            if index not in touched:
+                touched.append(index)
+        completed = [index for index in touched if index not in self.completed and self.is_complete(index)]
+        self.completed.update(completed)
+        return completed
+
+    def is_complete(self, index: int) -> bool:
+        call = self.calls[index]
+        arguments = call["function"]["arguments"].rstrip()
+        # Only parse when the text could be a whole object, so long arguments are not re-parsed per fragment
+        if not (call["id"] and call["function"]["name"] and arguments.endswith("}")):
+            return False
+        try:
+            return isinstance(json.loads(arguments), dict)
+        except ValueError:
+            return False
+
+    def ordered(self) -> List[Dict[str, Any]]:
+        return [self.calls[index] for index in sorted(self.calls)]
+
+async def coalesce_content(chunks: AsyncIterator[Dict[str, Any]], max_delay: float,
+                           max_chars: int) -> AsyncIterator[Dict[str, Any]]:
+    """Merge consecutive content-only chunks
+
+    Buffered text is flushed once it reaches max_chars, once max_delay has
+    passed since the first buffered piece, or when a non-content chunk
+    (tool calls, finish reason) arrives. A slow upstream never holds text
+    back for longer than max_delay.
+    """
+    iterator = chunks.__aiter__()
+    buffer: List[str] = []
+    buffered_chars = 0
+    template: Optional[Dict[str, Any]] = None
+    deadline = 0.0
+    pending: Optional[asyncio.Future] = None
+
+    def flush() -> Dict[str, Any]:
+        nonlocal buffer, buffered_chars, template
+        merged = dict(template, choices=[{"index": 0, "delta": {"content": "".join(buffer)}, "finish_reason": None}])
+        buffer, buffered_chars, template = [], 0, None
+        return merged
+
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(iterator.__anext__())
+            if buffer:
+                done, _ = await asyncio.wait({pending}, timeout=max(0.0, deadline - time.monotonic()))
+                if not done:
+                    yield flush()
+                    continue
+            try:
+                chunk = await pending
+            except StopAsyncIteration:
+                break
+            finally:
+                if pending.done():
+                    pending = None
+
+            choices = chunk.get("choices") or [{}]
+            delta = choices[0].get("delta") or {}
+            if delta.get("content") and not delta.get("tool_calls") and not choices[0].get("finish_reason"):
+                if not buffer:
+                    template = chunk
+                    deadline = time.monotonic() + max_delay
+                buffer.append(delta["content"])
+                buffered_chars += len(delta["content"])
+                if buffered_chars >= max_chars:
+                    yield flush()
+                continue
+
+            if buffer:
+                yield flush()
+            yield chunk
+
+        if buffer:
+            yield flush()
+    finally:
+        if pending is not None and not pending.done():
+            pending.cancel()
+            try:
+                await pending
+            except BaseException:
+                pass
+        aclose = getattr(iterator, "aclose", None)
+        if aclose is not None:
+            await aclose()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Tests for admission control
+Fair turns between clients, strict priorities, queue limits, deadlines and slot release
+"""
+
+import asyncio
+
+import pytest
+
+from admission import AdmissionController, AdmissionRejected
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+async def admit_in_order(controller, requests):
+    """Queue (client, priority) requests behind one held slot and return their admission order"""
+    order = []
+    holder = await controller.acquire("holder", "interactive")
+
+    async def request(client, priority):
+        ticket = await controller.acquire(client, priority)
+        order.append(client)
+        await settle()
+        ticket.release()
+
+    tasks = []
+    for client, priority in requests:
+        tasks.append(asyncio.create_task(request(client, priority)))
+        await settle()
+    holder.release()
+    await asyncio.gather(*tasks)
+    return order
+
+def test_admits_immediately_below_capacity():
+    async def scenario():
+        controller = AdmissionController(max_active=2)
+        tickets = [await controller.acquire("a", "interactive") for _ in range(2)]
+        assert controller.active == 2 and all(ticket.wait_seconds == 0.0 for ticket in tickets)
+        for ticket in tickets:
+            ticket.release()
+        return controller.active
+    assert asyncio.run(scenario()) == 0
+
+def test_clients_take_turns_within_a_priority():
+    controller = AdmissionController(max_active=1)
+    requests = [("a", "interactive")] * 3 + [("b", "interactive")] * 2 + [("c", "interactive")]
+    order = asyncio.run(admit_in_order(controller, requests))
+    assert order == ["a", "b", "c", "a", "b", "a"]
+
+def test_earlier_priority_classes_go_first():
+    controller = AdmissionController(max_active=1)
+    requests = [("bulk", "batch"), ("bulk", "batch"), ("user", "interactive")]
+    assert asyncio.run(admit_in_order(controller, requests)) == ["user", "bulk", "bulk"]
+
+def test_full_queues_reject_at_once_with_retry_after():
+    async def scenario():
+        controller = AdmissionController(max_active=1, max_queue=3, max_queue_per_client=2)
+        holder = await controller.acquire("holder", "interactive")
+        waiting = [asyncio.create_task(controller.acquire("a", "interactive")) for _ in range(2)]
+        await settle()
+        with pytest.raises(AdmissionRejected) as per_client:
+            await controller.acquire("a", "interactive")
+        waiting.append(asyncio.create_task(controller.acquire("b", "interactive")))
+        await settle()
+        with pytest.raises(AdmissionRejected) as full:
+            await controller.acquire("c", "interactive")
+        for task in waiting:
+            task.cancel()
+        await asyncio.gather(*waiting, return_exceptions=True)
+        holder.release()
+        return controller, per_client.value, full.value
+
+    controller, per_client, full = asyncio.run(scenario())
+    assert per_client.reason == "client_queue_full"
+    assert full.reason == "queue_full" and full.retry_after >= 1
+    assert controller.rejected == {"client_queue_full": 1, "queue_full": 1}
+    assert (controller.active, controller.queued) == (0, 0)
+
+def test_queue_deadline_rejects_and_leaves_the_queue():
+    async def scenario():
+        controller = AdmissionController(max_active=1, queue_timeouts={"interactive": 0.05})
+        holder = await controller.acquire("holder", "interactive")
+        with pytest.raises(AdmissionRejected) as timed_out:
+            await controller.acquire("a", "interactive")
+        holder.release()
+        return controller, timed_out.value
+    controller, timed_out = asyncio.run(scenario())
+    assert timed_out.reason == "queue_timeout"
+    assert (controller.active, controller.queued, controller.stats()["queued_clients"]) == (0, 0, 0)
+
+def test_cancelled_waiters_do_not_leak_slots():
+    async def scenario():
+        controller = AdmissionController(max_active=1)
+        holder = await controller.acquire("holder", "interactive")
+        waiter = asyncio.create_task(controller.acquire("a", "interactive"))
+        await settle()
+        # Admitted and cancelled in the same tick: the slot must be handed on
+        holder.release()
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        return controller
+    controller = asyncio.run(scenario())
+    assert (controller.active, controller.queued) == (0, 0)
+
+def test_release_is_idempotent_and_rejects_unknown_priorities():
+    async def scenario():
+        controller = AdmissionController(max_active=1)
+        ticket = await controller.acquire("a", "batch")
+        ticket.release()
+        ticket.release()
+        with pytest.raises(ValueError):
+            await controller.acquire("a", "urgent")
+        return controller
+    controller = asyncio.run(scenario())
+    assert controller.active == 0 and controller.admitted == 1
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+Tests for batch completions
+Bounded concurrency, per-record failures, journal resume and the streaming endpoint
+"""
+
+import asyncio
+import json
+import os
+import time
+import uuid
+
+import httpx
+
+import server
+from batch import BatchJournal, iter_jsonl, prune_journals, run_batch
+
+def collect(records, handler, concurrency=2, journal=None):
+    async def scenario():
+        return [json.loads(line) async for line in run_batch(records, handler, concurrency, "batch-test", journal)]
+    return asyncio.run(scenario())
+
+def upload(*records):
+    return "\n\n".join(record if isinstance(record, str) else json.dumps(record) for record in records).encode()
+
+def test_blank_lines_are_skipped_and_indexes_stay_dense():
+    assert list(iter_jsonl(b'{"a": 1}\n\n  \n{"b": 2}\n\xff\n')) == [(0, '{"a": 1}'), (1, '{"b": 2}'), (2, "�")]
+
+def test_records_run_with_bounded_concurrency_and_isolated_failures():
+    running, peak = 0, 0
+
+    async def handler(record):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01 * record["n"])
+        running -= 1
+        if record["n"] == 2:
+            raise ValueError("bad record")
+        return {"n": record["n"], "usage": {"prompt_tokens": 1, "completion_tokens": 2}}
+
+    data = upload(*({"custom_id": f"r{n}", "n": n} for n in (5, 1, 2, 3)), "not json")
+    lines = collect(iter_jsonl(data), handler, concurrency=2)
+    summary = lines.pop()["summary"]
+    assert peak == 2
+    assert sorted(line["index"] for line in lines) == [0, 1, 2, 3, 4]
+    by_index = {line["index"]: line for line in lines}
+    assert by_index[0]["response"]["n"] == 5 and by_index[0]["custom_id"] == "r5"
+    assert by_index[2]["error"] == {"type": "ValueError", "message": "bad record"}
+    assert by_index[4]["error"]["type"] == "JSONDecodeError"
+    # Results stream in completion order, not input order
+    assert lines[0]["index"] == 1
+    assert (summary["succeeded"], summary["failed"], summary["completion_tokens"]) == (3, 2, 6)
+
+def test_journal_resumes_only_the_records_that_did_not_succeed(tmp_path):
+    calls = []
+
+    async def flaky(record):
+        calls.append(record["n"])
+        if record["n"] == 1 and calls.count(1) == 1:
+            raise ConnectionError("upstream went away")
+        return {"n": record["n"]}
+
+    data = upload(*({"n": n} for n in range(3)))
+    first = collect(iter_jsonl(data), flaky, journal=BatchJournal(str(tmp_path), "batch-resume"))
+    assert first[-1]["summary"]["failed"] == 1
+    with open(tmp_path / "batch-resume.jsonl", "a", encoding="utf-8") as f:
+        f.write('{"index": 1, "respo')
+
+    second = collect(iter_jsonl(data), flaky, journal=BatchJournal(str(tmp_path), "batch-resume"))
+    assert calls[3:] == [1]
+    summary = second.pop()["summary"]
+    assert (summary["succeeded"], summary["resumed"], summary["total"]) == (1, 2, 3)
+    assert sorted(line["index"] for line in second if line.get("resumed")) == [0, 2]
+
+def test_journal_ids_are_checked_and_old_journals_pruned(tmp_path):
+    try:
+        BatchJournal(str(tmp_path), "../escape")
+        raise AssertionError("expected ValueError")
+    except ValueError:
+        pass
+    stale, fresh = tmp_path / "stale.jsonl", tmp_path / "fresh.jsonl"
+    stale.write_text("")
+    fresh.write_text("")
+    os.utime(stale, (time.time() - 3600, time.time() - 3600))
+    assert prune_journals(str(tmp_path), 60) == 1
+    assert not stale.exists() and fresh.exists()
+
+def test_endpoint_streams_ndjson_results_with_a_summary(tmp_path, monkeypatch):
+    monkeypatch.setattr(server, "BATCH_JOURNAL_DIR", str(tmp_path))
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            data = upload(
+                {"custom_id": "a", "model": "gpt-3.5-turbo", "messages": [{"role": "user", "content": f"batch {uuid.uuid4()}"}]},
+                {"custom_id": "b", "model": "gpt-3.5-turbo"},
+            )
+            response = await client.post("/batch/chat/completions?batch_id=batch-endpoint", content=data)
+            rejected = await client.post("/batch/chat/completions?batch_id=bad/id", content=data)
+            return response, rejected
+
+    response, rejected = asyncio.run(scenario())
+    assert response.headers["X-Batch-Id"] == "batch-endpoint"
+    assert response.headers["content-type"].startswith("application/x-ndjson")
+    lines = [json.loads(line) for line in response.text.splitlines()]
+    by_id = {line.get("custom_id"): line for line in lines[:-1]}
+    assert by_id["a"]["response"]["choices"][0]["message"]["role"] == "assistant"
+    assert by_id["b"]["error"]["type"] == "ValidationError"
+    assert lines[-1]["summary"]["succeeded"] == 1
+    assert (tmp_path / "batch-endpoint.jsonl").exists()
+    assert rejected.status_code == 400
@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+"""
+Tests for the benchmark harness
+Percentile math, request payloads, and a benchmark level run against the mock upstream
+"""
+
+import asyncio
+
+import httpx
+import pytest
+import uvicorn
+
+import mock_upstream
+from benchmark import build_payload, is_heavy, latency_summary, percentile, run_level
+
+@pytest.fixture
+def fast_mock(monkeypatch):
+    monkeypatch.setattr(mock_upstream, "MOCK_TTFT_SECONDS", 0.01)
+    monkeypatch.setattr(mock_upstream, "MOCK_TOKENS_PER_SECOND", 1000)
+    monkeypatch.setattr(mock_upstream, "MOCK_RESPONSE_TOKENS", 5)
+    monkeypatch.setattr(mock_upstream, "MOCK_ERROR_RATE", 0)
+    monkeypatch.setattr(mock_upstream, "TRACE_CALLS", {})
+
+def test_percentiles_interpolate_and_tolerate_empty_samples():
+    assert percentile([], 50) is None
+    assert percentile([3, 1, 2, 4], 50) == 2.5
+    assert percentile([1, 2, 3, 4, 5], 95) == pytest.approx(4.8)
+    summary = latency_summary([0.001, 0.002, 0.003])
+    assert (summary["p50_ms"], summary["max_ms"], summary["mean_ms"]) == (2.0, 3.0, 2.0)
+    assert latency_summary([])["p99_ms"] is None
+
+def test_payloads_are_unique_unless_identical_and_heavy_ones_are_spread():
+    first, second = (build_payload(i, True, "m", "hi", False) for i in (1, 2))
+    assert first["messages"] != second["messages"]
+    assert build_payload(1, False, "m", "hi", True)["messages"] == [{"role": "user", "content": "hi"}]
+    heavy = build_payload(3, True, "m", "hi", False, {"messages": 4, "chars": 100})
+    assert len(heavy["messages"]) == 5 and all(len(m["content"]) == 100 for m in heavy["messages"][:4])
+    assert [i for i in range(20) if is_heavy(i, 0.25)] == [0, 4, 8, 12, 16]
+    assert not any(is_heavy(i, 0) for i in range(20))
+
+def test_mock_upstream_speaks_the_openai_format(fast_mock):
+    async def run():
+        transport = httpx.ASGITransport(app=mock_upstream.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://mock") as client:
+            plain = (await client.post("/v1/chat/completions", json={"model": "m", "messages": []})).json()
+            streamed = (await client.post("/v1/chat/completions", json={"model": "m", "messages": [], "stream": True})).text
+        return plain, streamed
+    plain, streamed = asyncio.run(run())
+    assert plain["choices"][0]["message"]["content"] == "our support team is available"
+    events = [line for line in streamed.split("\n\n") if line]
+    assert len(events) == 7 and events[-1] == "data: [DONE]"
+
+def test_run_level_measures_a_live_server(fast_mock):
+    async def run():
+        config = uvicorn.Config(mock_upstream.app, host="127.0.0.1", port=0, log_level="warning")
+        server = uvicorn.Server(config)
+        serving = asyncio.create_task(server.serve())
+        while not server.started:
+            await asyncio.sleep(0.01)
+        port = server.servers[0].sockets[0].getsockname()[1]
+        try:
+            return await asyncio.gather(*(
+                run_level(f"http://127.0.0.1:{port}", 4, 12, stream, "m", "hi", False, 10) for stream in (True, False)
+            ))
+        finally:
+            server.should_exit = True
+            await serving
+
+    streamed, plain = asyncio.run(run())
+    assert (streamed["successes"], plain["successes"]) == (12, 12)
+    assert streamed["errors"] == {} and streamed["mode"] == "stream"
+    assert streamed["ttft"]["p50_ms"] >= 10 and streamed["inter_token"]["p50_ms"] is not None
+    assert plain["inter_token"]["p50_ms"] is None
+    assert streamed["requests_per_s"] > 0
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Tests for the calculator expression engine
+Parsing, evaluation limits, the process-pool guard and batch/scalar equivalence
+"""
+
+import asyncio
+import random
+
+import pytest
+
+from calculator import CalculationError, Calculator, Limits, canonical_expression, compile_expression, evaluate_program
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+def scalar_results(calculator, expressions):
+    return [run(calculator.calculate(expression)) for expression in expressions]
+
+def test_compiles_arithmetic_to_postfix():
+    compiled = compile_expression("2 * (3 + 4)")
+    assert compiled.shape == ("const", "const", "const", "add", "mul")
+    assert compiled.constants == (2, 3, 4)
+    assert evaluate_program(compiled.program) == 14
+
+@pytest.mark.parametrize("expression", ["__import__('os')", "os.system(1)", "(1, 2)", "[1, 2]", "1 if 1 else 2"])
+def test_rejects_anything_but_arithmetic(expression):
+    # Letters, quotes, commas and colons are sanitized away; what is left must not parse
+    with pytest.raises(CalculationError):
+        evaluate_program(compile_expression(expression).program)
+
+def test_rejects_empty_and_oversized_expressions():
+    with pytest.raises(CalculationError):
+        compile_expression("abc")
+    with pytest.raises(CalculationError):
+        compile_expression("1+" * 600 + "1")
+
+def test_canonical_expression_ignores_spacing_only():
+    assert canonical_expression("2*(3+4)") == canonical_expression(" 2 * ( 3 + 4 ) ")
+    assert canonical_expression("1 2") != canonical_expression("12")
+
+def test_limits_reject_large_exponents_and_magnitudes():
+    limits = Limits(max_exponent=100, max_magnitude=1e20, max_steps=10)
+    with pytest.raises(CalculationError, match="Exponent"):
+        evaluate_program(compile_expression("9 ** 9 ** 9").program, limits)
+    with pytest.raises(CalculationError, match="exceeds"):
+        evaluate_program(compile_expression("10 ** 21").program, limits)
+    # Intermediate results are checked, not only the final one
+    with pytest.raises(CalculationError, match="exceeds"):
+        evaluate_program(compile_expression("100000000000000.0 * 100000000000000.0 / 100000000000000.0").program, limits)
+    with pytest.raises(CalculationError, match="steps"):
+        compile_expression("1+1+1+1+1+1+1", limits.max_steps)
+
+def test_division_by_zero_is_an_error_result():
+    calculator = Calculator()
+    result = run(calculator.calculate("1 / 0"))
+    assert result == {"expression": "1 / 0", "error": "division by zero", "success": False}
+
+def test_pow_runs_in_worker_and_times_out():
+    calculator = Calculator(Limits(max_exponent=10 ** 9, max_magnitude=float("inf")), timeout=0.2, max_workers=1)
+    try:
+        assert run(calculator.calculate("2 ** 10"))["result"] == 1024
+        result = run(calculator.calculate("7 ** 300000000"))
+        assert not result["success"] and "timed out" in result["error"]
+        # The stuck pool was replaced, so later calls still work
+        assert run(calculator.calculate("3 ** 3"))["result"] == 27
+    finally:
+        calculator.shutdown()
+
+def test_batch_matches_scalar_for_large_integers():
+    calculator = Calculator(vectorize_min_batch=2)
+    expressions = ["12345678901234567 - 12345678901234566"] * 8
+    batch = run(calculator.calculate_batch(expressions))
+    assert [r["result"] for r in batch] == [1] * 8
+    assert batch == scalar_results(Calculator(), expressions)
+
+def test_batch_matches_scalar_when_intermediates_overflow_the_limits():
+    limits = Limits(max_magnitude=1e20)
+    expressions = ["100000000000000.0 * 100000000000000.0 / 100000000000000.0", "2 * 3 / 4", "4000000000 * 4000000000 - 1", "94906267 * 94906267 - 1"]
+    batch = run(Calculator(limits, vectorize_min_batch=2).calculate_batch(expressions))
+    assert batch == scalar_results(Calculator(limits), expressions)
+
+def test_batch_matches_scalar_on_random_programs():
+    rng = random.Random(11)
+    numbers = ["0", "1", "7", "2.5", "0.1", "3000000", "99999999999", "12345678901234567", "1000000000000000000000000000000.0"]
+    expressions = []
+    for _ in range(400):
+        a, b, c = (rng.choice(numbers) for _ in range(3))
+        op1, op2 = rng.choice("+-*/"), rng.choice("+-*/")
+        expressions.append(f"-{a} {op1} ({b} {op2} {c})")
+    batch = run(Calculator(vectorize_min_batch=2).calculate_batch(expressions))
+    scalar = scalar_results(Calculator(), expressions)
+    for batch_result, scalar_result in zip(batch, scalar):
+        assert batch_result == scalar_result
+        if batch_result["success"]:
+            assert type(batch_result["result"]) is type(scalar_result["result"])
@@ -0,0 +1,150 @@
+#!/usr/bin/env python3
+"""
+Tests for request coalescing
+Single-flight calls, shared streams, late joiners and producer cancellation
+"""
+
+import asyncio
+
+import pytest
+
+from coalesce import Coalescer
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+def test_concurrent_calls_share_one_factory_run():
+    async def scenario():
+        coalescer = Coalescer()
+        runs = 0
+
+        async def factory():
+            nonlocal runs
+            runs += 1
+            await asyncio.sleep(0.01)
+            return "answer"
+
+        results = await asyncio.gather(*(coalescer.call("k", factory) for _ in range(5)))
+        return runs, results, coalescer.stats()
+
+    runs, results, stats = run(scenario())
+    assert runs == 1
+    assert results == [("answer", 5)] * 5
+    assert stats == {"in_flight_calls": 0, "in_flight_streams": 0, "upstream_calls": 1, "coalesced_requests": 4}
+
+def test_call_survives_one_waiter_cancelling_and_stops_when_all_do():
+    async def scenario():
+        coalescer = Coalescer()
+        started = asyncio.Event()
+
+        async def factory():
+            started.set()
+            await asyncio.sleep(0.05)
+            return "answer"
+
+        first = asyncio.ensure_future(coalescer.call("k", factory))
+        second = asyncio.ensure_future(coalescer.call("k", factory))
+        await started.wait()
+        first.cancel()
+        kept = await second
+
+        never = asyncio.Event()
+
+        async def slow():
+            await never.wait()
+
+        only = asyncio.ensure_future(coalescer.call("slow", slow))
+        await asyncio.sleep(0)
+        shared_task = coalescer._calls["slow"].task
+        only.cancel()
+        await asyncio.gather(only, return_exceptions=True)
+        await asyncio.sleep(0)
+        return kept, shared_task.cancelled(), coalescer.stats()["in_flight_calls"]
+
+    kept, cancelled, in_flight = run(scenario())
+    assert kept == ("answer", 2)
+    assert cancelled
+    assert in_flight == 0
+
+async def produce(chunks, gate=None, fail=None):
+    for chunk in chunks:
+        if gate is not None:
+            await gate.wait()
+        yield chunk
+    if fail is not None:
+        raise fail
+
+def test_late_joiner_replays_missed_chunks():
+    async def scenario():
+        coalescer = Coalescer()
+        gate = asyncio.Event()
+
+        async def source():
+            yield "a"
+            await gate.wait()
+            yield "b"
+            yield "c"
+
+        shared = coalescer.stream("k", source)
+        first = shared.attach()
+        received = [await first.__anext__()]
+        late = coalescer.stream("k", lambda: produce(["x"]))
+        assert late is shared
+        second = shared.attach()
+        gate.set()
+        received += [chunk async for chunk in first]
+        return received, [chunk async for chunk in second], shared.joined, shared.subscribers
+
+    first, second, joined, subscribers = run(scenario())
+    assert first == second == ["a", "b", "c"]
+    assert joined == 2
+    assert subscribers == 0
+
+def test_stream_error_reaches_every_follower():
+    async def scenario():
+        shared = Coalescer().stream("k", lambda: produce(["a"], fail=RuntimeError("upstream failed")))
+        outcomes = []
+        for subscription in (shared.attach(), shared.attach()):
+            try:
+                async for _ in subscription:
+                    pass
+            except RuntimeError as e:
+                outcomes.append(str(e))
+        return outcomes
+
+    assert run(scenario()) == ["upstream failed", "upstream failed"]
+
+def test_subscriber_that_never_reads_still_releases_the_producer():
+    async def scenario():
+        coalescer = Coalescer()
+        never = asyncio.Event()
+        shared = coalescer.stream("k", lambda: produce(["a"], never))
+        reader, idle = shared.attach(), shared.attach()
+        reader_task = asyncio.ensure_future(reader.__anext__())
+        await asyncio.sleep(0)
+        # The reading client goes away; the idle one is still attached
+        reader_task.cancel()
+        await asyncio.gather(reader_task, return_exceptions=True)
+        alive_with_idle = not shared._task.done()
+        # The idle client disconnects before its body was ever iterated
+        idle.release()
+        idle.release()
+        await asyncio.sleep(0)
+        return alive_with_idle, shared._task.cancelled(), shared.subscribers, coalescer.stats()["in_flight_streams"]
+
+    alive_with_idle, cancelled, subscribers, in_flight = run(scenario())
+    assert alive_with_idle
+    assert cancelled
+    assert subscribers == 0
+    assert in_flight == 0
+
+def test_released_subscription_stops_iterating():
+    async def scenario():
+        shared = Coalescer().stream("k", lambda: produce(["a", "b"]))
+        keep, leave = shared.attach(), shared.attach()
+        await leave.aclose()
+        with pytest.raises(StopAsyncIteration):
+            await leave.__anext__()
+        return [chunk async for chunk in keep]
+
+    assert run(scenario()) == ["a", "b"]
@@ -0,0 +1,46 @@
+#!/usr/bin/env python3
+"""
+Tests for the completion cache
+Only finished answers are cached, for streamed and non-streamed requests
+"""
+
+import asyncio
+import json
+
+import httpx
+
+import server
+
+def post_twice(payload):
+    async def scenario():
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            first = await client.post("/chat/completions", json=payload)
+            second = await client.post("/chat/completions", json=payload)
+            return first, second
+    return asyncio.run(scenario())
+
+def stream_finish_reason(response):
+    events = [line[len("data: "):] for line in response.text.splitlines() if line.startswith("data: ")]
+    reasons = [choice["finish_reason"] for event in events if event != "[DONE]"
+               for choice in json.loads(event)["choices"] if choice.get("finish_reason")]
+    return reasons[-1]
+
+def payload(content, stream, **extra):
+    return {"model": "m", "messages": [{"role": "user", "content": content}], "stream": stream, **extra}
+
+def test_finished_stream_is_cached_and_replayed_as_finished():
+    first, second = post_twice(payload("cache a finished stream", True))
+    assert (first.headers["x-cache"], second.headers["x-cache"]) == ("MISS", "HIT")
+    assert stream_finish_reason(second) == "stop"
+
+def test_stream_cut_off_at_max_tokens_is_not_cached():
+    first, second = post_twice(payload("cache a truncated stream", True, max_tokens=3))
+    assert stream_finish_reason(first) == "length"
+    assert (first.headers["x-cache"], second.headers["x-cache"]) == ("MISS", "MISS")
+    assert stream_finish_reason(second) == "length"
+
+def test_completion_cut_off_at_max_tokens_is_not_cached():
+    first, second = post_twice(payload("cache a truncated completion", False, max_tokens=3))
+    assert first.json()["choices"][0]["finish_reason"] == "length"
+    assert (first.headers["x-cache"], second.headers["x-cache"]) == ("MISS", "MISS")
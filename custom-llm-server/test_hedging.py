@@ -0,0 +1,157 @@
+#!/usr/bin/env python3
+"""
+Tests for hedged and fallback upstream requests
+Circuit breaker states, hedging after the delay, failover and cancelling the loser
+"""
+
+import asyncio
+import time
+
+import pytest
+
+from hedging import CircuitBreaker, HedgingUpstream, Route
+from upstream import UpstreamError
+
+class FakeClient:
+    """Answers after delay seconds, or raises when fail is set; records what was cancelled or closed"""
+
+    def __init__(self, name, delay=0.0, fail=False):
+        self.name = name
+        self.delay = delay
+        self.fail = fail
+        self.calls = 0
+        self.cancelled = 0
+        self.closed_streams = 0
+
+    async def complete(self, **params):
+        self.calls += 1
+        try:
+            await asyncio.sleep(self.delay)
+        except asyncio.CancelledError:
+            self.cancelled += 1
+            raise
+        if self.fail:
+            raise UpstreamError(f"{self.name} failed", status=502)
+        return {"route": self.name, "model": params.get("model")}
+
+    async def stream(self, **params):
+        self.calls += 1
+        try:
+            yield {"choices": [{"delta": {"role": "assistant"}}]}
+            await asyncio.sleep(self.delay)
+            if self.fail:
+                raise UpstreamError(f"{self.name} failed", status=502)
+            for word in (self.name, " done"):
+                yield {"choices": [{"delta": {"content": word}}]}
+        finally:
+            self.closed_streams += 1
+
+    def stats(self):
+        return {}
+
+    async def aclose(self):
+        pass
+
+def upstream(*clients, **options):
+    routes = [Route(client.name, client, breaker=CircuitBreaker(failure_threshold=2, reset_seconds=0.05))
+              for client in clients]
+    return HedgingUpstream(routes, default_hedge_delay=0.05, **options)
+
+def test_breaker_opens_probes_once_and_closes():
+    breaker = CircuitBreaker(failure_threshold=2, reset_seconds=0.05)
+    breaker.record_failure()
+    assert breaker.state == "closed" and breaker.available()
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.available()
+
+    time.sleep(0.06)
+    assert breaker.available()
+    breaker.on_attempt()
+    # Only one probe at a time while half open
+    assert breaker.state == "half_open" and not breaker.available()
+    breaker.record_failure()
+    assert breaker.state == "open" and breaker.stats()["times_opened"] == 2
+
+    time.sleep(0.06)
+    breaker.on_attempt()
+    breaker.record_abandoned()
+    assert breaker.available()
+    breaker.on_attempt()
+    breaker.record_success()
+    assert breaker.state == "closed" and breaker.consecutive_failures == 0
+
+def test_fast_route_is_not_hedged():
+    primary, backup = FakeClient("primary"), FakeClient("backup")
+    hedger = upstream(primary, backup)
+    assert asyncio.run(hedger.complete(model="m"))["route"] == "primary"
+    assert (backup.calls, hedger.hedges) == (0, 0)
+
+def test_slow_route_is_hedged_and_the_loser_cancelled():
+    primary, backup = FakeClient("primary", delay=1.0), FakeClient("backup")
+    hedger = upstream(primary, backup)
+    started = time.perf_counter()
+    assert asyncio.run(hedger.complete(model="m"))["route"] == "backup"
+    assert time.perf_counter() - started < 0.5
+    assert (hedger.hedges, hedger.hedge_wins, primary.cancelled) == (1, 1, 1)
+    # Cancelling the loser is not a failure of its backend, nor a latency sample
+    assert primary.calls == 1 and hedger.routes[0].breaker.state == "closed"
+    assert (len(hedger.routes[0].latency), len(hedger.routes[1].latency)) == (0, 1)
+
+def test_cancelled_callers_leave_no_latency_samples():
+    primary = FakeClient("primary", delay=1.0)
+    hedger = upstream(primary, hedging=False)
+
+    async def run():
+        task = asyncio.ensure_future(hedger.complete(model="m"))
+        await asyncio.sleep(0.05)
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+    asyncio.run(run())
+    assert primary.cancelled == 1
+    assert len(hedger.routes[0].latency) == 0 and hedger.routes[0].breaker.available()
+
+def test_hedges_are_capped_by_ratio():
+    primary, backup = FakeClient("primary", delay=0.1), FakeClient("backup", delay=0.1)
+    hedger = upstream(primary, backup, max_hedge_ratio=0.0)
+
+    async def run():
+        for _ in range(3):
+            await hedger.complete(model="m")
+    asyncio.run(run())
+    assert hedger.hedges == 1
+
+def test_failure_fails_over_and_opens_the_breaker():
+    primary, backup = FakeClient("primary", fail=True), FakeClient("backup")
+    hedger = upstream(primary, backup, hedging=False)
+
+    async def run():
+        return [(await hedger.complete(model="m"))["route"] for _ in range(3)]
+    assert asyncio.run(run()) == ["backup"] * 3
+    # The third request skipped the open breaker instead of failing over again
+    assert (primary.calls, hedger.failovers) == (2, 2)
+    assert hedger.routes[0].breaker.state == "open"
+
+def test_all_breakers_open_rejects_with_503():
+    primary = FakeClient("primary", fail=True)
+    hedger = upstream(primary, hedging=False)
+
+    async def run():
+        for _ in range(2):
+            with pytest.raises(UpstreamError):
+                await hedger.complete(model="m")
+        with pytest.raises(UpstreamError) as rejected:
+            await hedger.complete(model="m")
+        return rejected.value
+    assert asyncio.run(run()).status == 503
+    assert primary.calls == 2 and hedger.rejected == 1
+
+def test_stream_hedge_replays_the_winner_and_closes_the_loser():
+    primary, backup = FakeClient("primary", delay=1.0), FakeClient("backup")
+    hedger = upstream(primary, backup)
+
+    async def run():
+        return [chunk async for chunk in hedger.stream(model="m")]
+    chunks = asyncio.run(run())
+    assert chunks[0]["choices"][0]["delta"] == {"role": "assistant"}
+    assert "".join(c["choices"][0]["delta"].get("content", "") for c in chunks) == "backup done"
+    assert primary.closed_streams == 1 and backup.closed_streams == 1
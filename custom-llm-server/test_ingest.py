@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Tests for document ingestion
+Chunking, the journal and its replay into rebuilt indexes, and the server's use of both
+"""
+
+import asyncio
+
+import httpx
+
+import server
+from ingest import IngestJournal, Ingestor, chunk_text
+from retrieval import BM25Index, Document, HashingEmbedder, HybridRetriever, VectorIndex
+from snapshot import load_snapshot, write_snapshot
+
+BASE = [Document("faq:shipping", "shipping", "Free shipping on orders over $50.", "faq")]
+LONG_TEXT = " ".join(f"zebra{i} giraffe" for i in range(300))
+
+def build_indexes():
+    index = BM25Index()
+    index.add_documents(BASE)
+    vector_index = VectorIndex(HashingEmbedder(64))
+    vector_index.add_documents(BASE)
+    return index, vector_index
+
+def ids(results):
+    return [document.doc_id for document, _ in results]
+
+def ingest(journal, index, vector_index, upserts=(), deletes=()):
+    async def scenario():
+        ingestor = Ingestor(lambda: (index, vector_index), lambda: None, chunk_chars=200, chunk_overlap=20,
+                            journal=journal)
+        jobs = []
+        if upserts:
+            jobs.append(ingestor.upsert(list(upserts)))
+        if deletes:
+            jobs.append(ingestor.delete(list(deletes)))
+        while any(job.finished is None for job in jobs):
+            await asyncio.sleep(0.01)
+        ingestor.shutdown()
+        return jobs
+    return asyncio.run(scenario())
+
+def test_chunks_overlap_and_respect_the_size_limit():
+    chunks = chunk_text(LONG_TEXT, 200, 20)
+    assert len(chunks) > 1
+    assert all(len(chunk) <= 200 for chunk in chunks)
+    assert chunks[0].split()[-1] in chunks[1]
+
+def test_journal_replays_ingested_documents_into_rebuilt_indexes(tmp_path):
+    path = str(tmp_path / "journal.jsonl")
+    index, vector_index = build_indexes()
+    pets = Document("pets", "pet_policy", "Hamsters ride free on Tuesdays.")
+    ingest(IngestJournal(path), index, vector_index, upserts=[pets, Document("long", "long", LONG_TEXT)])
+    ingest(IngestJournal(path), index, vector_index, deletes=["faq:shipping"])
+
+    # A restart: fresh indexes from the base documents, then the journal
+    journal = IngestJournal(path)
+    index, vector_index = build_indexes()
+    assert journal.replay(index, vector_index, 200, 20) == 3
+    assert ids(index.search("hamsters tuesdays", 1)) == ["pets"]
+    assert ids(vector_index.search("hamsters tuesdays", 1)) == ["pets"]
+    assert "faq:shipping" not in ids(index.search("free shipping orders", 3))
+    assert len(vector_index) == len(index)
+
+    # Chunks indexed by the replay are still found by their document's id
+    ingest(journal, index, vector_index, upserts=[Document("long", "long", "Short now.")])
+    assert ids(index.search("zebra299", 3)) == []
+    ingest(journal, index, vector_index, deletes=["long"])
+    assert ids(index.search("short", 3)) == []
+
+def test_journal_compacts_superseded_versions(tmp_path):
+    path = tmp_path / "journal.jsonl"
+    journal = IngestJournal(str(path))
+    for version in range(5):
+        journal.record_upserts([Document("doc", "doc", f"version {version}")])
+    journal.record_deletes(["gone"])
+    journal.close()
+    assert len(path.read_text().splitlines()) == 6
+    with open(path, "a", encoding="utf-8") as f:
+        f.write('{"upsert": [{"doc_id": "torn"')
+
+    reloaded = IngestJournal(str(path))
+    assert [d.text for d in reloaded.documents] == ["version 4"]
+    assert reloaded.deleted == ["gone"]
+    assert len(path.read_text().splitlines()) == 2
+
+def test_ingested_documents_reach_the_full_prompt_and_survive_a_reload():
+    async def scenario():
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            async def wait(response):
+                job_id = response.json()["job_id"]
+                while (await client.get(f"/ingest/jobs/{job_id}")).json()["status"] not in ("done", "failed"):
+                    await asyncio.sleep(0.01)
+
+            await wait(await client.post("/documents", json={"documents": [
+                {"id": "parrots", "title": "parrot_policy", "text": "Parrots fly free on Fridays."}]}))
+            await wait(await client.delete("/documents/faq:warranty"))
+            prompt = server.get_rag_system_message()["content"]
+            reload = await client.post("/admin/knowledge/reload")
+            return prompt, reload.status_code
+
+    prompt, status = asyncio.run(scenario())
+    assert "parrot_policy: Parrots fly free on Fridays." in prompt
+    assert "warranty" not in prompt
+    assert status == 200
+    assert ids(server.KNOWLEDGE_INDEX.search("parrots fridays", 1)) == ["parrots"]
+    assert "faq:warranty" not in ids(server.KNOWLEDGE_INDEX.search("warranty lifetime support", 5))
+    assert "Parrots fly free" in server.get_rag_system_message()["content"]
+
+def test_snapshot_after_replace_and_delete_keeps_vectors_aligned(tmp_path):
+    index, vector_index = build_indexes()
+    ingest(IngestJournal(), index, vector_index, upserts=[
+        Document("returns", "returns", "Returns are accepted within 30 days."),
+        Document("hours", "hours", "Support is open from nine to five."),
+        Document("pets", "pets", "Dogs are welcome in every store."),
+    ])
+    ingest(IngestJournal(), index, vector_index, upserts=[Document("returns", "returns", "Returns are accepted within 90 days.")],
+           deletes=["hours"])
+    assert len(vector_index.matrix) > index.live_documents
+
+    write_snapshot(str(tmp_path), index, vector_index)
+    snapshot = load_snapshot(str(tmp_path), embedder=vector_index.embedder)
+    assert len(snapshot.vector_index.matrix) == len(snapshot.keyword_index.documents) == 3
+
+    semantic = snapshot.vector_index.search("dogs welcome store", 3)
+    assert semantic[0][0].doc_id == "pets"
+    hybrid = HybridRetriever(snapshot.keyword_index, snapshot.vector_index).search("returns 90 days", 3)
+    assert hybrid[0][0].doc_id == "returns" and "90 days" in hybrid[0][0].text
+    assert "hours" not in ids(hybrid)
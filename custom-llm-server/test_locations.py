@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Tests for the location table
+Exact, alias, prefix and typo-tolerant lookups, country qualifiers, CSV loading and get_weather
+"""
+
+import asyncio
+
+import server
+from locations import LocationTableBuilder, build_location_table, edit_distance, normalize_name
+
+SEED = {
+    "paris": {"name": "Paris", "country": "FR", "temp": 18, "condition": "Cloudy", "humidity": 70,
+              "population": 2100000},
+    "paris_tx": {"name": "Paris", "country": "US", "temp": 30, "condition": "Sunny", "humidity": 40,
+                 "population": 25000},
+    "london": {"name": "London", "country": "GB", "temp": 12, "condition": "Rainy", "humidity": 85,
+               "population": 8900000},
+    "new_york": {"name": "New York", "country": "US", "temp": 20, "condition": "Sunny", "humidity": 55,
+                 "population": 8300000, "aliases": ["NYC", "Big Apple"]},
+    "sao_paulo": {"name": "São Paulo", "country": "BR", "temp": 25, "condition": "Humid", "humidity": 80,
+                  "population": 12300000},
+}
+
+def resolve(table, query):
+    match = table.lookup(query)
+    return (table.display_name(match.row), match.matched_by) if match.row is not None else None
+
+def test_names_fold_accents_and_punctuation():
+    assert normalize_name("  São_Paulo!! ") == "sao paulo"
+    assert normalize_name("New-York") == "new york"
+    # A swapped pair of letters is one edit
+    assert edit_distance("london", "lodnon", 2) == 1
+    assert edit_distance("london", "berlin", 2) == 3
+    assert edit_distance("paris", "paris", 0) == 0
+
+def test_lookups_go_exact_then_prefix_then_fuzzy():
+    table = build_location_table(SEED)
+    assert resolve(table, "paris") == ("Paris, FR", "exact")
+    assert resolve(table, "NYC") == ("New York, US", "exact")
+    assert resolve(table, "sao paulo") == ("São Paulo, BR", "exact")
+    assert resolve(table, "lond") == ("London, GB", "prefix")
+    assert resolve(table, "Lodnon") == ("London, GB", "fuzzy")
+    assert resolve(table, "New Yrok") == ("New York, US", "fuzzy")
+
+def test_country_qualifiers_narrow_the_match():
+    table = build_location_table(SEED)
+    assert resolve(table, "Paris, USA") == ("Paris, US", "exact")
+    assert resolve(table, "Paris, France") == ("Paris, FR", "exact")
+    # An unknown qualifier is ignored rather than failing the lookup
+    assert resolve(table, "Paris, Narnia") == ("Paris, FR", "exact")
+
+def test_misses_carry_suggestions_and_repeats_are_looked_up_once():
+    table = build_location_table(SEED)
+    miss = table.lookup("Londinium")
+    assert miss.row is None
+    assert table.display_name(miss.suggestions[0]) == "London, GB"
+    assert table.lookup("xq").suggestions == ()
+
+    calls = []
+    lookup = table.lookup
+    table.lookup = lambda query, suggestions=5: calls.append(query) or lookup(query, suggestions)
+    matches = table.lookup_many(["nyc", "paris", "nyc"])
+    assert calls == ["nyc", "paris"]
+    assert [table.name(match.row) for match in matches] == ["New York", "Paris", "New York"]
+
+def test_csv_rows_join_the_table(tmp_path):
+    path = tmp_path / "cities.csv"
+    path.write_text("name,country,temp,condition,humidity,population,aliases\n"
+                    "Reykjavík,IS,4,Windy,75,130000,Reykjavik City|RVK\n"
+                    "Oslo,NO,6.5,Snowy,60,,\n", encoding="utf-8")
+    builder = LocationTableBuilder()
+    assert builder.add_csv(str(path)) == 2
+    table = builder.build()
+    assert resolve(table, "rvk") == ("Reykjavík, IS", "exact")
+    assert table.record(table.lookup("oslo").row) == {
+        "name": "Oslo", "country": "NO", "temp": 6.5, "condition": "Snowy", "humidity": 60}
+
+def test_get_weather_resolves_typos_and_suggests_on_a_miss():
+    found = asyncio.run(server.get_weather("San Fransisco"))
+    assert found["resolved_location"].startswith("San Francisco")
+    missing = asyncio.run(server.get_weather("Atlantis Under The Sea"))
+    assert missing["error"] == "Weather data not available for this location"
+    assert isinstance(missing["did_you_mean"], list)
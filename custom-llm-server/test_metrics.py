@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Tests for metrics
+Prometheus rendering, per-request stage timings and the Server-Timing header
+"""
+
+import asyncio
+import uuid
+
+import httpx
+
+import server
+from metrics import (Registry, StageTimer, current_request_timings, observe_stage, server_timing_header,
+                     start_request_timings)
+
+def test_metrics_render_in_the_prometheus_text_format():
+    registry = Registry()
+    requests = registry.counter("requests_total", "Requests", ["mode"])
+    depth = registry.gauge("queue_depth", "Queued")
+    latency = registry.histogram("latency_seconds", "Latency", buckets=(0.1, 1.0))
+    requests.inc(2, "stream")
+    depth.inc(3)
+    depth.dec(1)
+    for value in (0.05, 0.5, 5):
+        latency.observe(value)
+
+    lines = registry.render().splitlines()
+    assert "# TYPE requests_total counter" in lines
+    assert 'requests_total{mode="stream"} 2' in lines
+    assert "queue_depth 2" in lines
+    assert 'latency_seconds_bucket{le="0.1"} 1' in lines
+    assert 'latency_seconds_bucket{le="1.0"} 2' in lines
+    assert 'latency_seconds_bucket{le="+Inf"} 3' in lines
+    assert "latency_seconds_sum 5.55" in lines and "latency_seconds_count 3" in lines
+
+def test_stage_timings_are_collected_per_request():
+    async def request(name):
+        timings = start_request_timings()
+        with StageTimer(name):
+            await asyncio.sleep(0.01)
+        observe_stage(name, 0.5)
+        return timings is current_request_timings(), dict(timings)
+
+    async def run():
+        return await asyncio.gather(request("a"), request("b"))
+
+    (same_a, a), (same_b, b) = asyncio.run(run())
+    assert same_a and same_b
+    assert list(a) == ["a"] and list(b) == ["b"]
+    assert 0.51 <= a["a"] < 0.6
+    assert server_timing_header({"rag": 0.0012, "upstream": 0.25}) == "rag;dur=1.20, upstream;dur=250.00"
+
+def test_completions_report_stage_timings_and_count_in_metrics():
+    async def run():
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            def payload(**extra):
+                messages = [{"role": "user", "content": f"timing {uuid.uuid4()}"}]
+                return {"model": "gpt-3.5-turbo", "messages": messages, **extra}
+            plain = await client.post("/chat/completions", json=payload())
+            streamed = await client.post("/chat/completions", json=payload(stream=True))
+            metrics = await client.get("/metrics")
+        return plain, streamed, metrics
+
+    plain, streamed, metrics = asyncio.run(run())
+    stages = dict(item.split(";dur=") for item in plain.headers["Server-Timing"].split(", "))
+    assert {"rag_enhance", "upstream_complete"} <= set(stages)
+    assert "prepare;dur=" in streamed.headers["Server-Timing"]
+    assert streamed.text.endswith("data: [DONE]\n\n")
+    assert 'llm_requests_total{mode="non_stream"}' in metrics.text
+    assert 'llm_stage_seconds_count{stage="upstream_complete"}' in metrics.text
+    assert metrics.headers["content-type"].startswith("text/plain")
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Tests for offloading request preparation
+Inline versus worker-thread placement, stage timings from the pool, loop responsiveness and the server's thresholds
+"""
+
+import asyncio
+import threading
+import time
+
+import pytest
+
+import server
+from metrics import current_request_timings, observe_stage, start_request_timings
+from offload import Offloader
+
+def spin(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+    return threading.current_thread().name
+
+def ticks_during(offloader, heavy):
+    """How often a 10 ms ticker ran on the loop while a 0.3 s CPU-bound step was running"""
+    async def scenario():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                await asyncio.sleep(0.01)
+                ticks += 1
+
+        task = asyncio.create_task(ticker())
+        await asyncio.sleep(0)
+        await offloader.run("prepare", heavy, spin, 0.3)
+        task.cancel()
+        return ticks
+    return asyncio.run(scenario())
+
+def test_heavy_steps_run_in_the_pool_and_light_ones_inline():
+    offloader = Offloader(workers=2)
+
+    async def scenario():
+        start_request_timings()
+
+        def step():
+            observe_stage("prepare", 0.25)
+            return threading.current_thread().name
+
+        light = await offloader.run("prepare", False, step)
+        heavy = await offloader.run("prepare", True, step)
+        return light, heavy, dict(current_request_timings())
+
+    light, heavy, timings = asyncio.run(scenario())
+    offloader.shutdown()
+    assert light == "MainThread" and heavy.startswith("prepare")
+    # The worker ran in a copy of the request's context, so its timing was kept
+    assert timings == {"prepare": 0.5}
+    assert offloader.stats()["steps"] == {"prepare": {"inline": 1, "thread": 1}}
+
+def test_off_mode_runs_everything_inline():
+    offloader = Offloader(mode="off")
+    assert asyncio.run(offloader.run("prepare", True, spin, 0)) == "MainThread"
+    with pytest.raises(ValueError):
+        Offloader(mode="process")
+
+def test_the_loop_keeps_ticking_while_a_heavy_step_runs():
+    offloader = Offloader()
+    try:
+        assert ticks_during(offloader, heavy=True) >= 5
+        assert ticks_during(offloader, heavy=False) <= 1
+    finally:
+        offloader.shutdown()
+
+def test_server_offloads_large_requests_and_retrieved_mode_retrieval(monkeypatch):
+    offloader = Offloader(workers=1)
+    monkeypatch.setattr(server, "OFFLOADER", offloader)
+    monkeypatch.setattr(server, "OFFLOAD_MIN_CHARS", 2000)
+    small = server.ChatCompletionRequest(model="gpt-3.5-turbo", messages=[{"role": "user", "content": "hi"}])
+    large = server.ChatCompletionRequest(model="gpt-3.5-turbo", messages=[{"role": "user", "content": "shipping " * 300}])
+
+    async def scenario():
+        prepared_small = await server.prepare_request(small, cache=True)
+        prepared_large = await server.prepare_request(large, cache=True)
+        messages = await server.rag_messages(prepared_large)
+        return prepared_small, prepared_large, messages
+
+    prepared_small, prepared_large, messages = asyncio.run(scenario())
+    assert not prepared_small.heavy and prepared_large.heavy
+    assert prepared_large.cache_key and prepared_large.messages[0]["content"].startswith("shipping")
+    assert messages[0]["role"] == "system"
+    # The full-knowledge-base prompt is cached, so it is never worth a thread hop
+    assert not server.retrieval_is_heavy(prepared_large)
+    assert offloader.counts == {"prepare": {"inline": 1, "thread": 1}, "rag_enhance": {"inline": 1, "thread": 0}}
+
+    monkeypatch.setattr(server, "RAG_PROMPT_MODE", "retrieved")
+    assert server.retrieval_is_heavy(prepared_large) and not server.retrieval_is_heavy(prepared_small)
+    offloader.shutdown()
@@ -0,0 +1,106 @@
+#!/usr/bin/env python3
+"""
+Tests for request profiling
+Opt-in per-request cProfile capture, the admin toggle, the profile endpoints and the event-loop lag monitor
+"""
+
+import asyncio
+import marshal
+import time
+import uuid
+
+import httpx
+
+import server
+from profiling import LoopMonitor, ProfileStore, ProfilingMiddleware, install_task_factory
+
+def busy(seconds):
+    end = time.perf_counter() + seconds
+    while time.perf_counter() < end:
+        pass
+
+async def background_work():
+    busy(0.02)
+
+async def app(scope, receive, send):
+    """Spends a little CPU, waits, and spawns a task, like a request streaming its response"""
+    busy(0.01)
+    await asyncio.sleep(0.05)
+    await asyncio.create_task(background_work())
+    await send({"type": "http.response.start", "status": 200, "headers": []})
+    await send({"type": "http.response.body", "body": b"ok"})
+
+def call(middleware, path="/work", headers=None):
+    async def scenario():
+        install_task_factory(asyncio.get_running_loop())
+        transport = httpx.ASGITransport(app=middleware)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.get(path, headers=headers or {})
+    return asyncio.run(scenario())
+
+def test_only_requests_asking_for_it_are_profiled():
+    store = ProfileStore()
+    middleware = ProfilingMiddleware(app, store)
+    assert "x-profile-id" not in call(middleware).headers
+    profile_id = call(middleware, headers={"X-Profile": "1"}).headers["x-profile-id"]
+
+    profile = store.get(profile_id)
+    assert (profile.method, profile.path, profile.status) == ("GET", "/work", 200)
+    # The sleep counts towards wall time but not towards the time the request held the loop
+    assert 0.03 <= profile.busy_seconds <= profile.wall_seconds - 0.04
+    functions = [row["function"] for row in profile.top_functions(limit=50)]
+    assert any("background_work" in function for function in functions)
+
+def test_admin_key_and_toggle_select_requests():
+    store = ProfileStore(max_profiles=2)
+    middleware = ProfilingMiddleware(app, store, admin_key="secret")
+    assert "x-profile-id" not in call(middleware, headers={"X-Profile": "1"}).headers
+    assert "x-profile-id" in call(middleware, headers={"X-Profile": "1", "X-Admin-Key": "secret"}).headers
+
+    store.arm(2)
+    assert "x-profile-id" not in call(middleware, path="/health").headers
+    assert "x-profile-id" in call(middleware).headers
+    assert "x-profile-id" in call(middleware).headers
+    assert "x-profile-id" not in call(middleware).headers
+    assert store.stats() == {"armed": False, "remaining": 0, "stored": 2, "max_profiles": 2}
+
+def test_loop_monitor_records_the_coroutine_that_blocked():
+    async def blocking_handler():
+        await asyncio.sleep(0.05)
+        time.sleep(0.2)
+
+    async def scenario():
+        monitor = LoopMonitor(interval=0.01, stall_threshold=0.05)
+        runner = asyncio.create_task(monitor.run())
+        await blocking_handler()
+        await asyncio.sleep(0.05)
+        runner.cancel()
+        return monitor
+
+    monitor = asyncio.run(scenario())
+    assert monitor.stall_count == 1
+    stall = monitor.stalls[0]
+    assert "blocking_handler" in stall["coroutine"]
+    assert stall["duration_ms"] >= 150 and "ongoing" not in stall
+    assert monitor.stats()["lag_ms"]["max"] >= 150
+
+def test_profiled_completion_is_downloadable_from_the_admin_endpoints():
+    async def scenario():
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            payload = {"model": "gpt-3.5-turbo", "messages": [{"role": "user", "content": f"profile {uuid.uuid4()}"}]}
+            response = await client.post("/chat/completions", json=payload, headers={"X-Profile": "1"})
+            profile_id = response.headers["x-profile-id"]
+            summary = await client.get(f"/admin/profiles/{profile_id}")
+            dump = await client.get(f"/admin/profiles/{profile_id}?format=pstats")
+            listed = await client.get("/admin/profiles")
+            missing = await client.get("/admin/profiles/prof-missing")
+            return profile_id, summary.json(), dump.content, listed.json(), missing.status_code
+
+    profile_id, summary, dump, listed, missing = asyncio.run(scenario())
+    assert summary["path"] == "/chat/completions" and summary["status"] == 200
+    assert "upstream_complete" in summary["stage_timings_ms"]
+    assert summary["top_functions"]
+    assert isinstance(marshal.loads(dump), dict)
+    assert profile_id in [profile["profile_id"] for profile in listed["profiles"]]
+    assert missing == 404
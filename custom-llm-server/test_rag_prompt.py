@@ -0,0 +1,44 @@
+#!/usr/bin/env python3
+"""
+Tests for the RAG system prompt
+The cached full-knowledge-base message and the retrieved-context mode
+"""
+
+import server
+
+def test_full_prompt_is_built_once_per_knowledge_version(monkeypatch):
+    builds = []
+    build = server.build_rag_system_prompt
+    monkeypatch.setattr(server, "build_rag_system_prompt", lambda: builds.append(1) or build())
+    server.bump_knowledge_version()
+
+    first = server.get_rag_system_message()
+    assert server.get_rag_system_message() is first
+    assert len(builds) == 1
+    server.bump_knowledge_version()
+    assert server.get_rag_system_message() is not first
+    assert len(builds) == 2
+
+def test_full_prompt_holds_the_knowledge_base():
+    content = server.get_rag_system_message()["content"]
+    assert content.startswith(server.RAG_PROMPT_HEADER)
+    assert '"name": "ACME Corporation"' in content and '"AI Chatbots"' in content
+    assert '"shipping": "Free shipping on orders over $50.' in content
+    assert content.endswith(server.RAG_PROMPT_INSTRUCTIONS)
+
+def test_retrieved_mode_only_includes_relevant_entries(monkeypatch):
+    monkeypatch.setattr(server, "RAG_PROMPT_MODE", "retrieved")
+    messages = [{"role": "user", "content": "hello"}, {"role": "assistant", "content": "hi"},
+                {"role": "user", "content": "which credit cards and PayPal payment do you accept"}]
+    enhanced = server.enhance_messages_with_rag(messages)
+    assert enhanced[1:] == messages
+    content = enhanced[0]["content"]
+    assert "payment: We accept all major credit cards" in content
+    assert "Free shipping" not in content
+    assert len(content) < len(server.get_rag_system_message()["content"])
+
+def test_retrieved_context_respects_its_size_limit():
+    context = server.build_retrieved_context("shipping payment support warranty", max_chars=120)
+    assert len(context) <= 120
+    assert server.build_retrieved_context("shipping", max_chars=10) == "shipping: "
+    assert server.build_retrieved_context("xylophone") == "No relevant information found in knowledge base."
@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+"""
+Tests for traffic recording
+Redaction, and trace writes kept off the calling thread
+"""
+
+import json
+import threading
+
+from recording import Redactor, TraceRecorder, read_trace
+
+def record(recorder, payload):
+    entry = recorder.start()
+    recorder.record(entry, json.dumps(payload).encode(), {"x-session-id": "s1"}, 200, None)
+
+def test_patterns_redact_secrets_and_hash_identifiers():
+    redactor = Redactor("patterns")
+    payload = redactor.payload({
+        "messages": [{"role": "user", "content": "mail me at ann@example.com, key sk-abcdefghijklmnop1234"}],
+        "session_id": "s1",
+    })
+    assert payload["messages"][0]["content"] == "mail me at [EMAIL], key [SECRET]"
+    assert payload["session_id"] == redactor.identifier("s1") != "s1"
+    assert Redactor("all").text("two words") == "xxx xxxxx"
+
+def test_records_are_written_by_a_background_thread(tmp_path):
+    recorder = TraceRecorder(str(tmp_path / "trace.jsonl.gz"), Redactor("patterns"))
+    writers = []
+    write = recorder._write
+    recorder._write = lambda line: (writers.append(threading.current_thread().name), write(line))
+    for i in range(3):
+        record(recorder, {"messages": [{"role": "user", "content": f"hi {i}"}]})
+    recorder.record(recorder.start(), b"not json", {}, 400, None)
+    recorder.close()
+
+    assert writers and threading.current_thread().name not in writers
+    header, records = read_trace(recorder.path)
+    records = list(records)
+    assert header["redaction"] == "patterns"
+    assert [r["payload"]["messages"][0]["content"] for r in records] == ["hi 0", "hi 1", "hi 2"]
+    assert recorder.stats()["recorded"] == 3 and recorder.stats()["skipped"] == 1
+
+def test_a_backlog_drops_records_instead_of_blocking(tmp_path):
+    recorder = TraceRecorder(str(tmp_path / "trace.jsonl"), Redactor("none"), max_pending=2)
+    release = threading.Event()
+    record_one = recorder._record
+    recorder._record = lambda item: (release.wait(5), record_one(item))
+    for i in range(6):
+        record(recorder, {"messages": [], "n": i})
+    dropped = recorder.stats()["dropped"]
+    release.set()
+    recorder.flush()
+    assert dropped >= 3
+    assert recorder.stats()["recorded"] + dropped == 6
+    with open(recorder.path) as f:
+        assert len(f.readlines()) == 1 + recorder.stats()["recorded"]
+    recorder.close()
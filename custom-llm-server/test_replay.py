@@ -0,0 +1,31 @@
+#!/usr/bin/env python3
+"""
+Tests for trace replay
+Loading recorded requests in arrival order
+"""
+
+import json
+
+from recording import TRACE_FORMAT
+from replay import load_records
+
+def write_trace(path, arrivals):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write(json.dumps({"trace_format": TRACE_FORMAT}) + "\n")
+        for name, t in arrivals:
+            f.write(json.dumps({"t": t, "payload": {"name": name}}) + "\n")
+
+def test_limit_keeps_the_earliest_arrivals(tmp_path):
+    path = str(tmp_path / "trace.jsonl")
+    # Written in finish order: "slow" arrived first but finished last
+    write_trace(path, [("fast", 1.0), ("quick", 1.5), ("later", 3.0), ("slow", 0.5)])
+    records = load_records(path, 2)
+    assert [record["payload"]["name"] for record in records] == ["slow", "fast"]
+    assert [record["t"] for record in records] == [0.0, 0.5]
+
+def test_without_a_limit_every_record_is_loaded_in_arrival_order(tmp_path):
+    path = str(tmp_path / "trace.jsonl")
+    write_trace(path, [("b", 2.0), ("a", 1.0), ("c", 4.0)])
+    records = load_records(path, None)
+    assert [record["payload"]["name"] for record in records] == ["a", "b", "c"]
+    assert [record["t"] for record in records] == [0.0, 1.0, 3.0]
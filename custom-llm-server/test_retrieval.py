@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Tests for retrieval
+BM25 scoring and ranking, and reuse of a saved vector index only while its
+documents and embedder are unchanged
+"""
+
+import math
+import random
+
+import numpy as np
+import pytest
+
+import server
+from retrieval import BM25Index, Document, HashingEmbedder, build_retriever, load_jsonl_documents, tokenize
+
+def keyword_index(documents):
+    index = BM25Index()
+    index.add_documents(documents)
+    return index
+
+DOCUMENTS = [
+    Document("faq:shipping", "shipping", "Free shipping on orders over $50."),
+    Document("faq:returns", "returns", "Returns are accepted within 30 days."),
+]
+
+def test_saved_index_is_reused_while_documents_are_unchanged(tmp_path):
+    path = str(tmp_path / "vectors")
+    build_retriever("semantic", keyword_index(DOCUMENTS), HashingEmbedder(64), vector_index_path=path)
+    reused = build_retriever("semantic", keyword_index(DOCUMENTS), HashingEmbedder(64), vector_index_path=path)
+    assert isinstance(reused.matrix, np.memmap)
+
+def test_saved_index_is_rebuilt_when_a_document_is_edited(tmp_path):
+    path = str(tmp_path / "vectors")
+    build_retriever("semantic", keyword_index(DOCUMENTS), HashingEmbedder(64), vector_index_path=path)
+    edited = [DOCUMENTS[0], Document("faq:returns", "returns", "Refunds take five business days.")]
+    rebuilt = build_retriever("semantic", keyword_index(edited), HashingEmbedder(64), vector_index_path=path)
+    assert not isinstance(rebuilt.matrix, np.memmap)
+    assert rebuilt.search("refunds business days", top_k=1)[0][0].text == edited[1].text
+
+def test_saved_index_is_rebuilt_for_another_embedder(tmp_path):
+    path = str(tmp_path / "vectors")
+    build_retriever("semantic", keyword_index(DOCUMENTS), HashingEmbedder(64), vector_index_path=path)
+    rebuilt = build_retriever("semantic", keyword_index(DOCUMENTS), HashingEmbedder(128), vector_index_path=path)
+    assert rebuilt.matrix.shape == (2, 128)
+
+def reference_bm25(documents, query, k1=1.5, b=0.75):
+    """Textbook BM25 by scanning every document, to check the inverted index against"""
+    tokenized = [tokenize(f"{d.title.replace('_', ' ')} {d.text}") for d in documents]
+    average = sum(map(len, tokenized)) / len(tokenized)
+    scores = {}
+    for term in set(tokenize(query)):
+        doc_freq = sum(term in tokens for tokens in tokenized)
+        idf = math.log(1 + (len(documents) - doc_freq + 0.5) / (doc_freq + 0.5))
+        for i, tokens in enumerate(tokenized):
+            freq = tokens.count(term)
+            if freq:
+                norm = k1 * (1 - b + b * len(tokens) / average)
+                scores[i] = scores.get(i, 0.0) + idf * freq * (k1 + 1) / (freq + norm)
+    return scores
+
+def test_bm25_scores_match_a_linear_scan():
+    rng = random.Random(1)
+    words = ["ship", "order", "refund", "card", "delivery", "days", "free", "support", "hours", "warranty"]
+    documents = [Document(f"d{i}", f"t{i}", " ".join(rng.choice(words) for _ in range(rng.randint(3, 30))))
+                 for i in range(200)]
+    index = keyword_index(documents)
+    for query in ("free delivery", "refund card refund", "warranty hours support", "unknown"):
+        expected = reference_bm25(documents, query)
+        assert index.score_terms(tokenize(query)) == pytest.approx(expected)
+        top = [d.doc_id for d, _ in index.search(query, top_k=5)]
+        assert top == [documents[i].doc_id for i in sorted(expected, key=lambda i: -expected[i])[:5]]
+
+def test_titles_are_searchable_and_stopwords_ignored():
+    index = keyword_index([Document("a", "return_policy", "30 days money back"), *DOCUMENTS])
+    assert index.search("what is the return policy", top_k=1)[0][0].doc_id == "a"
+    assert tokenize("What is THE Return-Policy?") == ["return", "policy"]
+    assert index.search("the and of", top_k=3) == []
+
+def test_removed_documents_are_skipped_and_idf_stays_exact():
+    documents = DOCUMENTS + [Document("faq:shipping-old", "shipping", "Shipping costs $5.")]
+    index = keyword_index(documents)
+    index.remove(2)
+    assert [d.doc_id for d, _ in index.search("shipping", top_k=5)] == ["faq:shipping"]
+    assert index.score_terms(["shipping"]) == pytest.approx(reference_bm25(DOCUMENTS, "shipping"))
+
+def test_jsonl_documents_report_the_bad_line(tmp_path):
+    path = tmp_path / "kb.jsonl"
+    path.write_text('{"id": "x", "title": "t", "text": "ok"}\n\n{"id": "y"}\n')
+    with pytest.raises(ValueError, match=":3: record has no 'text' field"):
+        list(load_jsonl_documents(str(path)))
+
+def test_search_knowledge_base_renders_the_best_matches():
+    assert server.search_knowledge_base("free shipping delivery", top_k=1).startswith("shipping: Free shipping")
+    assert server.search_knowledge_base("xylophone") == "No relevant information found in knowledge base."
@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""
+Tests for server-side sessions
+Context budgeting and sharing sessions between worker processes through a directory
+"""
+
+from sessions import SessionStore, message_tokens
+
+def test_context_keeps_newest_turns_within_budget():
+    store = SessionStore(context_tokens=60, summary_tokens=40)
+    session = store.get_or_create("s")
+    for i in range(10):
+        session.append("user", f"question number {i} about shipping times")
+    messages = store.context(session)
+    assert messages[-1]["content"] == "question number 9 about shipping times"
+    assert messages[0]["role"] == "system"
+    assert session.tokens + session.summary_tokens <= 60
+    assert session.compacted_turns == 10 - len(session.turns)
+
+def test_trim_drops_turns_without_summary():
+    store = SessionStore(context_tokens=30, overflow="trim")
+    session = store.get_or_create("s")
+    for i in range(10):
+        session.append("user", f"turn {i}")
+    messages = store.context(session)
+    assert all(message["role"] == "user" for message in messages)
+    assert sum(message_tokens(message["content"]) for message in messages) <= 30
+
+def test_workers_sharing_a_directory_see_each_others_turns(tmp_path):
+    # Two stores stand in for two worker processes
+    first, second = SessionStore(directory=str(tmp_path)), SessionStore(directory=str(tmp_path))
+
+    session = first.get_or_create("abc")
+    session.append("user", "hello")
+    first.save(session)
+
+    session = second.get_or_create("abc")
+    assert [turn.content for turn in session.turns] == ["hello"]
+    session.append("assistant", "hi there")
+    second.save(session)
+
+    session = first.get_or_create("abc")
+    assert [turn.content for turn in session.turns] == ["hello", "hi there"]
+    assert session.tokens == sum(turn.tokens for turn in session.turns)
+
+def test_delete_on_one_worker_ends_the_session_everywhere(tmp_path):
+    first, second = SessionStore(directory=str(tmp_path)), SessionStore(directory=str(tmp_path))
+    session = first.get_or_create("abc")
+    session.append("user", "hello")
+    first.save(session)
+    second.get("abc")
+
+    assert second.delete("abc")
+    assert first.get("abc") is None
+    assert not first.delete("abc")
+
+def test_idle_shared_sessions_expire(tmp_path):
+    store = SessionStore(directory=str(tmp_path), idle_ttl_seconds=0)
+    session = store.get_or_create("abc")
+    session.append("user", "hello")
+    store.save(session)
+    other = SessionStore(directory=str(tmp_path), idle_ttl_seconds=0)
+    assert other.get("abc") is None
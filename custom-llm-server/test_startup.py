@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Tests for cold start
+Lazy heavy imports, the mapped snapshot format, warming and the /ready probe
+"""
+
+import asyncio
+import json
+import os
+import subprocess
+import sys
+
+import httpx
+import numpy as np
+
+import server
+from retrieval import BM25Index, Document, FrozenBM25Index, HashingEmbedder, VectorIndex
+from snapshot import MappedTerms, load_snapshot, snapshot_path, warm_snapshot, write_snapshot
+
+DOCUMENTS = [
+    Document("faq:shipping", "shipping", "Free shipping on orders over $50.", "faq"),
+    Document("faq:returns", "returns", "Returns are accepted within 30 days.", "faq"),
+    Document("faq:café", "café", "The café serves crème brûlée.", "faq"),
+]
+
+# Imports the server in a fresh interpreter and reports what a cold start did
+COLD_START = """
+import asyncio, json, sys
+import server
+before = server.KNOWLEDGE_WARM
+asyncio.run(server.warm_knowledge_base())
+print(json.dumps({"openai": "openai" in sys.modules, "aiohttp": "aiohttp" in sys.modules,
+                  "warm_before": before, "warm_after": server.KNOWLEDGE_WARM, "startup": server.STARTUP_STATS,
+                  "documents": len(server.KNOWLEDGE_INDEX)}))
+"""
+
+def build_indexes():
+    index = BM25Index()
+    index.add_documents(DOCUMENTS)
+    vector_index = VectorIndex(HashingEmbedder(64))
+    vector_index.add_documents(DOCUMENTS)
+    return index, vector_index
+
+def cold_start(snapshot_dir):
+    env = {**os.environ, "LLM_BACKEND": "stub", "KNOWLEDGE_SNAPSHOT_DIR": str(snapshot_dir)}
+    completed = subprocess.run([sys.executable, "-c", COLD_START], cwd=os.path.dirname(os.path.abspath(__file__)),
+                               env=env, capture_output=True, text=True, timeout=60)
+    assert completed.returncode == 0, completed.stderr[-2000:]
+    return json.loads(completed.stdout.splitlines()[-1])
+
+def test_snapshot_vocabulary_is_mapped_not_decoded(tmp_path):
+    index, vector_index = build_indexes()
+    write_snapshot(str(tmp_path), index, vector_index)
+    snapshot = load_snapshot(str(tmp_path), embedder=vector_index.embedder)
+    terms = snapshot.keyword_index.term_ids
+    assert isinstance(terms, MappedTerms)
+    frozen = FrozenBM25Index.from_index(index)
+    assert {term: terms[term] for term in frozen.term_ids} == dict(frozen.term_ids)
+    assert "missing" not in terms
+    assert [d.doc_id for d, _ in snapshot.keyword_index.search("crème brûlée", 1)] == ["faq:café"]
+    assert warm_snapshot(snapshot) == sum(array.nbytes for array in snapshot.mapped)
+    assert snapshot.vector_index.search("shipping orders", 1)[0][0].doc_id == "faq:shipping"
+
+def test_format_1_snapshots_are_still_readable(tmp_path):
+    index, _ = build_indexes()
+    version = write_snapshot(str(tmp_path), index)
+    path = snapshot_path(str(tmp_path), version)
+    # Format 1 kept the vocabulary in the manifest as a term -> id dict
+    with open(os.path.join(path, "terms.bin"), "rb") as f:
+        terms = f.read()
+    offsets = np.load(os.path.join(path, "term_offsets.npy"))
+    vocabulary = {terms[offsets[i]:offsets[i + 1]].decode("utf-8"): i for i in range(len(offsets) - 1)}
+    with open(os.path.join(path, "manifest.json"), "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    manifest.update(format=1, terms=vocabulary)
+    with open(os.path.join(path, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    os.remove(os.path.join(path, "terms.bin"))
+    os.remove(os.path.join(path, "term_offsets.npy"))
+
+    snapshot = load_snapshot(str(tmp_path))
+    assert snapshot.keyword_index.term_ids == vocabulary
+    assert [d.doc_id for d, _ in snapshot.keyword_index.search("returns days", 1)] == ["faq:returns"]
+
+    manifest["format"] = 99
+    with open(os.path.join(path, "manifest.json"), "w", encoding="utf-8") as f:
+        json.dump(manifest, f)
+    try:
+        load_snapshot(str(tmp_path))
+        raise AssertionError("expected ValueError")
+    except ValueError as e:
+        assert "format 99" in str(e)
+
+def test_cold_start_skips_the_openai_sdk_and_becomes_ready_after_warming(tmp_path):
+    first = cold_start(tmp_path)
+    assert not first["openai"] and not first["aiohttp"]
+    assert first["startup"]["knowledge_source"] == "built_and_published"
+    assert (first["warm_before"], first["warm_after"]) == (False, True)
+    assert "knowledge_warm_ms" in first["startup"]
+
+    second = cold_start(tmp_path)
+    assert second["startup"]["knowledge_source"] == "snapshot"
+    assert second["documents"] == first["documents"]
+
+def test_ready_reports_503_until_the_knowledge_base_is_warm(monkeypatch):
+    async def probe():
+        transport = httpx.ASGITransport(app=server.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.get("/ready")
+
+    monkeypatch.setattr(server, "KNOWLEDGE_WARM", False)
+    cold = asyncio.run(probe())
+    monkeypatch.setattr(server, "KNOWLEDGE_WARM", True)
+    warm = asyncio.run(probe())
+    assert cold.status_code == 503 and cold.json()["ready"] is False
+    assert warm.status_code == 200
+    assert warm.json()["documents"] == len(server.KNOWLEDGE_INDEX)
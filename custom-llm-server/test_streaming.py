@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+"""
+Tests for streamed tool calls
+Reassembling fragments, and running server-side tools while the model is still streaming
+"""
+
+import asyncio
+import json
+import time
+
+import server
+from metrics import ERRORS
+from streaming import ToolCallAccumulator
+
+def fragment(index, id=None, name=None, arguments=None):
+    function = {key: value for key, value in (("name", name), ("arguments", arguments)) if value is not None}
+    delta = {"index": index, "function": function}
+    if id:
+        delta["id"] = id
+    return delta
+
+def chunk(tool_calls=None, content=None, finish_reason=None):
+    delta = {}
+    if tool_calls:
+        delta["tool_calls"] = tool_calls
+    if content:
+        delta["content"] = content
+    return {"choices": [{"delta": delta, "finish_reason": finish_reason}]}
+
+class ScriptedUpstream:
+    """Plays one scripted round per stream() call; numbers in a round are pauses, exceptions are raised"""
+
+    def __init__(self, rounds):
+        self.rounds = list(rounds)
+        self.requests = []
+        self.finished = []
+
+    async def stream(self, **params):
+        self.requests.append([dict(message) for message in params["messages"]])
+        for item in self.rounds.pop(0):
+            if isinstance(item, (int, float)):
+                await asyncio.sleep(item)
+            elif isinstance(item, Exception):
+                raise item
+            else:
+                yield item
+        self.finished.append(time.perf_counter())
+
+def read_stream(**kwargs):
+    async def run():
+        return [line async for line in server.stream_openai_response(
+            [{"role": "user", "content": "hi"}], tools=[], **kwargs)]
+    events = []
+    for line in asyncio.run(run()):
+        payload = line.removeprefix("data: ").strip()
+        if payload and payload != "[DONE]":
+            events.append(json.loads(payload))
+    return events
+
+def test_accumulator_reports_each_call_once_when_its_arguments_parse():
+    calls = ToolCallAccumulator()
+    assert calls.add([fragment(0, id="a", name="calculate", arguments='{"expre')]) == []
+    assert calls.add([fragment(1, id="b", name="get_", arguments="")]) == []
+    assert calls.add([fragment(0, arguments='ssion": "1+1"}')]) == [0]
+    # Braces inside strings do not count as the end of the object
+    assert calls.add([fragment(1, name="weather", arguments='{"location": "}"')]) == []
+    assert calls.add([fragment(1, arguments="}"), fragment(0, arguments="")]) == [1]
+    assert [call["function"]["name"] for call in calls.ordered()] == ["calculate", "get_weather"]
+    assert calls.ordered()[1]["function"]["arguments"] == '{"location": "}"}'
+
+def test_accumulator_needs_an_id_and_an_object():
+    calls = ToolCallAccumulator()
+    assert calls.add([fragment(0, name="calculate", arguments="{}")]) == []
+    assert calls.add([fragment(1, id="b", name="calculate", arguments="[1]")]) == []
+    assert calls.add([fragment(0, id="a")]) == [0]
+
+def test_server_tools_start_before_the_model_finishes(monkeypatch):
+    started = {}
+
+    async def calculate(expression):
+        started[expression] = time.perf_counter()
+        return {"expression": expression, "result": 4, "success": True}
+
+    upstream = ScriptedUpstream([
+        [chunk([fragment(0, id="c1", name="calculate", arguments='{"expression": "2 + 2 + 0.5"}')]), 0.2,
+         chunk([fragment(1, id="c2", name="calculate", arguments='{"expression": "2 + 2 + 0.25"}')]),
+         chunk(finish_reason="tool_calls")],
+        [chunk(content="four"), chunk(finish_reason="stop")],
+    ])
+    monkeypatch.setitem(server.TOOL_FUNCTIONS, "calculate", calculate)
+    monkeypatch.setattr(server, "UPSTREAM", upstream)
+    monkeypatch.setattr(server, "EARLY_TOOL_EXECUTION", True)
+    monkeypatch.setattr(server, "TOOL_CACHE", None)
+
+    events = read_stream()
+    reports = next(event["tool_executions"] for event in events if "tool_executions" in event)
+    assert [report.get("started_early") for report in reports] == [True, True]
+    # The first tool ran during the pause in the stream, not after it
+    assert started["2 + 2 + 0.5"] < upstream.finished[0] - 0.1
+    # Each tool ran once and its result reached the second round
+    assert len(started) == 2
+    tool_messages = [message for message in upstream.requests[1] if message["role"] == "tool"]
+    assert [message["tool_call_id"] for message in tool_messages] == ["c1", "c2"]
+    assert events[-1]["choices"][0]["finish_reason"] == "stop"
+
+def test_unknown_tool_hands_the_round_to_the_client_and_cancels_early_calls(monkeypatch):
+    cancelled = []
+
+    async def slow_calculate(expression):
+        try:
+            await asyncio.sleep(5)
+        except asyncio.CancelledError:
+            cancelled.append(expression)
+            raise
+
+    upstream = ScriptedUpstream([
+        [chunk([fragment(0, id="c1", name="calculate", arguments='{"expression": "1 + 2"}')]), 0.05,
+         chunk([fragment(1, id="c2", name="client_tool", arguments="{}")]),
+         chunk(finish_reason="tool_calls")],
+    ])
+    monkeypatch.setitem(server.TOOL_FUNCTIONS, "calculate", slow_calculate)
+    monkeypatch.setattr(server, "UPSTREAM", upstream)
+    monkeypatch.setattr(server, "EARLY_TOOL_EXECUTION", True)
+    monkeypatch.setattr(server, "TOOL_CACHE", None)
+
+    events = read_stream()
+    sent = [call for event in events for choice in event.get("choices", [])
+            for call in (choice["delta"].get("tool_calls") or [])]
+    assert [call["id"] for call in sent] == ["c1", "c2"]
+    assert cancelled == ["1 + 2"]
+    assert events[-1]["choices"][0]["finish_reason"] == "tool_calls"
+
+def test_early_calls_are_rerun_when_their_arguments_change(monkeypatch):
+    runs = []
+
+    async def calculate(expression):
+        runs.append(expression)
+        return {"expression": expression, "result": 0, "success": True}
+
+    monkeypatch.setitem(server.TOOL_FUNCTIONS, "calculate", calculate)
+    monkeypatch.setattr(server, "TOOL_CACHE", None)
+
+    async def run():
+        early = {}
+        call = {"id": "c1", "type": "function", "function": {"name": "calculate", "arguments": '{"expression": "1"}'}}
+        server.start_tool_call_early(early, call, 0)
+        changed = {**call, "function": {**call["function"], "arguments": '{"expression": "2"}'}}
+        messages, reports = await server.run_tool_calls([changed], 0, early)
+        return early, messages, reports
+
+    early, messages, reports = asyncio.run(run())
+    assert early == {}
+    assert json.loads(messages[0]["content"])["expression"] == "2"
+    assert "started_early" not in reports[0]
+    assert runs[-1] == "2"
+
+def error_count(error_type):
+    return ERRORS._values.get((error_type,), 0)
+
+def test_upstream_errors_are_not_counted_as_disconnects(monkeypatch):
+    upstream = ScriptedUpstream([[chunk(content="par"), RuntimeError("upstream reset")]])
+    monkeypatch.setattr(server, "UPSTREAM", upstream)
+    monkeypatch.setattr(server, "STREAM_COALESCE_MS", 0)
+    before = error_count("client_disconnect"), error_count("RuntimeError")
+
+    events = read_stream()
+    assert events[-2]["choices"][0]["delta"]["content"] == "Error: upstream reset"
+    assert (error_count("client_disconnect"), error_count("RuntimeError")) == (before[0], before[1] + 1)
+
+def test_client_disconnect_closes_the_upstream_stream(monkeypatch):
+    upstream = ScriptedUpstream([[chunk(content="one"), 5, chunk(content="two")]])
+    monkeypatch.setattr(server, "UPSTREAM", upstream)
+    monkeypatch.setattr(server, "STREAM_COALESCE_MS", 0)
+    before = error_count("client_disconnect")
+
+    async def run():
+        stream = server.stream_openai_response([{"role": "user", "content": "hi"}], tools=[])
+        first = await stream.__anext__()
+        await stream.aclose()
+        return first
+    assert "one" in asyncio.run(run())
+    assert error_count("client_disconnect") == before + 1
+    assert upstream.finished == []
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Tests for the tool result cache
+Canonical keys, hit refreshing, and what is never cached
+"""
+
+import asyncio
+import json
+import time
+
+import server
+from cache import ToolCachePolicy, ToolResultCache
+
+def call(name, arguments, call_id="call_1"):
+    tool_call = {"id": call_id, "function": {"name": name, "arguments": json.dumps(arguments)}}
+    return json.loads(asyncio.run(server.execute_tool_call(tool_call))["content"])
+
+def counts(name):
+    return server.TOOL_CACHE.stats()["tools"].get(name, {"hits": 0, "misses": 0})
+
+def test_equivalent_weather_calls_share_an_entry_but_echo_their_own_location():
+    before = counts("get_weather")
+    first = call("get_weather", {"location": "Tokyo"})
+    time.sleep(0.01)
+    second = call("get_weather", {"location": "  TOKYO ", "unit": "Celsius"})
+    after = counts("get_weather")
+    assert after["hits"] == before["hits"] + 1
+    assert first["location"] == "Tokyo" and second["location"] == "  TOKYO "
+    assert second["resolved_location"] == first["resolved_location"]
+    assert second["temperature"] == first["temperature"]
+    assert second["timestamp"] > first["timestamp"]
+
+def test_exact_repeats_are_refreshed_too():
+    first = call("get_weather", {"location": "San Francisco", "unit": "fahrenheit"})
+    time.sleep(0.01)
+    second = call("get_weather", {"location": "San Francisco", "unit": "fahrenheit"})
+    assert second["location"] == "San Francisco"
+    assert second["timestamp"] > first["timestamp"]
+
+def test_batch_hits_echo_each_location():
+    call("get_weather_batch", {"locations": ["London", "Tokyo"]})
+    before = counts("get_weather_batch")
+    result = call("get_weather_batch", {"locations": ["london", "tokyo "]})
+    assert counts("get_weather_batch")["hits"] == before["hits"] + 1
+    assert [r["location"] for r in result["results"]] == ["london", "tokyo "]
+
+def test_search_hits_echo_the_query():
+    call("search_company_info", {"query": "Shipping policy"})
+    assert call("search_company_info", {"query": "shipping   POLICY"})["query"] == "shipping   POLICY"
+
+def test_failed_and_oversized_results_are_not_cached():
+    async def fails(x):
+        return {"success": False}
+    async def large(x):
+        return {"data": "x" * 100}
+    cache = ToolResultCache({"fails": ToolCachePolicy(60), "large": ToolCachePolicy(60)}, max_result_bytes=50)
+    for name, function in (("fails", fails), ("large", large)):
+        _, keys, args = cache.lookup(name, function, '{"x": 1}')
+        cache.store(name, keys, asyncio.run(function(**args)))
+        assert cache.lookup(name, function, '{"x": 1}')[0] is None
+
+def test_zero_ttl_and_unknown_tools_bypass_the_cache():
+    async def tool(x):
+        return {"x": x}
+    cache = ToolResultCache({"off": ToolCachePolicy(0)})
+    for name in ("off", "unknown"):
+        content, keys, args = cache.lookup(name, tool, '{"x": 2}')
+        assert (content, keys, args) == (None, [], {"x": 2})
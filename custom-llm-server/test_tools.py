@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Tests for server-side tool execution
+The multi-round loop, parallel tool calls and their timeout and error results
+"""
+
+import asyncio
+import json
+import time
+
+import server
+
+REQUEST = server.ChatCompletionRequest(model="gpt-3.5-turbo", messages=[{"role": "user", "content": "hi"}])
+
+def tool_call(call_id, name, arguments):
+    return {"id": call_id, "type": "function", "function": {"name": name, "arguments": json.dumps(arguments)}}
+
+def reply(content=None, tool_calls=None):
+    message = {"role": "assistant", "content": content}
+    if tool_calls:
+        message["tool_calls"] = tool_calls
+    return {"choices": [{"message": message, "finish_reason": "tool_calls" if tool_calls else "stop"}]}
+
+class ScriptedUpstream:
+    """Returns the scripted replies in turn, repeating the last one"""
+
+    def __init__(self, replies):
+        self.replies = replies
+        self.requests = []
+
+    async def complete(self, **params):
+        self.requests.append(list(params["messages"]))
+        return self.replies[min(len(self.requests), len(self.replies)) - 1]
+
+def complete(monkeypatch, replies):
+    upstream = ScriptedUpstream(replies)
+    monkeypatch.setattr(server, "UPSTREAM", upstream)
+    monkeypatch.setattr(server, "TOOL_CACHE", None)
+    response = asyncio.run(server.complete_with_tools([{"role": "user", "content": "hi"}], REQUEST, tools=[]))
+    return response, upstream
+
+def test_tool_rounds_run_in_parallel_until_the_model_answers(monkeypatch):
+    async def slow(expression):
+        await asyncio.sleep(0.2)
+        return {"expression": expression, "result": 1, "success": True}
+    monkeypatch.setitem(server.TOOL_FUNCTIONS, "calculate", slow)
+
+    started = time.perf_counter()
+    response, upstream = complete(monkeypatch, [
+        reply(tool_calls=[tool_call("a", "calculate", {"expression": "1"}), tool_call("b", "calculate", {"expression": "2"})]),
+        reply(tool_calls=[tool_call("c", "get_weather", {"location": "London"})]),
+        reply("done"),
+    ])
+    elapsed = time.perf_counter() - started
+
+    assert response["choices"][0]["message"]["content"] == "done"
+    assert [(r["id"], r["round"]) for r in response["tool_executions"]] == [("a", 0), ("b", 0), ("c", 1)]
+    # Both calls of the first round ran at once
+    assert elapsed < 0.35
+    second_round = upstream.requests[1]
+    assert [m["role"] for m in second_round] == ["user", "assistant", "tool", "tool"]
+    assert [m["tool_call_id"] for m in second_round[2:]] == ["a", "b"]
+    assert json.loads(upstream.requests[2][-1]["content"])["resolved_location"].startswith("London")
+
+def test_rounds_stop_at_the_limit(monkeypatch):
+    monkeypatch.setattr(server, "MAX_TOOL_ROUNDS", 2)
+    looping = reply(tool_calls=[tool_call("a", "calculate", {"expression": "1 + 1"})])
+    response, upstream = complete(monkeypatch, [looping])
+    assert len(upstream.requests) == 3
+    assert len(response["tool_executions"]) == 2
+    assert response["choices"][0]["message"]["tool_calls"]
+
+def test_rounds_with_client_tools_are_returned_unexecuted(monkeypatch):
+    calls = [tool_call("a", "calculate", {"expression": "1"}), tool_call("b", "open_door", {})]
+    response, upstream = complete(monkeypatch, [reply(tool_calls=calls)])
+    assert len(upstream.requests) == 1
+    assert "tool_executions" not in response
+    assert response["choices"][0]["message"]["tool_calls"] == calls
+
+def test_tool_failures_become_error_results(monkeypatch):
+    async def hang(expression):
+        await asyncio.sleep(5)
+    monkeypatch.setitem(server.TOOL_FUNCTIONS, "calculate", hang)
+    monkeypatch.setattr(server, "TOOL_CACHE", None)
+
+    def run(call, timeout=0.05):
+        return json.loads(asyncio.run(server.execute_tool_call(call, timeout))["content"])
+
+    assert run(tool_call("a", "calculate", {"expression": "1"})) == {"error": "Tool timed out after 0.05s", "success": False}
+    assert run(tool_call("b", "nope", {}))["error"] == "Unknown function: nope"
+    broken = {"id": "c", "function": {"name": "get_weather", "arguments": "{not json"}}
+    assert run(broken)["success"] is False
+    assert run(tool_call("d", "get_weather", {"city": "London"}))["success"] is False
@@ -0,0 +1,118 @@
+#!/usr/bin/env python3
+"""
+Tests for the upstream client
+Retries with backoff, the concurrency limit, and connection reuse by the OpenAI backend
+"""
+
+import asyncio
+
+import pytest
+
+from upstream import OpenAIBackend, StubBackend, UpstreamBackend, UpstreamClient, UpstreamError, create_backend
+
+class FlakyBackend(UpstreamBackend):
+    """Fails with the given errors first, then answers; streams three chunks"""
+    name = "flaky"
+
+    def __init__(self, errors=(), delay=0.0):
+        self.errors = list(errors)
+        self.delay = delay
+        self.calls = 0
+        self.active = 0
+        self.peak = 0
+
+    async def _attempt(self):
+        self.calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        self.active += 1
+        self.peak = max(self.peak, self.active)
+        try:
+            await asyncio.sleep(self.delay)
+        finally:
+            self.active -= 1
+
+    async def complete(self, **params):
+        await self._attempt()
+        return {"choices": [{"message": {"role": "assistant", "content": "ok"}}]}
+
+    async def stream(self, **params):
+        await self._attempt()
+
+        async def chunks():
+            for i in range(3):
+                yield {"n": i}
+        return chunks()
+
+def client(backend, **options):
+    return UpstreamClient(backend, backoff_base=0.001, backoff_max=0.01, **options)
+
+def test_retryable_errors_are_retried():
+    backend = FlakyBackend([UpstreamError("busy", status=503), ConnectionError("reset")])
+    upstream = client(backend)
+    assert asyncio.run(upstream.complete(model="m"))["choices"][0]["message"]["content"] == "ok"
+    assert (backend.calls, upstream.retries, upstream.failures) == (3, 2, 0)
+
+def test_other_errors_and_exhausted_retries_are_raised():
+    backend = FlakyBackend([UpstreamError("bad request", status=400)])
+    upstream = client(backend)
+    with pytest.raises(UpstreamError, match="bad request"):
+        asyncio.run(upstream.complete(model="m"))
+    assert backend.calls == 1
+
+    backend = FlakyBackend([UpstreamError("busy", status=429)] * 5)
+    upstream = client(backend, max_retries=2)
+    with pytest.raises(UpstreamError, match="busy"):
+        asyncio.run(upstream.complete(model="m"))
+    assert (backend.calls, upstream.retries, upstream.failures) == (3, 2, 1)
+
+def test_backoff_honours_retry_after_up_to_the_cap():
+    upstream = UpstreamClient(FlakyBackend(), backoff_base=0.5, backoff_max=8.0)
+    assert 0 <= upstream.backoff_delay(3, UpstreamError("busy", status=503)) <= 4.0
+    assert upstream.backoff_delay(0, UpstreamError("busy", status=429, retry_after=3)) >= 3
+    assert upstream.backoff_delay(0, UpstreamError("busy", status=429, retry_after=60)) == 8.0
+
+def test_concurrency_is_capped_and_streams_hold_their_slot():
+    backend = FlakyBackend(delay=0.02)
+    upstream = client(backend, max_concurrency=2)
+
+    async def run():
+        await asyncio.gather(*(upstream.complete(model="m") for _ in range(6)))
+        stream = upstream.stream(model="m")
+        first = await stream.__anext__()
+        held = upstream.in_flight
+        await stream.aclose()
+        return first, held
+    first, held = asyncio.run(run())
+    assert backend.peak == 2
+    assert first == {"n": 0} and held == 1 and upstream.in_flight == 0
+
+def test_stream_opening_is_retried():
+    backend = FlakyBackend([UpstreamError("busy", status=502)])
+    upstream = client(backend)
+
+    async def run():
+        return [chunk async for chunk in upstream.stream(model="m")]
+    assert asyncio.run(run()) == [{"n": 0}, {"n": 1}, {"n": 2}]
+    assert upstream.retries == 1
+
+def test_backends_are_created_by_name():
+    assert isinstance(create_backend("stub", time_to_first_token=0), StubBackend)
+    with pytest.raises(ValueError, match="Unknown LLM backend"):
+        create_backend("nope")
+
+def test_openai_backend_reuses_one_session_per_loop():
+    backend = OpenAIBackend(pool_size=7)
+
+    async def sessions():
+        first, second = backend._get_session(), backend._get_session()
+        limit = first.connector.limit
+        return first, second, limit
+
+    first, second, limit = asyncio.run(sessions())
+    assert first is second and limit == 7
+    third, _, _ = asyncio.run(sessions())
+    # A ClientSession is bound to its loop, so another loop gets its own
+    assert third is not first
+    asyncio.run(backend.aclose())
+    assert third.closed
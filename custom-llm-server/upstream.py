@@ -0,0 +1,292 @@
+"""
+Upstream LLM client for the Custom LLM Server
+Pluggable backends behind a shared client that pools connections, limits
+concurrent requests and retries transient failures with jittered backoff
+"""
+
+import asyncio
+import random
+import time
+from typing import TYPE_CHECKING, Any, AsyncIterator, Dict, List, Optional, Tuple
+
+from metrics import UPSTREAM_IN_FLIGHT, observe_stage
+
+# HTTP statuses worth retrying: rate limits and transient server errors
+RETRYABLE_STATUSES = frozenset({408, 409, 429, 500, 502, 503, 504})
+
+if TYPE_CHECKING:
+    import aiohttp
+
+class UpstreamError(Exception):
+    """Error raised by a backend, carrying the upstream HTTP status"""
+
+    def __init__(self, message: str, status: Optional[int] = None, retry_after: Optional[float] = None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+class UpstreamBackend:
+    """Interface for LLM backends
+
+    complete() returns an OpenAI-format completion dict; stream() returns an
+    async iterator of OpenAI-format chunk dicts. Both take the same keyword
+    arguments as the OpenAI chat completions API.
+    """
+    name = "base"
+
+    async def complete(self, **params) -> Dict[str, Any]:
+        raise NotImplementedError
+
+    async def stream(self, **params) -> AsyncIterator[Dict[str, Any]]:
+        raise NotImplementedError
+
+    def is_retryable(self, error: Exception) -> bool:
+        """Whether a failed call may succeed if repeated"""
+        if isinstance(error, UpstreamError):
+            return error.status in RETRYABLE_STATUSES
+        return isinstance(error, (asyncio.TimeoutError, ConnectionError))
+
+    def retry_after(self, error: Exception) -> Optional[float]:
+        """Server-requested delay before retrying, if any"""
+        return getattr(error, "retry_after", None)
+
+    async def aclose(self) -> None:
+        pass
+
+class OpenAIBackend(UpstreamBackend):
+    """OpenAI via the openai 0.28 SDK, sharing one keep-alive aiohttp session
+
+    The SDK and aiohttp take about a third of a second to import, so they
+    are imported on first use and servers on other backends never load them.
+    """
+    name = "openai"
+
+    def __init__(self, api_key: Optional[str] = None, api_base: Optional[str] = None,
+                 pool_size: int = 100, keepalive_seconds: float = 30):
+        self.api_key = api_key
+        self.api_base = api_base
+        self.pool_size = pool_size
+        self.keepalive_seconds = keepalive_seconds
+        self._session: Optional["aiohttp.ClientSession"] = None
+        self._session_loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _get_session(self) -> "aiohttp.ClientSession":
+        # Created lazily because a ClientSession must be bound to the running loop
+        import aiohttp
+        loop = asyncio.get_running_loop()
+        if self._session is None or self._session.closed or self._session_loop is not loop:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=self.keepalive_seconds)
+            self._session = aiohttp.ClientSession(connector=connector)
+            self._session_loop = loop
+        return self._session
+
+    async def _create(self, **params):
+        import openai
+        # openai 0.28 reuses the session set in this context instead of opening one per call
+        openai.aiosession.set(self._get_session())
+        if self.api_key:
+            params.setdefault("api_key", self.api_key)
+        if self.api_base:
+            params.setdefault("api_base", self.api_base)
+        if params.get("tools") is None:
+            params.pop("tools", None)
+        return await openai.ChatCompletion.acreate(**params)
+
+    async def complete(self, **params) -> Dict[str, Any]:
+        return await self._create(**params)
+
+    async def stream(self, **params) -> AsyncIterator[Dict[str, Any]]:
+        return await self._create(stream=True, **params)
+
+    def is_retryable(self, error: Exception) -> bool:
+        import aiohttp
+        import openai
+        if isinstance(error, aiohttp.ClientConnectionError):
+            return True
+        if isinstance(error, (openai.error.RateLimitError, openai.error.ServiceUnavailableError,
+                              openai.error.APIConnectionError, openai.error.Timeout, openai.error.TryAgain)):
+            return True
+        if getattr(error, "http_status", None) in RETRYABLE_STATUSES:
+            return True
+        return super().is_retryable(error)
+
+    def retry_after(self, error: Exception) -> Optional[float]:
+        headers = getattr(error, "headers", None) or {}
+        try:
+            return float(headers.get("retry-after"))
+        except (TypeError, ValueError):
+            return None
+
+    async def aclose(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+
+class StubBackend(UpstreamBackend):
+    """Offline backend for load testing; answers with canned text at a set pace"""
+    name = "stub"
+
+    def __init__(self, reply: str = "This is a stub response from the local test backend.",
+                 time_to_first_token: float = 0.05, tokens_per_second: float = 50,
+                 error_rate: float = 0.0, slow_rate: float = 0.0, slow_time_to_first_token: float = 3.0):
+        self.reply = reply
+        self.time_to_first_token = time_to_first_token
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        # Share of calls whose first token is slow, to exercise tail-latency handling
+        self.slow_rate = slow_rate
+        self.slow_time_to_first_token = slow_time_to_first_token
+
+    def _first_token_delay(self) -> float:
+        if self.slow_rate and random.random() < self.slow_rate:
+            return self.slow_time_to_first_token
+        return self.time_to_first_token
+
+    def _maybe_fail(self) -> None:
+        if self.error_rate and random.random() < self.error_rate:
+            raise UpstreamError("Stub backend injected failure", status=503)
+
+    def _tokens(self, max_tokens: Optional[int] = None) -> Tuple[List[str], str]:
+        """The reply's words as tokens, cut at max_tokens like a real model, and the finish_reason"""
+        words = self.reply.split(" ")
+        tokens = [words[0]] + [f" {word}" for word in words[1:]]
+        if max_tokens is not None and len(tokens) > max_tokens:
+            return tokens[:max_tokens], "length"
+        return tokens, "stop"
+
+    async def complete(self, **params) -> Dict[str, Any]:
+        await asyncio.sleep(self._first_token_delay())
+        self._maybe_fail()
+        tokens, finish_reason = self._tokens(params.get("max_tokens"))
+        await asyncio.sleep(len(tokens) / self.tokens_per_second)
+        return {
+            "id": f"chatcmpl-stub-{random.getrandbits(48):012x}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": params.get("model", "stub"),
+            "choices": [{
+                "index": 0,
+                "message": {"role": "assistant", "content": "".join(tokens)},
+                "finish_reason": finish_reason
+            }],
+            "usage": {"prompt_tokens": 0, "completion_tokens": len(tokens), "total_tokens": len(tokens)}
+        }
+
+    async def stream(self, **params) -> AsyncIterator[Dict[str, Any]]:
+        await asyncio.sleep(self._first_token_delay())
+        self._maybe_fail()
+        return self._stream_tokens(params.get("model", "stub"), params.get("max_tokens"))
+
+    async def _stream_tokens(self, model: str, max_tokens: Optional[int]) -> AsyncIterator[Dict[str, Any]]:
+        completion_id = f"chatcmpl-stub-{random.getrandbits(48):012x}"
+        created = int(time.time())
+        delay = 1 / self.tokens_per_second
+        tokens, finish_reason = self._tokens(max_tokens)
+        for i, token in enumerate(tokens):
+            if i:
+                await asyncio.sleep(delay)
+            yield {
+                "id": completion_id,
+                "object": "chat.completion.chunk",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "delta": {"content": token}, "finish_reason": None}]
+            }
+        yield {
+            "id": completion_id,
+            "object": "chat.completion.chunk",
+            "created": created,
+            "model": model,
+            "choices": [{"index": 0, "delta": {}, "finish_reason": finish_reason}]
+        }
+
+# Backends selectable by name through LLM_BACKEND
+BACKENDS = {
+    "openai": OpenAIBackend,
+    "stub": StubBackend,
+}
+
+def create_backend(name: str, **kwargs) -> UpstreamBackend:
+    """Instantiate a registered backend by name"""
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown LLM backend: {name}. Available: {list(BACKENDS)}")
+    return BACKENDS[name](**kwargs)
+
+class UpstreamClient:
+    """Shared entry point for all upstream LLM calls"""
+
+    def __init__(self, backend: UpstreamBackend, max_concurrency: int = 64, max_retries: int = 3,
+                 backoff_base: float = 0.5, backoff_max: float = 8.0):
+        self.backend = backend
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self.in_flight = 0
+        self.retries = 0
+        self.failures = 0
+
+    def backoff_delay(self, attempt: int, error: Exception) -> float:
+        """Full-jitter exponential backoff, never shorter than a Retry-After hint"""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        retry_after = self.backend.retry_after(error)
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.backoff_max))
+        return delay
+
+    async def _call_with_retries(self, method: str, params: Dict[str, Any]):
+        attempt = 0
+        while True:
+            try:
+                return await getattr(self.backend, method)(**params)
+            except Exception as e:
+                if attempt >= self.max_retries or not self.backend.is_retryable(e):
+                    self.failures += 1
+                    raise
+                await asyncio.sleep(self.backoff_delay(attempt, e))
+                attempt += 1
+                self.retries += 1
+
+    async def complete(self, **params) -> Dict[str, Any]:
+        """Non-streaming completion"""
+        async with self._semaphore:
+            self.in_flight += 1
+            UPSTREAM_IN_FLIGHT.inc()
+            started = time.perf_counter()
+            try:
+                return await self._call_with_retries("complete", params)
+            finally:
+                observe_stage("upstream_complete", time.perf_counter() - started)
+                self.in_flight -= 1
+                UPSTREAM_IN_FLIGHT.dec()
+
+    async def stream(self, **params) -> AsyncIterator[Dict[str, Any]]:
+        """Streaming completion; the concurrency slot is held until the stream ends
+
+        Only opening the stream is retried, since chunks already forwarded to
+        the client cannot be taken back.
+        """
+        async with self._semaphore:
+            self.in_flight += 1
+            UPSTREAM_IN_FLIGHT.inc()
+            try:
+                started = time.perf_counter()
+                response = await self._call_with_retries("stream", params)
+                observe_stage("upstream_connect", time.perf_counter() - started)
+                async for chunk in response:
+                    yield chunk
+            finally:
+                self.in_flight -= 1
+                UPSTREAM_IN_FLIGHT.dec()
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "backend": self.backend.name,
+            "in_flight": self.in_flight,
+            "max_concurrency": self.max_concurrency,
+            "retries": self.retries,
+            "failures": self.failures,
+        }
+
+    async def aclose(self) -> None:
+        await self.backend.aclose()